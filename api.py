@@ -1,48 +1,18 @@
-import socket
 import os
-import re
+import time
+import weakref
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import asyncio
 import aiohttp
 import database 
+import budget
+import metrics
+import resolver
 
 # --- Load .env file to make sure keys are available ---
 load_dotenv()
 
-# --- DNS Patching ---
-HOST_IP_MAP = {
-    "www.ipqualityscore.com": "104.18.12.18",
-    "otx.alienvault.com": "34.239.115.143"
-}
-for host in HOST_IP_MAP:
-    try:
-        HOST_IP_MAP[host] = socket.gethostbyname(host)
-    except socket.gaierror:
-        print(f"Warning: DNS resolution failed for {host}. Using fallback IP.")
-
-class CustomResolver(aiohttp.abc.AbstractResolver):
-    async def resolve(self, host, port, family=socket.AF_INET):
-        if host in HOST_IP_MAP:
-            ip = HOST_IP_MAP[host]
-            return [{'hostname': host, 'host': ip, 'port': port, 'family': family, 'proto': 0, 'flags': 0}]
-        loop = asyncio.get_event_loop()
-        return await loop.getaddrinfo(host, port, family=family)
-
-    async def close(self):
-        pass
-
-def extract_ips_from_file(filepath):
-    """ Reads a file and extracts all unique IPv4 addresses using regex. """
-    IP_REGEX = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b'
-    try:
-        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-            ips = re.findall(IP_REGEX, content)
-            return list(set(ips))
-    except Exception as e:
-        print(f"Error reading or processing file: {e}")
-        return []
-
 # --- API Key Getters ---
 def get_ipqs_api_key():
     key = os.getenv('IPQS_API_KEY')
@@ -52,22 +22,146 @@ def get_otx_api_key():
     key = os.getenv('OTX_API_KEY')
     return key.strip() if key else None
 
+DEFAULT_MALICIOUS_THRESHOLD = 85
+
+def get_malicious_threshold():
+    """ IPQS fraud score from which an IP counts as malicious (MALICIOUS_THRESHOLD, 0-100). """
+    value = os.getenv("MALICIOUS_THRESHOLD", "").strip()
+    return int(value) if value.isdigit() and int(value) <= 100 else DEFAULT_MALICIOUS_THRESHOLD
+
+# --- Shared Rate Limiting ---
+class RateLimiter:
+    """
+    Async token bucket: at most `rate` requests per second with bursts of up to `burst`.
+    One instance per provider is shared by every concurrent job; create it on the loop that uses it.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def _read_rate(name, default):
+    try:
+        rate = float(os.getenv(name, default))
+    except ValueError:
+        rate = float(default)
+    return rate if rate > 0 else None
+
+def get_rate_limiters():
+    """ Builds the per-provider limiters from IPQS_RATE_PER_SEC / OTX_RATE_PER_SEC (0 = unlimited). """
+    limiters = {}
+    for provider, name, default in ((budget.PROVIDER_IPQS, "IPQS_RATE_PER_SEC", "5"), (budget.PROVIDER_OTX, "OTX_RATE_PER_SEC", "2")):
+        rate = _read_rate(name, default)
+        if rate:
+            limiters[provider] = RateLimiter(rate)
+    return limiters
+
+async def _throttle(limiters, provider, run_metrics=metrics.NULL_METRICS):
+    if limiters and provider in limiters:
+        start = time.perf_counter()
+        await limiters[provider].acquire()
+        run_metrics.add_stage("rate_limit_wait", time.perf_counter() - start)
+
+async def _timed_request(run_metrics, provider, request):
+    """ Awaits one provider request, recording its latency. """
+    start = time.perf_counter()
+    try:
+        return await request
+    finally:
+        run_metrics.observe_latency(provider, time.perf_counter() - start)
+
+def _count_request(run_metrics, provider, error_class=None):
+    run_metrics.incr("provider_requests_total", provider=provider, outcome="error" if error_class else "ok")
+    if error_class:
+        run_metrics.incr("provider_errors_total", provider=provider, error_class=error_class)
+
+async def _get_otx_pulses(session, ip, limiters, run_metrics):
+    await _throttle(limiters, budget.PROVIDER_OTX, run_metrics)
+    pulses = await _timed_request(run_metrics, budget.PROVIDER_OTX, get_otx_pulse_count_async(session, ip))
+    _count_request(run_metrics, budget.PROVIDER_OTX, ERROR_NETWORK if pulses == -1 else None)
+    return pulses
+
+# --- Failed Lookup Classification & Negative Cache ---
+ERROR_INVALID_IP = "invalid_ip"
+ERROR_AUTH = "auth"
+ERROR_QUOTA = "quota"
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_NETWORK = "network"
+ERROR_API = "api"
+
+# Account-level and transport failures (timeouts, DNS, HTTP 5xx, offline) say nothing about
+# the IP itself, so they are never negative-cached.
+UNCACHEABLE_ERRORS = {ERROR_AUTH, ERROR_QUOTA, ERROR_RATE_LIMIT, ERROR_NETWORK}
+
+def classify_ipqs_error(message):
+    """ Maps an IPQS error message onto one of the ERROR_* classes. """
+    text = (message or "").lower()
+    if "key" in text and ("invalid" in text or "unauthorized" in text or "not set" in text):
+        return ERROR_AUTH
+    if "quota" in text or "credits" in text or "exceeded" in text:
+        return ERROR_QUOTA
+    if "too many" in text or "429" in text:
+        return ERROR_RATE_LIMIT
+    if "invalid ip" in text or "private" in text or "reserved" in text or "not a valid" in text:
+        return ERROR_INVALID_IP
+    return ERROR_API
+
+def negative_cache_ttl(error_count):
+    """
+    How long to wait before retrying an IP after `error_count` consecutive failures:
+    NEGATIVE_CACHE_MINUTES (default 30), doubled per repeat, capped at NEGATIVE_CACHE_MAX_HOURS (default 168).
+    """
+    try:
+        base = timedelta(minutes=int(os.getenv("NEGATIVE_CACHE_MINUTES", "30")))
+        cap = timedelta(hours=int(os.getenv("NEGATIVE_CACHE_MAX_HOURS", "168")))
+    except ValueError:
+        base, cap = timedelta(minutes=30), timedelta(hours=168)
+    return min(base * 2 ** min(max(error_count, 1) - 1, 20), cap)
+
+def is_negatively_cached(details, now=None):
+    """ True if the IP's last lookup failed recently enough that retrying would waste a request. """
+    if not details or not details['last_error_at'] or details['last_error_class'] in UNCACHEABLE_ERRORS:
+        return False
+    try:
+        failed_at = datetime.fromisoformat(details['last_error_at'])
+    except ValueError:
+        return False
+    return (now or datetime.now()) - failed_at < negative_cache_ttl(details['error_count'])
+
 # --- ASYNCHRONOUS API Calls ---
 async def get_ipqs_reputation_async(session, ip_address):
     api_key = get_ipqs_api_key()
-    if not api_key: return {'error': 'IPQS Key not set.'}
+    if not api_key: return {'error': 'IPQS Key not set.', 'error_class': ERROR_AUTH}
     
     full_url = f"https://www.ipqualityscore.com/api/json/ip/{api_key}/{ip_address}"
     params = {'strictness': 0, 'allow_public_access_points': 'true'}
     try:
         async with session.get(full_url, params=params, timeout=20) as response:
+            if response.status == 429:
+                return {'error': 'Too many requests (HTTP 429)', 'error_class': ERROR_RATE_LIMIT}
             response.raise_for_status()
             data = await response.json()
             if not data.get('success', False):
-                return {'error': data.get('message', 'Unknown API error')}
+                message = data.get('message', 'Unknown API error')
+                return {'error': message, 'error_class': classify_ipqs_error(message)}
             return {'data': data}
     except Exception as e:
-        return {'error': f'API request failed: {e}'}
+        return {'error': f'API request failed: {e}', 'error_class': ERROR_NETWORK}
 
 async def get_otx_pulse_count_async(session, ip_address):
     api_key = get_otx_api_key()
@@ -100,55 +194,157 @@ async def get_ipqs_account_stats_async(session):
     except Exception as e:
         return {'error': f'API request failed: {e}'}
 
-async def process_single_ip_and_save(session, ip_info, api_key_otx, progress_callback):
+async def get_ipqs_credits_remaining_async(session=None):
+    """ Returns the remaining IPQS credits as an int, or None if they could not be fetched. """
+    if session is None:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(resolver=resolver.CachingResolver(), ssl=False)) as own_session:
+            result = await get_ipqs_account_stats_async(own_session)
+    else:
+        result = await get_ipqs_account_stats_async(session)
+    try:
+        return int(result['data']['credits_remaining'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+# --- Singleflight: one in-flight provider call (and one DB write) per (IP, provider) ---
+class SingleFlight:
     """
-    Processes a single IP, saves the result to the DB, and returns the IP's ID.
+    Coalesces concurrent calls that share a key onto one in-flight future. The first caller
+    runs the work; everyone arriving while it runs awaits the same result. If the running
+    caller is cancelled, a waiting caller takes over instead of failing. Event loop only.
     """
+    def __init__(self):
+        self.calls = {}
+
+    def is_inflight(self, key):
+        return key in self.calls
+
+    async def do(self, key, work):
+        """ Returns (result, shared) where `shared` is True if another caller did the work. """
+        while key in self.calls:
+            future = self.calls[key]
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This caller was cancelled, not the one doing the work
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())  # Never "never retrieved"
+        self.calls[key] = future
+        try:
+            result = await work()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+_single_flights = weakref.WeakKeyDictionary()
+
+def get_single_flight():
+    """ The SingleFlight of the running event loop (futures cannot be shared across loops). """
+    loop = asyncio.get_running_loop()
+    if loop not in _single_flights:
+        _single_flights[loop] = SingleFlight()
+    return _single_flights[loop]
+
+async def _fetch_otx(session, ip, ip_id, limiters, run_metrics, write):
+    """ Fetches the OTX pulse count; an OTX-only refresh (`write`) also stores it. """
+    pulses = await _get_otx_pulses(session, ip, limiters, run_metrics)
+    if write:
+        with run_metrics.stage("db_write"):
+            database.update_otx_pulses(ip_id, pulses)
+    return pulses
+
+async def _lookup_and_save(session, ip_info, api_key_otx, limiters, run_metrics, flight):
+    """ Queries IPQS (and OTX where stale), writes the record once and returns the outcome for the callback. """
     ip = ip_info['ip']
     existing_details = ip_info['details']
     ip_id = existing_details['id'] if existing_details else None
+    providers = ip_info.get('providers', {budget.PROVIDER_IPQS, budget.PROVIDER_OTX})
+
+    if existing_details and existing_details['error_count']:
+        run_metrics.incr("retries_total", provider=budget.PROVIDER_IPQS)
+    await _throttle(limiters, budget.PROVIDER_IPQS, run_metrics)
+    ipqs_result = await _timed_request(run_metrics, budget.PROVIDER_IPQS, get_ipqs_reputation_async(session, ip))
+    _count_request(run_metrics, budget.PROVIDER_IPQS, ipqs_result.get('error_class', ERROR_API) if 'data' not in ipqs_result else None)
 
-    ipqs_result = await get_ipqs_reputation_async(session, ip)
-    
     if 'data' in ipqs_result:
         data = ipqs_result['data']
         country = data.get("country_code", "N/A")
         score = data.get("fraud_score", 0)
         
-        malicious = score >= 85
+        malicious = score >= get_malicious_threshold()
         
         isp = data.get("ISP", "N/A")
         org = data.get("organization", "N/A")
         
-        pulses = -1
-        if api_key_otx:
-            pulses = await get_otx_pulse_count_async(session, ip)
+        pulses = shown_pulses = None  # OTX still fresh: keep the stored count
+        if not api_key_otx:
+            pulses = shown_pulses = -1
+        elif budget.PROVIDER_OTX in providers:
+            shown_pulses, otx_shared = await flight.do(
+                (ip, budget.PROVIDER_OTX), lambda: _fetch_otx(session, ip, ip_id, limiters, run_metrics, write=False))
+            # A concurrent OTX-only refresh that ran the call also stores it
+            pulses = None if otx_shared else shown_pulses
         
-        if ip_id:
-            database.update_ip_record_details(ip_id, country, malicious, score, isp, org, pulses)
-        else:
-            ip_id = database.add_ip_record(ip, country, malicious, score, isp, org, pulses)
+        with run_metrics.stage("db_write"):
+            if ip_id:
+                database.update_ip_record_details(ip_id, country, malicious, score, isp, org, pulses, payload=data)
+            else:
+                ip_id = database.add_ip_record(ip, country, malicious, score, isp, org, pulses, payload=data)
 
-        progress_callback({'ip': ip, 'result': {'score': score, 'country': country, 'pulses': pulses}})
-        return {'ip_id': ip_id}
+        if shown_pulses is None:
+            shown_pulses = existing_details['otx_pulses']
+        return {'ip_id': ip_id, 'result': {'score': score, 'country': country, 'pulses': shown_pulses}}
 
     else:
-        progress_callback({'ip': ip, 'error': ipqs_result.get('error', 'Unknown')})
-        ip_id = database.get_or_create_ip_id(ip)
-        return {'ip_id': ip_id}
+        error_class = ipqs_result.get('error_class', ERROR_API)
+        with run_metrics.stage("db_write"):
+            if error_class in UNCACHEABLE_ERRORS:
+                ip_id = database.get_or_create_ip_id(ip)
+            else:
+                ip_id = database.record_ip_failure(ip, error_class)
+        return {'ip_id': ip_id, 'error': ipqs_result.get('error', 'Unknown'), 'error_class': error_class}
 
-async def run_concurrent_analysis(ips_to_query, api_key_otx, progress_callback, cancel_event):
+async def process_single_ip_and_save(session, ip_info, api_key_otx, progress_callback, limiters=None, run_metrics=None):
     """
-    The main entry point for concurrent analysis.
+    Processes a single IP, saves the result to the DB, and returns the IP's ID.
+    Each provider call first waits for its shared rate limiter, if one is given.
+    Latencies, outcomes and DB write time are recorded into `run_metrics` (a metrics.RunMetrics).
+
+    Concurrent calls for the same (IP, provider) share one provider request and one DB
+    write; callers that joined another's request get `'shared': True` in their progress
+    callback (they spent no credit).
     """
-    conn = aiohttp.TCPConnector(resolver=CustomResolver(), ssl=False)
-    async with aiohttp.ClientSession(connector=conn, headers={'User-Agent': 'LOCKON IP Prism v2.1'}) as session:
-        tasks = []
-        for ip_info in ips_to_query:
-            if cancel_event.is_set():
-                break
-            task = asyncio.create_task(process_single_ip_and_save(session, ip_info, api_key_otx, progress_callback))
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        return [r for r in results if r is not None and not isinstance(r, Exception)]
+    run_metrics = run_metrics or metrics.NULL_METRICS
+    flight = get_single_flight()
+    ip = ip_info['ip']
+    existing_details = ip_info['details']
+    ip_id = existing_details['id'] if existing_details else None
+    providers = ip_info.get('providers', {budget.PROVIDER_IPQS, budget.PROVIDER_OTX})
+
+    # --- Partial refresh: only the OTX pulse count is stale, no IPQS credit is spent ---
+    if budget.PROVIDER_IPQS not in providers:
+        pulses, shared = await flight.do(
+            (ip, budget.PROVIDER_OTX), lambda: _fetch_otx(session, ip, ip_id, limiters, run_metrics, write=True))
+        progress_callback({'ip': ip, 'otx_only': True, 'shared': shared, 'result': {'pulses': pulses}})
+        return {'ip_id': ip_id}
+
+    outcome, shared = await flight.do(
+        (ip, budget.PROVIDER_IPQS), lambda: _lookup_and_save(session, ip_info, api_key_otx, limiters, run_metrics, flight))
+    progress_callback({'ip': ip, 'shared': shared, **{key: value for key, value in outcome.items() if key != 'ip_id'}})
+    return {'ip_id': outcome['ip_id']}
+
+def create_session():
+    """ The HTTP session used for lookups; must be created inside a running event loop. """
+    conn = aiohttp.TCPConnector(resolver=resolver.CachingResolver(), ssl=False)
+    return aiohttp.ClientSession(connector=conn, headers={'User-Agent': 'LOCKON IP Prism v2.1'})
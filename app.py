@@ -2,7 +2,7 @@ import customtkinter as ctk
 from tkinter import filedialog, messagebox
 import threading
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import traceback
 import sys
 import asyncio
@@ -13,6 +13,12 @@ try:
     from dotenv import load_dotenv, set_key
     import database
     import api
+    import job_queue
+    import log_watcher
+    import lookup_service
+    import refresh_ahead
+    import rederive
+    import resolver
     from settings_window import SettingsWindow
     from history_window import HistoryWindow
     from help_window import HelpWindow
@@ -75,18 +81,24 @@ class App(ctk.CTk):
         load_dotenv()
 
         self.title("LOCKON IP Prism")
-        self.geometry("800x750") # Increased height for new panel
+        self.geometry("800x850") # Increased height for the job queue panel
         self.grid_columnconfigure(0, weight=1)
-        self.grid_rowconfigure(5, weight=1) # Adjusted for new panel
+        self.grid_rowconfigure(6, weight=1) # Log console takes the spare height
 
-        self.selected_file_path = ""
+        self.selected_file_paths = []
+        self.selected_folder = None
         self.history_win = None
         self.settings_win = None
         self.help_win = None
         self.is_closing = False
         
-        self.analysis_thread = None
-        self.cancel_requested = threading.Event()
+        # --- Analysis jobs run concurrently on the queue's background thread ---
+        self.job_queue = job_queue.JobQueue(on_update=self.on_job_update)
+        self.job_rows = {}
+        self.progress_jobs = []
+        self.log_watcher = None
+        self.lookup_service = None
+        self.refresh_scheduler = None
 
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
@@ -147,15 +159,22 @@ class App(ctk.CTk):
         self.input_frame.grid(row=3, column=0, padx=10, pady=10, sticky="ew")
         self.input_frame.grid_columnconfigure(1, weight=1)
 
-        self.select_file_button = ctk.CTkButton(self.input_frame, text="Select IP File (.txt, .log)", command=self.select_file)
+        self.select_file_button = ctk.CTkButton(self.input_frame, text="Select IP File(s) (.txt, .log)", command=self.select_file)
         self.select_file_button.grid(row=0, column=0, padx=10, pady=10)
 
         self.file_path_label = ctk.CTkLabel(self.input_frame, text="No file selected", anchor="w")
         self.file_path_label.grid(row=0, column=1, padx=10, pady=10, sticky="ew")
 
+        self.select_folder_button = ctk.CTkButton(self.input_frame, text="Select Folder", width=110, command=self.select_folder)
+        self.select_folder_button.grid(row=0, column=2, padx=10, pady=10)
+
         self.description_entry = ctk.CTkEntry(self.input_frame, placeholder_text="Enter a description for this batch...")
         self.description_entry.grid(row=1, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
 
+        self.merge_files_var = ctk.StringVar(value="false")
+        self.merge_files_checkbox = ctk.CTkCheckBox(self.input_frame, text="Merge into one batch", variable=self.merge_files_var, onvalue="true", offvalue="false")
+        self.merge_files_checkbox.grid(row=1, column=2, padx=10, pady=10)
+
         # --- Control Frame ---
         self.control_frame = ctk.CTkFrame(self)
         self.control_frame.grid(row=4, column=0, padx=10, pady=5, sticky="ew")
@@ -163,10 +182,21 @@ class App(ctk.CTk):
 
         self.start_analysis_button = ctk.CTkButton(self.control_frame, text="Start Analysis", command=self.start_analysis_thread, height=40)
         self.start_analysis_button.grid(row=0, column=0, padx=5, pady=5, sticky="ew")
+
+        self.watch_button = ctk.CTkButton(self.control_frame, text="Watch Log File(s)", command=self.toggle_watch, height=40, width=150)
+        self.watch_button.grid(row=0, column=1, padx=5, pady=5)
+
+        self.service_button = ctk.CTkButton(self.control_frame, text="Start Lookup Service", command=self.toggle_service, height=40, width=150)
+        self.service_button.grid(row=0, column=2, padx=5, pady=5)
+
+        # --- Job Queue Frame (one row per queued file) ---
+        self.jobs_frame = ctk.CTkScrollableFrame(self, height=90, label_text="Analysis Jobs")
+        self.jobs_frame.grid(row=5, column=0, padx=10, pady=(5, 10), sticky="ew")
+        self.jobs_frame.grid_columnconfigure(0, weight=1)
         
         # --- Log Console Frame ---
         self.log_frame = ctk.CTkFrame(self)
-        self.log_frame.grid(row=5, column=0, padx=10, pady=(0, 0), sticky="nsew")
+        self.log_frame.grid(row=6, column=0, padx=10, pady=(0, 0), sticky="nsew")
         self.log_frame.grid_rowconfigure(0, weight=1)
         self.log_frame.grid_columnconfigure(0, weight=1)
         
@@ -176,7 +206,7 @@ class App(ctk.CTk):
         # --- Progress Bar ---
         self.progress_bar = ctk.CTkProgressBar(self)
         self.progress_bar.set(0)
-        self.progress_bar.grid(row=6, column=0, padx=10, pady=(5, 10), sticky="ew")
+        self.progress_bar.grid(row=7, column=0, padx=10, pady=(5, 10), sticky="ew")
         
         self.check_api_key()
         self.update_dashboard()
@@ -201,9 +231,13 @@ class App(ctk.CTk):
 
     def on_closing(self):
         self.is_closing = True
-        self.cancel_requested.set()
-        if self.analysis_thread and self.analysis_thread.is_alive():
-            self.analysis_thread.join(timeout=1)
+        if self.log_watcher:
+            self.log_watcher.stop()
+        if self.lookup_service:
+            self.lookup_service.stop()
+        if self.refresh_scheduler:
+            self.refresh_scheduler.stop()
+        self.job_queue.shutdown()
         self.destroy()
 
     def check_api_key(self, from_settings=False):
@@ -225,12 +259,30 @@ class App(ctk.CTk):
         else:
             self.otx_status_value.configure(text="OK", text_color="green")
         
+        if from_settings or self.refresh_scheduler is None:
+            self.restart_refresh_scheduler()
+
         if from_settings:
             self.update_log(f"[INFO] Cache duration is set to {self.cache_duration_hours} hours.")
             if self.api_key_ipqs:
                  self.update_log("[SUCCESS] Settings applied successfully.")
             self.update_api_stats_thread()
 
+    def restart_refresh_scheduler(self):
+        """ (Re)starts refresh-ahead with the current settings; it only runs while the queue is idle. """
+        if self.refresh_scheduler:
+            self.refresh_scheduler.stop()
+        self.refresh_scheduler = refresh_ahead.RefreshScheduler(
+            self.job_queue, self.api_key_otx, self.cache_duration_hours,
+            log=lambda message: self.is_closing or self.after(0, self.update_log, message)
+        )
+        self.refresh_scheduler.start()
+
+    def start_rederive(self):
+        """ Re-derives stored verdicts (e.g. after the malicious threshold changed) off the GUI thread. """
+        log = lambda message: self.is_closing or self.after(0, self.update_log, message)
+        threading.Thread(target=rederive.run, kwargs={'log': log}, daemon=True).start()
+
     def update_api_stats_thread(self):
         """ Starts a thread to fetch API stats without freezing the GUI. """
         self.refresh_api_button.configure(state="disabled")
@@ -246,7 +298,7 @@ class App(ctk.CTk):
             asyncio.set_event_loop(loop)
             
             async def fetch():
-                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
+                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(resolver=resolver.CachingResolver(), ssl=False)) as session:
                     return await api.get_ipqs_account_stats_async(session)
             
             result = loop.run_until_complete(fetch())
@@ -268,13 +320,33 @@ class App(ctk.CTk):
             self.ipqs_status_value.configure(text=f"OK (Credits: {credits})", text_color="green")
 
     def select_file(self):
-        file_path = filedialog.askopenfilename(
-            title="Select an IP address file",
-            filetypes=(("Text files", "*.txt"), ("Log files", "*.log"), ("All files", "*.*"))
+        file_paths = filedialog.askopenfilenames(
+            title="Select one or more IP address files",
+            filetypes=(("Text & log files", "*.txt *.log *.gz *.bz2 *.xz"), ("All files", "*.*"))
         )
-        if file_path:
-            self.selected_file_path = file_path
-            self.file_path_label.configure(text=os.path.basename(file_path))
+        if file_paths:
+            self.set_selected_files(list(file_paths))
+
+    def select_folder(self):
+        """ Selects every regular file in a folder; each one becomes its own batch. """
+        folder = filedialog.askdirectory(title="Select a folder of IP/log files")
+        if folder:
+            file_paths = sorted(
+                os.path.join(folder, name) for name in os.listdir(folder)
+                if not name.startswith(".") and os.path.isfile(os.path.join(folder, name))
+            )
+            if not file_paths:
+                messagebox.showerror("Error", "The selected folder contains no files.")
+                return
+            self.set_selected_files(file_paths, folder)
+
+    def set_selected_files(self, file_paths, folder=None):
+        self.selected_file_paths = file_paths
+        self.selected_folder = folder
+        if len(file_paths) == 1:
+            self.file_path_label.configure(text=os.path.basename(file_paths[0]))
+        else:
+            self.file_path_label.configure(text=f"{len(file_paths)} files selected")
 
     def update_log(self, message, clear=False):
         if self.is_closing: return
@@ -286,7 +358,8 @@ class App(ctk.CTk):
         self.log_console.see("end")
 
     def start_analysis_thread(self):
-        if not self.selected_file_path:
+        """ Queues every selected file as its own analysis job; jobs run concurrently. """
+        if not self.selected_file_paths:
             messagebox.showerror("Error", "Please select a file first.")
             return
         
@@ -296,130 +369,128 @@ class App(ctk.CTk):
             return
 
         self.update_api_stats_thread() # Refresh credits on new analysis
-        self.cancel_requested.clear()
-        self.start_analysis_button.configure(text="Cancel Analysis", command=self.cancel_analysis, fg_color="#E74C3C", hover_color="#C0392B")
-        self.progress_bar.set(0)
-        self.update_log("", clear=True)
-
-        self.analysis_thread = threading.Thread(target=self.run_analysis, daemon=True)
-        self.analysis_thread.start()
-
-    def cancel_analysis(self):
-        """ Signals the analysis thread to stop. """
-        self.update_log("[CANCEL] Cancellation requested by user...")
-        self.cancel_requested.set()
-        self.start_analysis_button.configure(state="disabled", text="Cancelling...")
+        if not self.job_queue.is_busy():
+            self.progress_jobs = []
+            self.progress_bar.set(0)
+            self.update_log("", clear=True)
+
+        description = self.description_entry.get()
+        if self.merge_files_var.get() == "true" and len(self.selected_file_paths) > 1:
+            # One batch for all files; extraction runs in parallel across a process pool
+            label_path = self.selected_folder or self.selected_file_paths[0]
+            jobs = [job_queue.AnalysisJob(label_path, description, self.api_key_otx, self.cache_duration_hours,
+                                          source_paths=self.selected_file_paths)]
+        else:
+            jobs = [job_queue.AnalysisJob(file_path, description, self.api_key_otx, self.cache_duration_hours)
+                    for file_path in self.selected_file_paths]
+        for job in jobs:
+            self.progress_jobs.append(job)
+            self.job_queue.submit(job)
+        self.update_log(f"[QUEUE] Added {len(self.selected_file_paths)} file(s) to the analysis queue as {len(jobs)} batch(es).")
+        self.selected_file_paths = []
+        self.file_path_label.configure(text="No file selected")
+
+    def toggle_watch(self):
+        """ Starts tailing the chosen log files, or stops the running watch session. """
+        if self.log_watcher:
+            self.log_watcher.stop()
+            self.log_watcher = None
+            self.watch_button.configure(text="Watch Log File(s)", fg_color=("#3B8ED0", "#1F6AA5"), hover_color=("#36719F", "#144870"))
+            return
 
-    def run_analysis(self):
-        def safe_update_log(message):
-            """ Schedules the update_log method to be called in the main GUI thread. """
-            if not self.is_closing:
-                self.after(0, self.update_log, message)
+        self.check_api_key()
+        if not self.api_key_ipqs:
+            messagebox.showerror("API Key Missing", "IPQualityScore API Key is required. Please set it in Settings.")
+            return
+        file_paths = filedialog.askopenfilenames(
+            title="Select log files to watch",
+            filetypes=(("Log files", "*.log"), ("Text files", "*.txt"), ("All files", "*.*"))
+        )
+        if not file_paths:
+            return
+        self.log_watcher = log_watcher.LogWatcher(
+            list(file_paths), self.description_entry.get(), self.job_queue,
+            self.api_key_otx, self.cache_duration_hours,
+            log=lambda message: self.is_closing or self.after(0, self.update_log, message)
+        )
+        self.log_watcher.start()
+        self.watch_button.configure(text="Stop Watching", fg_color="#E74C3C", hover_color="#C0392B")
+
+    def toggle_service(self):
+        """ Starts or stops the local HTTP lookup service (it shares the analysis job queue). """
+        if self.lookup_service:
+            self.lookup_service.stop()
+            self.lookup_service = None
+            self.update_log("[SERVICE] Lookup service stopped.")
+            self.service_button.configure(text="Start Lookup Service", fg_color=("#3B8ED0", "#1F6AA5"), hover_color=("#36719F", "#144870"))
+            return
 
+        self.check_api_key()
+        service = lookup_service.LookupService(self.job_queue, self.api_key_otx, self.cache_duration_hours)
         try:
-            safe_update_log(f"--- Analysis Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-            
-            description = self.description_entry.get()
-            file_name = os.path.basename(self.selected_file_path)
-            batch_id = database.add_import_batch(datetime.now().isoformat(), file_name, description)
-
-            all_ips_in_file = api.extract_ips_from_file(self.selected_file_path)
-            total_ips = len(all_ips_in_file)
-            safe_update_log(f"Found {total_ips} unique IPs in '{file_name}'.")
-
-            cache_delta = timedelta(hours=self.cache_duration_hours)
-            
-            ips_to_query_api = []
-            cached_ips = []
-
-            safe_update_log("Checking database for cached data...")
-
-            # --- FIXED: Bulk check for cached IPs to improve performance ---
-            cached_records = database.find_ip_details_bulk(all_ips_in_file)
-            cached_ips_map = {row['ip_address']: row for row in cached_records}
-
-            for ip in all_ips_in_file:
-                if self.cancel_requested.is_set(): break
-                details = cached_ips_map.get(ip)
-                if details:
-                    last_check_str = details['last_api_check']
-                    if last_check_str and isinstance(last_check_str, str):
-                        last_check_time = datetime.fromisoformat(last_check_str)
-                        if datetime.now() - last_check_time < cache_delta:
-                            cached_ips.append(details)
-                        else:
-                            ips_to_query_api.append({'ip': ip, 'details': details})
-                    else:
-                        ips_to_query_api.append({'ip': ip, 'details': details})
-                else:
-                    ips_to_query_api.append({'ip': ip, 'details': None})
-            
-            if self.cancel_requested.is_set(): raise InterruptedError("Cancelled during pre-check")
-
-            processed_count = 0
-            if cached_ips:
-                safe_update_log(f"Found {len(cached_ips)} fresh IPs in cache.")
-                for ip_details in cached_ips:
-                    if self.cancel_requested.is_set(): break
-                    ip_id = ip_details['id']
-                    ip_address = ip_details['ip_address']
-                    database.link_ip_to_batch(ip_id, batch_id)
-                    processed_count += 1
-                    safe_update_log(f"({processed_count}/{total_ips}) Processing IP: {ip_address}... -> [CACHED]")
-                    progress = processed_count / total_ips
-                    if not self.is_closing: self.after(0, lambda p=progress: self.progress_bar.set(p))
-            
-            if self.cancel_requested.is_set(): raise InterruptedError("Cancelled after cache processing")
-
-            if ips_to_query_api:
-                safe_update_log(f"Querying APIs for {len(ips_to_query_api)} new/stale IPs...")
-                
-                def progress_callback(ip_info):
-                    nonlocal processed_count
-                    processed_count += 1
-                    safe_update_log(f"({processed_count}/{total_ips}) Processing IP: {ip_info['ip']}...")
-                    if 'result' in ip_info:
-                        res = ip_info['result']
-                        safe_update_log(f" -> IPQS: Score={res['score']}, Country={res['country']}")
-                        if self.api_key_otx: safe_update_log(f" -> OTX: Pulses={res['pulses']}")
-                    else:
-                        error_message = ip_info.get('error', 'Unknown')
-                        safe_update_log(f" -> [API ERROR] Could not get IPQS data: {error_message}")
-                        if not self.is_closing:
-                            self.after(0, self.ipqs_status_value.configure, {'text': f"API Error: {error_message}", 'text_color': "red"})
-
-                    progress = processed_count / total_ips
-                    if not self.is_closing: self.after(0, lambda p=progress: self.progress_bar.set(p))
-
-                results = asyncio.run(api.run_concurrent_analysis(ips_to_query_api, self.api_key_otx, progress_callback, self.cancel_requested))
-                
-                safe_update_log("Saving analysis results to database...")
-                for res in results:
-                    if self.cancel_requested.is_set(): break
-                    if res and 'ip_id' in res:
-                        database.link_ip_to_batch(res['ip_id'], batch_id)
-            
-            if self.cancel_requested.is_set():
-                raise InterruptedError("Analysis cancelled by user.")
-            else:
-                safe_update_log("--- Analysis Complete! ---")
-                if not self.is_closing: self.after(0, lambda: self.progress_bar.set(1.0))
-
-        except InterruptedError as e:
-            safe_update_log(f"--- {e} ---")
-        except Exception:
-            if not self.is_closing:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                handle_exception(exc_type, exc_value, exc_traceback)
-        finally:
-            if not self.is_closing:
-                self.after(100, self.analysis_finished)
-    
-    def analysis_finished(self):
-        """Called after analysis is done to reset the button and refresh dashboard."""
-        self.start_analysis_button.configure(state="normal", text="Start Analysis", command=self.start_analysis_thread, fg_color=("#3B8ED0", "#1F6AA5"), hover_color=("#36719F", "#144870"))
-        self.update_dashboard()
-        self.update_api_stats_thread() # Refresh credits after analysis
+            service.start()
+        except OSError as e:
+            messagebox.showerror("Lookup Service", f"Could not listen on {service.host}:{service.port}:\n{e}")
+            return
+        self.lookup_service = service
+        self.update_log(f"[SERVICE] Serving lookups on http://{service.host}:{service.port}/lookup/<ip>")
+        self.service_button.configure(text="Stop Lookup Service", fg_color="#E74C3C", hover_color="#C0392B")
+
+    def add_job_row(self, job):
+        row_key = job.group or job.id
+        row = ctk.CTkFrame(self.jobs_frame, fg_color="transparent")
+        row.grid(row=len(self.job_rows), column=0, sticky="ew")
+        row.grid_columnconfigure(0, weight=1)
+        name_label = ctk.CTkLabel(row, text=f"{job.name} (watching)" if job.group else f"#{job.id} {job.name}", anchor="w")
+        name_label.grid(row=0, column=0, padx=5, sticky="ew")
+        status_label = ctk.CTkLabel(row, text=job.status, width=150, anchor="w")
+        status_label.grid(row=0, column=1, padx=5)
+        progress = ctk.CTkProgressBar(row, width=160)
+        progress.set(0)
+        progress.grid(row=0, column=2, padx=5)
+        cancel_button = ctk.CTkButton(row, text="✕", width=30, fg_color="#E74C3C", hover_color="#C0392B", command=job.cancel)
+        cancel_button.grid(row=0, column=3, padx=5)
+        self.job_rows[row_key] = {'job': job, 'status': status_label, 'progress': progress, 'cancel': cancel_button, 'finished': False}
+
+    def on_job_update(self, job, message):
+        """ Called from the queue's threads; hands the update to the GUI thread. """
+        if not self.is_closing:
+            self.after(0, self._apply_job_update, job, message)
+
+    def _apply_job_update(self, job, message):
+        if self.is_closing: return
+        if message:
+            self.update_log(f"[#{job.id}] {message}" if len(self.progress_jobs) > 1 or job.group else message)
+        row = self.job_rows.get(job.group or job.id)
+        if row is None:
+            self.add_job_row(job)
+            row = self.job_rows[job.group or job.id]
+        elif row['job'] is not job:
+            # A newer micro-batch of a watched file takes over its row
+            if job.id < row['job'].id: return
+            row.update(job=job, finished=False)
+            row['cancel'].configure(state="normal", command=job.cancel)
+        if job.last_api_error:
+            self.ipqs_status_value.configure(text=f"API Error: {job.last_api_error}", text_color="red")
+        detail = f" ({job.processed}/{job.total})" if job.status == job_queue.RUNNING and job.total else ""
+        row['status'].configure(text=f"{job.status}{detail}")
+        row['progress'].set(job.progress)
+        if self.progress_jobs:
+            self.progress_bar.set(sum(j.progress for j in self.progress_jobs) / len(self.progress_jobs))
+
+        if not job.is_active() and not row['finished']:
+            row['finished'] = True
+            row['cancel'].configure(state="disabled")
+            self.analysis_finished(job)
+
+    def analysis_finished(self, job):
+        """Called after a job is done to refresh the dashboard (and report crashes)."""
+        if job.status == job_queue.FAILED and job.exc_info:
+            handle_exception(*job.exc_info)
+        if not self.job_queue.is_busy():
+            self.update_dashboard()
+            if not job.last_api_error:  # Otherwise keep the error on show until refreshed by hand
+                self.update_api_stats_thread() # Refresh credits after analysis
 
     def open_settings_window(self):
         if self.settings_win is None or not self.settings_win.winfo_exists():
@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta
+
+import database
+
+PROVIDER_IPQS = "ipqs"
+PROVIDER_OTX = "otx"
+PROVIDER_FEED = "feed"  # Imported reputation feeds (see feeds.py); stand in for IPQS while fresh
+HIGH_SCORE = 75  # Planner only: scores worth re-checking first (reports use pdf_generator.high_risk_threshold())
+
+def _read_cap(name):
+    """ Reads a whole-number credit cap from .env; empty or invalid means unlimited (None). """
+    value = os.getenv(name, "").strip()
+    return int(value) if value.isdigit() else None
+
+def get_caps():
+    """ Returns (per-batch cap, per-day cap) for IPQS lookups. """
+    return _read_cap("IPQS_CREDIT_CAP_BATCH"), _read_cap("IPQS_CREDIT_CAP_DAY")
+
+def get_provider_ttls(default_hours):
+    """
+    Returns {provider: timedelta}. IPQS follows CACHE_DURATION_HOURS (`default_hours`);
+    OTX pulse counts and feed entries may be given their own OTX_CACHE_HOURS / FEED_CACHE_HOURS.
+    """
+    otx_hours = os.getenv("OTX_CACHE_HOURS", "").strip()
+    feed_hours = os.getenv("FEED_CACHE_HOURS", "").strip()
+    return {
+        PROVIDER_IPQS: timedelta(hours=default_hours),
+        PROVIDER_OTX: timedelta(hours=int(otx_hours) if otx_hours.isdigit() else default_hours),
+        PROVIDER_FEED: timedelta(hours=int(feed_hours) if feed_hours.isdigit() else default_hours),
+    }
+
+def _is_fresh(checked_at, ttl, now):
+    try:
+        return now - datetime.fromisoformat(checked_at) < ttl
+    except (TypeError, ValueError):
+        return False
+
+def fresh_reputation_source(details, ttls, now):
+    """ PROVIDER_IPQS if the row's IPQS data is fresh, else PROVIDER_FEED if a feed entry is, else None. """
+    if details and _is_fresh(details['ipqs_checked_at'], ttls[PROVIDER_IPQS], now):
+        return PROVIDER_IPQS
+    if details and PROVIDER_FEED in ttls and _is_fresh(details['feed_checked_at'], ttls[PROVIDER_FEED], now):
+        return PROVIDER_FEED
+    return None
+
+def stale_providers(details, ttls, now=None, otx_enabled=True):
+    """
+    Returns the set of providers whose data for this IP (a row or None) needs refreshing.
+    A fresh feed entry covers IPQS, so feed-listed IPs cost no credit.
+    """
+    now = now or datetime.now()
+    stale = set()
+    if fresh_reputation_source(details, ttls, now) is None:
+        stale.add(PROVIDER_IPQS)
+    if otx_enabled and (not details or not _is_fresh(details['otx_checked_at'], ttls[PROVIDER_OTX], now)):
+        stale.add(PROVIDER_OTX)
+    return stale
+
+def _staleness_days(details, now):
+    try:
+        return (now - datetime.fromisoformat(details['ipqs_checked_at'])).days
+    except (TypeError, ValueError):
+        return None
+
+def rank_key(ip_info, batch_counts, now):
+    """
+    Sort key for a pending IPQS lookup, most valuable first:
+    never seen (no successful IPQS check yet), then stalest by whole days, then IPs that
+    scored high before or keep recurring across batches, then higher prior scores.
+    Within each tier, IPs that occur more often in the source come first.
+    """
+    details = ip_info['details']
+    occurrences = ip_info.get('occurrences', 0)
+    stale = _staleness_days(details, now) if details else None
+    if stale is None:
+        return (0, 0, 0, -occurrences, 0, 0)
+    score = details['fraud_score'] or 0
+    batches = batch_counts.get(details['id'], 0)
+    notable = score >= HIGH_SCORE or batches > 1
+    return (1, -stale, 0 if notable else 1, -occurrences, -score, -batches)
+
+class BudgetPlan:
+    """ The outcome of plan_queries(): what to spend credits on and what was left out. """
+    def __init__(self, to_query, skipped, budget, limit_reason):
+        self.to_query = to_query
+        self.skipped = skipped
+        self.budget = budget
+        self.limit_reason = limit_reason
+
+    def is_limited(self):
+        return bool(self.skipped)
+
+def compute_budget(batch_cap=None, day_cap=None, credits_remaining=None, used_today=0):
+    """
+    Returns (budget, reason) where budget is the smallest of the applicable limits,
+    or (None, None) if nothing limits this batch.
+    """
+    limits = []
+    if batch_cap is not None:
+        limits.append((batch_cap, "per-batch cap"))
+    if day_cap is not None:
+        limits.append((max(0, day_cap - used_today), "daily cap"))
+    if credits_remaining is not None:
+        limits.append((max(0, int(credits_remaining)), "IPQS credits remaining"))
+    if not limits:
+        return None, None
+    return min(limits, key=lambda limit: limit[0])
+
+def plan_queries(pending, credits_remaining=None, now=None, reserved=0):
+    """
+    Ranks pending lookups ([{'ip': ..., 'details': row or None, 'occurrences': n}, ...]) by value and cuts the
+    list at the configured credit budget. Each IP costs one IPQS credit. `reserved` credits
+    are already promised to concurrently running jobs and count as spent.
+    """
+    now = now or datetime.now()
+    batch_cap, day_cap = get_caps()
+    used_today = (database.get_api_usage(PROVIDER_IPQS) if day_cap is not None else 0) + reserved
+    if credits_remaining is not None:
+        credits_remaining -= reserved
+    budget, reason = compute_budget(batch_cap, day_cap, credits_remaining, used_today)
+
+    seen_ids = [info['details']['id'] for info in pending if info['details']]
+    batch_counts = database.get_batch_counts(seen_ids)
+    ranked = sorted(pending, key=lambda info: rank_key(info, batch_counts, now))
+
+    if budget is None:
+        return BudgetPlan(ranked, [], None, None)
+    return BudgetPlan(ranked[:budget], ranked[budget:], budget, reason)
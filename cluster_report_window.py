@@ -0,0 +1,141 @@
+import customtkinter as ctk
+from tkinter import ttk, messagebox
+from datetime import datetime, timedelta
+
+import database
+import clustering
+import pdf_generator
+
+class ClusterReportWindow(ctk.CTkToplevel):
+    def __init__(self, master):
+        super().__init__(master)
+        self.title("Subnet & ASN Cluster Report")
+        self.geometry("1100x650")
+        self.transient(master)
+        self.grab_set()
+
+        self.order_by = "ip_count"
+        self.descending = True
+        self.page_offset = 0
+        self.total_rows = 0
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(2, weight=1)
+
+        # --- Scope & Grouping ---
+        self.controls_frame = ctk.CTkFrame(self)
+        self.controls_frame.grid(row=0, column=0, padx=10, pady=10, sticky="ew")
+
+        ctk.CTkLabel(self.controls_frame, text="Group by:").pack(side="left", padx=(10, 5), pady=5)
+        self.level_menu = ctk.CTkOptionMenu(self.controls_frame, values=list(clustering.CLUSTER_LEVELS), width=120)
+        self.level_menu.set("/24")
+        self.level_menu.pack(side="left", padx=5, pady=5)
+
+        ctk.CTkLabel(self.controls_frame, text="Batch:").pack(side="left", padx=(15, 5), pady=5)
+        self.batches = database.get_all_batches()
+        self.batch_combobox = ctk.CTkComboBox(self.controls_frame, width=220,
+            values=["All Batches"] + [f"{b['id']}: {b['description'] or b['file_name']}" for b in self.batches])
+        self.batch_combobox.set("All Batches")
+        self.batch_combobox.pack(side="left", padx=5, pady=5)
+
+        ctk.CTkLabel(self.controls_frame, text="Last N days:").pack(side="left", padx=(15, 5), pady=5)
+        self.days_entry = ctk.CTkEntry(self.controls_frame, width=60, placeholder_text="all")
+        self.days_entry.pack(side="left", padx=5, pady=5)
+
+        ctk.CTkLabel(self.controls_frame, text="Min IPs:").pack(side="left", padx=(15, 5), pady=5)
+        self.min_ips_entry = ctk.CTkEntry(self.controls_frame, width=50)
+        self.min_ips_entry.insert(0, "2")
+        self.min_ips_entry.pack(side="left", padx=5, pady=5)
+
+        self.apply_button = ctk.CTkButton(self.controls_frame, text="Apply", width=80, command=self.apply_scope)
+        self.apply_button.pack(side="right", padx=10, pady=5)
+
+        # --- Paging ---
+        self.paging_frame = ctk.CTkFrame(self)
+        self.paging_frame.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="ew")
+
+        self.summary_label = ctk.CTkLabel(self.paging_frame, text="", font=ctk.CTkFont(weight="bold"))
+        self.summary_label.pack(side="left", padx=10, pady=5)
+        self.next_button = ctk.CTkButton(self.paging_frame, text="Next >", width=80, command=self.next_page)
+        self.next_button.pack(side="right", padx=(5, 10), pady=5)
+        self.page_label = ctk.CTkLabel(self.paging_frame, text="")
+        self.page_label.pack(side="right", padx=5, pady=5)
+        self.prev_button = ctk.CTkButton(self.paging_frame, text="< Prev", width=80, command=self.prev_page)
+        self.prev_button.pack(side="right", padx=5, pady=5)
+
+        # --- Treeview for Clusters (click a heading to sort) ---
+        self.columns = clustering.SORTABLE_COLUMNS
+        headings = {
+            "cluster": "Cluster", "ip_count": "IPs", "malicious_count": "Malicious",
+            "max_score": "Max Score", "avg_score": "Mean Score",
+            "recurring_ips": "Recurring IPs", "max_batches": "Max Batches"
+        }
+        self.tree = ttk.Treeview(self, columns=self.columns, show="headings")
+        for col in self.columns:
+            self.tree.heading(col, text=headings[col], command=lambda c=col: self.sort_by_column(c))
+            self.tree.column(col, width=110, anchor="center")
+        self.tree.column("cluster", width=320, anchor="w")
+
+        self.tree.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
+
+        scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscroll=scrollbar.set)
+        scrollbar.grid(row=2, column=1, sticky="ns")
+
+        self.apply_scope()
+
+    def apply_scope(self):
+        """ Reads the scope controls and reloads the first page of clusters. """
+        choice = self.batch_combobox.get()
+        self.batch_ids = [] if choice == "All Batches" else [int(choice.split(":")[0])]
+
+        days = self.days_entry.get().strip()
+        min_ips = self.min_ips_entry.get().strip() or "1"
+        if (days and not days.isdigit()) or not min_ips.isdigit():
+            messagebox.showerror("Invalid Input", "Days and Min IPs must be whole numbers.", parent=self)
+            return
+        self.since = (datetime.now() - timedelta(days=int(days))).isoformat() if days else None
+        self.min_ips = max(1, int(min_ips))
+        self.level = self.level_menu.get()
+
+        self.page_offset = 0
+        self.total_rows = clustering.count_clusters(self.level, self.batch_ids, self.since, min_ips=self.min_ips)
+        self.populate_data()
+
+    def sort_by_column(self, col):
+        if self.order_by == col:
+            self.descending = not self.descending
+        else:
+            self.order_by, self.descending = col, True
+        self.page_offset = 0
+        self.populate_data()
+
+    def next_page(self):
+        if self.page_offset + clustering.PAGE_SIZE < self.total_rows:
+            self.page_offset += clustering.PAGE_SIZE
+            self.populate_data()
+
+    def prev_page(self):
+        if self.page_offset > 0:
+            self.page_offset = max(0, self.page_offset - clustering.PAGE_SIZE)
+            self.populate_data()
+
+    def populate_data(self):
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        self.tree.tag_configure('high_risk', background='#E74C3C', foreground='white')
+        self.tree.tag_configure('medium_risk', background='#F39C12', foreground='black')
+
+        clusters = clustering.get_clusters(self.level, self.batch_ids, self.since, min_ips=self.min_ips,
+                                           order_by=self.order_by, descending=self.descending, offset=self.page_offset)
+        high_risk_score = pdf_generator.high_risk_threshold()
+        for cluster in clusters:
+            tags_to_apply = pdf_generator.risk_tags(cluster['max_score'], high_risk_score)
+            self.tree.insert("", "end", values=tuple(cluster[col] for col in self.columns), tags=tags_to_apply)
+
+        last_row = min(self.page_offset + clustering.PAGE_SIZE, self.total_rows)
+        first_row = self.page_offset + 1 if self.total_rows else 0
+        self.summary_label.configure(text=f"{self.total_rows} clusters by {self.level}")
+        self.page_label.configure(text=f"{first_row}-{last_row} of {self.total_rows}")
+        self.prev_button.configure(state="normal" if self.page_offset > 0 else "disabled")
+        self.next_button.configure(state="normal" if last_row < self.total_rows else "disabled")
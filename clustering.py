@@ -0,0 +1,115 @@
+from sqlite3 import Error
+
+import database
+from ip_filter import int_to_ip
+
+PAGE_SIZE = 500
+
+# --- Cluster levels: SQL grouping expression over ip_records (alias r) ---
+CLUSTER_LEVELS = {
+    "/24": "r.ip_int >> 8",
+    "/16": "r.ip_int >> 16",
+    "ISP": "COALESCE(r.isp, 'N/A')",
+    "Organization": "COALESCE(r.organization, 'N/A')",
+}
+
+SORTABLE_COLUMNS = ("cluster", "ip_count", "malicious_count", "max_score", "avg_score", "recurring_ips", "max_batches")
+
+def format_cluster(level, key):
+    """ Turns the grouping key back into a readable netblock or name. """
+    if level == "/24":
+        return f"{int_to_ip(key << 8)}/24"
+    if level == "/16":
+        return f"{int_to_ip(key << 16)}/16"
+    return key
+
+def _scope_sql(batch_ids=None, since=None, until=None):
+    """
+    Per-IP batch counts for the requested scope: specific batches and/or an import time range.
+    Recurrence is measured inside the same scope.
+    """
+    conditions, params = [], []
+    if batch_ids:
+        conditions.append(f"l.batch_id IN ({','.join('?' for _ in batch_ids)})")
+        params.extend(batch_ids)
+    if since:
+        conditions.append("b.import_timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("b.import_timestamp < ?")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""
+        SELECT l.ip_id, COUNT(*) AS batches
+        FROM batch_ip_link l JOIN import_batches b ON b.id = l.batch_id
+        {where}
+        GROUP BY l.ip_id
+    """
+    return sql, params
+
+def _cluster_query(level, batch_ids, since, until, min_ips):
+    if level not in CLUSTER_LEVELS:
+        raise ValueError(f"Unknown cluster level: {level}")
+    key_sql = CLUSTER_LEVELS[level]
+    scope_sql, params = _scope_sql(batch_ids, since, until)
+    ip_filter = "WHERE r.ip_int IS NOT NULL" if level in ("/24", "/16") else ""
+    sql = f"""
+        WITH scoped AS ({scope_sql})
+        SELECT {key_sql} AS cluster,
+               COUNT(*) AS ip_count,
+               COALESCE(SUM(r.is_malicious = 1), 0) AS malicious_count,
+               COALESCE(MAX(r.fraud_score), 0) AS max_score,
+               ROUND(COALESCE(AVG(r.fraud_score), 0), 1) AS avg_score,
+               SUM(s.batches > 1) AS recurring_ips,
+               MAX(s.batches) AS max_batches
+        FROM scoped s JOIN ip_records r ON r.id = s.ip_id
+        {ip_filter}
+        GROUP BY cluster
+        HAVING COUNT(*) >= ?
+    """
+    return sql, params + [min_ips]
+
+def count_clusters(level, batch_ids=None, since=None, until=None, min_ips=1):
+    conn = database.create_connection()
+    if conn is None: return 0
+    try:
+        sql, params = _cluster_query(level, batch_ids, since, until, min_ips)
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) AS count FROM ({sql})", params)
+        return cursor.fetchone()['count']
+    except Error as e:
+        print(f"Error counting clusters: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def get_clusters(level, batch_ids=None, since=None, until=None, min_ips=1,
+                 order_by="ip_count", descending=True, offset=0, limit=PAGE_SIZE):
+    """
+    Groups the scoped IPs by /24, /16, ISP or organization with one aggregate query and
+    returns one page of clusters as dicts, with `cluster` already formatted for display.
+    """
+    if order_by not in SORTABLE_COLUMNS:
+        raise ValueError(f"Cannot sort clusters by {order_by}")
+    conn = database.create_connection()
+    if conn is None: return []
+    try:
+        sql, params = _cluster_query(level, batch_ids, since, until, min_ips)
+        direction = "DESC" if descending else "ASC"
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            {sql}
+            ORDER BY {order_by} {direction}, max_score DESC
+            LIMIT ? OFFSET ?
+        """, params + [limit, offset])
+        clusters = []
+        for row in cursor.fetchall():
+            cluster = dict(row)
+            cluster['cluster'] = format_cluster(level, row['cluster'])
+            clusters.append(cluster)
+        return clusters
+    except Error as e:
+        print(f"Error getting clusters: {e}")
+        return []
+    finally:
+        conn.close()
@@ -0,0 +1,116 @@
+import database
+
+# --- Each selected batch gets one bit of a signed 64-bit SQLite integer. ---
+MAX_COMPARE_BATCHES = 62
+PAGE_SIZE = 500
+
+# --- Filter modes understood by ComparisonEngine ---
+MODE_UNION = "union"
+MODE_INTERSECTION = "intersection"
+MODE_ONLY_IN = "only_in"
+MODE_AT_LEAST = "at_least"
+
+class ComparisonEngine:
+    """
+    Aggregates several batches once with a single GROUP BY over batch_ip_link and keeps the
+    per-IP result (batch count + membership bitmap) in a temp table, so every filter and page
+    afterwards is a cheap indexed query instead of a re-fetch of full batches.
+    """
+    def __init__(self, batch_ids):
+        if len(batch_ids) > MAX_COMPARE_BATCHES:
+            raise ValueError(f"At most {MAX_COMPARE_BATCHES} batches can be compared at once.")
+        self.batch_ids = list(batch_ids)
+        self.full_mask = (1 << len(self.batch_ids)) - 1
+        self.conn = database.create_connection()
+        if self.conn is None:
+            raise RuntimeError("Could not open the database.")
+        self._build()
+
+    def _build(self):
+        cursor = self.conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS temp.compare_selection")
+        cursor.execute("DROP TABLE IF EXISTS temp.compare_result")
+        cursor.execute("CREATE TEMP TABLE compare_selection (batch_id INTEGER PRIMARY KEY, bit INTEGER NOT NULL)")
+        cursor.executemany("INSERT INTO compare_selection (batch_id, bit) VALUES (?, ?)",
+                           [(batch_id, 1 << index) for index, batch_id in enumerate(self.batch_ids)])
+        cursor.execute("""
+            CREATE TEMP TABLE compare_result AS
+            SELECT g.ip_id, g.batch_count, g.mask,
+                   r.ip_address, r.country, r.isp,
+                   COALESCE(r.fraud_score, 0) AS max_score,
+                   MAX(COALESCE(r.otx_pulses, 0), 0) AS max_otx
+            FROM (
+                SELECT l.ip_id, COUNT(*) AS batch_count, SUM(s.bit) AS mask
+                FROM batch_ip_link l
+                JOIN compare_selection s ON s.batch_id = l.batch_id
+                GROUP BY l.ip_id
+            ) g
+            JOIN ip_records r ON r.id = g.ip_id
+        """)
+        cursor.execute("CREATE INDEX temp.idx_compare_rank ON compare_result (batch_count DESC, max_score DESC)")
+        cursor.execute("CREATE INDEX temp.idx_compare_mask ON compare_result (mask)")
+        self.conn.commit()
+
+    def _where(self, mode, arg=None):
+        """ Translates a filter mode into a WHERE clause over compare_result. """
+        if mode == MODE_INTERSECTION:
+            return "WHERE mask = ?", [self.full_mask]
+        if mode == MODE_ONLY_IN:
+            return "WHERE mask = ?", [1 << self.batch_ids.index(arg)]
+        if mode == MODE_AT_LEAST:
+            return "WHERE batch_count >= ?", [int(arg)]
+        return "", []
+
+    def count(self, mode=MODE_UNION, arg=None):
+        where, params = self._where(mode, arg)
+        cursor = self.conn.execute(f"SELECT COUNT(*) AS count FROM compare_result {where}", params)
+        return cursor.fetchone()['count']
+
+    def fetch_page(self, mode=MODE_UNION, arg=None, offset=0, limit=PAGE_SIZE):
+        """ Returns one page of rows (Records) ranked by recurrence, then by fraud score. """
+        where, params = self._where(mode, arg)
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"""
+            SELECT ip_address, batch_count, mask, country, isp, max_score, max_otx
+            FROM compare_result {where}
+            ORDER BY batch_count DESC, max_score DESC
+            LIMIT ? OFFSET ?
+        """, params + [limit, offset])
+        return [row for chunk in database.fetch_records(cursor, limit) for row in chunk]
+
+    def iter_rows(self, mode=MODE_UNION, arg=None, chunk_size=PAGE_SIZE):
+        """ Streams (ip_address, country, isp, max_score, max_otx) tuples in ranked order. """
+        where, params = self._where(mode, arg)
+        cursor = self.conn.cursor()
+        cursor.row_factory = None  # Plain tuples, straight from fetchmany()
+        cursor.execute(f"""
+            SELECT ip_address, country, isp, max_score, max_otx
+            FROM compare_result {where}
+            ORDER BY batch_count DESC, max_score DESC
+        """, params)
+        cursor.arraysize = chunk_size
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            yield from rows
+
+    def country_counts(self, mode=MODE_UNION, arg=None):
+        where, params = self._where(mode, arg)
+        country_filter = "country IS NOT NULL AND country != 'N/A'"
+        where = f"{where} AND {country_filter}" if where else f"WHERE {country_filter}"
+        cursor = self.conn.execute(f"""
+            SELECT country, COUNT(*) AS count FROM compare_result {where}
+            GROUP BY country ORDER BY count DESC
+        """, params)
+        return {row['country']: row['count'] for row in cursor.fetchall()}
+
+    def batches_in_mask(self, mask):
+        """ Decodes a membership bitmap back into the batch IDs it covers. """
+        return [batch_id for index, batch_id in enumerate(self.batch_ids) if mask & (1 << index)]
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
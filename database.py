@@ -1,10 +1,49 @@
 import sqlite3
 from sqlite3 import Error
 import os
-from datetime import datetime
+import json
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from ip_filter import ip_to_int
 
 DB_FILE = "ip_prism.db"
 
+# --- Columns of ip_records that may be projected by the streaming queries ---
+IP_RECORD_COLUMNS = ("id", "ip_address", "country", "is_malicious", "fraud_score", "isp", "organization", "otx_pulses", "tags", "notes", "last_api_check")
+# Per-batch volume from batch_ip_link, aggregated over the selected batches
+LINK_VOLUME_COLUMNS = ("occurrences", "first_line", "last_line")
+IP_QUERY_COLUMNS = IP_RECORD_COLUMNS + LINK_VOLUME_COLUMNS
+# What the recurrence report shows
+RECURRENCE_COLUMNS = ("id", "ip_address", "country", "fraud_score", "isp", "organization", "otx_pulses", "tags")
+
+# Text columns the History search looks in
+SEARCH_COLUMNS = ("ip_address", "country", "isp", "organization", "tags", "notes")
+
+ARRAYSIZE = 1000  # Rows per fetchmany() round trip in the streaming queries
+PAGE_SIZE = 500   # Rows per page of the History view
+
+# --- IPQS response fields promoted to ip_records columns (column: payload key), re-derivable from raw_payloads ---
+PROMOTED_IPQS_FIELDS = {
+    "is_proxy": "proxy",
+    "is_vpn": "vpn",
+    "is_tor": "tor",
+    "is_bot": "bot_status",
+    "recent_abuse": "recent_abuse",
+    "abuse_velocity": "abuse_velocity",
+    "connection_type": "connection_type",
+}
+PROMOTED_COLUMN_TYPES = {"abuse_velocity": "TEXT", "connection_type": "TEXT"}  # The rest are BOOLEAN
+
+def _ip_int(ip_address):
+    """ Integer form stored in ip_records.ip_int for subnet arithmetic (None if not IPv4). """
+    try:
+        return ip_to_int(ip_address)
+    except (ValueError, AttributeError):
+        return None
+
 def create_connection():
     conn = None
     try:
@@ -16,6 +55,64 @@ def create_connection():
         print(f"Database connection error: {e}")
     return conn
 
+# --- Streaming query API: projected columns, fetchmany chunks, lightweight records ---
+@lru_cache(maxsize=None)
+def record_type(columns):
+    """
+    A tuple subclass (no per-row dict) for one projection. Records unpack like tuples and,
+    like sqlite3.Row, also allow row['column'], row.column, keys() and dict(row).
+    """
+    base = namedtuple("Record", columns, rename=True)
+
+    class Record(base):
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                if key not in columns:
+                    raise IndexError(f"No item with that key: {key}")
+                return tuple.__getitem__(self, columns.index(key))
+            return tuple.__getitem__(self, key)
+
+        def keys(self):
+            return columns
+
+    return Record
+
+def fetch_records(cursor, chunk_size=ARRAYSIZE):
+    """ Drains an executed cursor `chunk_size` rows at a time, yielding lists of Records. """
+    cursor.arraysize = chunk_size
+    make = record_type(tuple(col[0] for col in cursor.description))._make
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        yield [make(row) for row in rows]
+
+def iter_query(sql, params=(), chunk_size=ARRAYSIZE):
+    """
+    Streams a read-only query as lists of Records, `chunk_size` rows at a time, so callers never
+    hold the whole result set. The connection lives on the consuming thread until the generator
+    is exhausted or closed.
+    """
+    conn = create_connection()
+    if conn is None: return
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Records are built from plain tuples
+        cursor.execute(sql, params)
+        yield from fetch_records(cursor, chunk_size)
+    finally:
+        conn.close()
+
+def _query_list(sql, params=(), error_label="running query"):
+    """ All rows of a small query as Records; errors are printed and give an empty list. """
+    try:
+        return [row for chunk in iter_query(sql, params) for row in chunk]
+    except Error as e:
+        print(f"Error {error_label}: {e}")
+        return []
+
 def setup_database():
     """ สร้างและอัปเดตตารางที่จำเป็น (Database Migration) """
     conn = create_connection()
@@ -30,7 +127,8 @@ def setup_database():
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 import_timestamp TEXT NOT NULL,
                 file_name TEXT NOT NULL,
-                description TEXT
+                description TEXT,
+                run_summary TEXT
             );
         """)
         cursor.execute("""
@@ -52,12 +150,76 @@ def setup_database():
             CREATE TABLE IF NOT EXISTS batch_ip_link (
                 batch_id INTEGER,
                 ip_id INTEGER,
+                occurrences INTEGER,
+                first_line INTEGER,
+                last_line INTEGER,
                 PRIMARY KEY (batch_id, ip_id),
                 FOREIGN KEY (batch_id) REFERENCES import_batches (id) ON DELETE CASCADE,
                 FOREIGN KEY (ip_id) REFERENCES ip_records (id)
             );
         """)
 
+        # --- Index of generated report artifacts (see report_cache.py) ---
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS report_cache (
+                cache_key TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                last_used TEXT NOT NULL
+            );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS report_cache_batches (
+                cache_key TEXT NOT NULL,
+                batch_id INTEGER NOT NULL,
+                PRIMARY KEY (cache_key, batch_id),
+                FOREIGN KEY (cache_key) REFERENCES report_cache (cache_key) ON DELETE CASCADE
+            );
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_cache_batches_batch ON report_cache_batches (batch_id)")
+
+        # --- Credit accounting for the query budget planner (see budget.py) ---
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS api_usage (
+                day TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, provider)
+            );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS batch_skipped_ips (
+                batch_id INTEGER NOT NULL,
+                ip_address TEXT NOT NULL,
+                reason TEXT,
+                PRIMARY KEY (batch_id, ip_address),
+                FOREIGN KEY (batch_id) REFERENCES import_batches (id) ON DELETE CASCADE
+            );
+        """)
+
+        # --- Latest raw provider response per IP, zlib-compressed JSON (see rederive.py) ---
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS raw_payloads (
+                ip_id INTEGER NOT NULL,
+                provider TEXT NOT NULL,
+                fetched_at TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (ip_id, provider),
+                FOREIGN KEY (ip_id) REFERENCES ip_records (id)
+            );
+        """)
+
+        # --- Tail/watch mode: how far each watched log file has been analyzed ---
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS watch_offsets (
+                path TEXT PRIMARY KEY,
+                file_id TEXT,
+                offset INTEGER NOT NULL DEFAULT 0,
+                line_no INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            );
+        """)
+
         # --- Now, perform migrations on the existing tables ---
         cursor.execute("PRAGMA table_info(ip_records)")
         columns = [col['name'] for col in cursor.fetchall()]
@@ -70,6 +232,53 @@ def setup_database():
         if 'notes' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN notes TEXT")
         if 'otx_pulses' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN otx_pulses INTEGER")
         if 'last_api_check' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN last_api_check TEXT")
+        if 'updated_at' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN updated_at TEXT")
+        if 'ip_int' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN ip_int INTEGER")
+        # Per-provider freshness: IPQS and OTX data can be refreshed independently
+        added_provider_columns = 'ipqs_checked_at' not in columns
+        if 'ipqs_checked_at' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN ipqs_checked_at TEXT")
+        if 'otx_checked_at' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN otx_checked_at TEXT")
+        if added_provider_columns:
+            # Before the split, a successful check refreshed both providers at last_api_check (-1 pulses = OTX failed)
+            cursor.execute("UPDATE ip_records SET ipqs_checked_at = last_api_check WHERE last_api_check IS NOT NULL")
+            cursor.execute("UPDATE ip_records SET otx_checked_at = last_api_check WHERE last_api_check IS NOT NULL AND otx_pulses >= 0")
+        # Negative cache: the last failed lookup and how many failed in a row (reset on success)
+        if 'last_error_class' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN last_error_class TEXT")
+        if 'last_error_at' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN last_error_at TEXT")
+        if 'error_count' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN error_count INTEGER NOT NULL DEFAULT 0")
+        # Provenance of data imported from external reputation feeds (see feeds.py)
+        if 'feed_source' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN feed_source TEXT")
+        if 'feed_checked_at' not in columns: cursor.execute("ALTER TABLE ip_records ADD COLUMN feed_checked_at TEXT")
+        # Promoted IPQS fields; rows stored before a column existed get it from rederive_ip_records()
+        for column in PROMOTED_IPQS_FIELDS:
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE ip_records ADD COLUMN {column} {PROMOTED_COLUMN_TYPES.get(column, 'BOOLEAN')}")
+
+        # Metrics summary of the batch's latest analysis run (see metrics.py)
+        cursor.execute("PRAGMA table_info(import_batches)")
+        if 'run_summary' not in [col['name'] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE import_batches ADD COLUMN run_summary TEXT")
+        # Per-batch volume: how often an IP appeared in the batch's source and where (see ingest.py)
+        cursor.execute("PRAGMA table_info(batch_ip_link)")
+        link_columns = [col['name'] for col in cursor.fetchall()]
+        if 'occurrences' not in link_columns: cursor.execute("ALTER TABLE batch_ip_link ADD COLUMN occurrences INTEGER")
+        if 'first_line' not in link_columns: cursor.execute("ALTER TABLE batch_ip_link ADD COLUMN first_line INTEGER")
+        if 'last_line' not in link_columns: cursor.execute("ALTER TABLE batch_ip_link ADD COLUMN last_line INTEGER")
+        cursor.execute("PRAGMA table_info(watch_offsets)")
+        if 'line_no' not in [col['name'] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE watch_offsets ADD COLUMN line_no INTEGER NOT NULL DEFAULT 0")
+
+        # --- Backfill integer addresses for rows written before ip_int existed ---
+        cursor.execute("SELECT id, ip_address FROM ip_records WHERE ip_int IS NULL")
+        backfill = [(_ip_int(row['ip_address']), row['id']) for row in cursor.fetchall()]
+        cursor.executemany("UPDATE ip_records SET ip_int = ? WHERE id = ?", [row for row in backfill if row[0] is not None])
+
+        # --- Indexes ---
+        # batch_ip_link's primary key is (batch_id, ip_id); lookups by IP across batches need the reverse order.
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_batch_ip_link_ip ON batch_ip_link (ip_id, batch_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_import_batches_timestamp ON import_batches (import_timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ip_records_ip_int ON ip_records (ip_int)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ip_records_ipqs_checked_at ON ip_records (ipqs_checked_at)")
 
         conn.commit()
     except Error as e:
@@ -144,67 +353,208 @@ def find_ip_details(ip_address):
         if conn:
             conn.close()
 
-def find_ip_details_bulk(ip_addresses):
+def find_ip_details_bulk(ip_addresses, columns=None):
+    """
+    Returns the rows (as Records) of the given addresses, all columns unless `columns` is given.
+    The addresses travel as one JSON parameter, so there is no limit on how many are asked for.
+    """
     if not ip_addresses:
         return []
+    select_list = ", ".join(columns) if columns else "*"
+    return _query_list(
+        f"SELECT {select_list} FROM ip_records WHERE ip_address IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(ip_addresses)),), "finding IP details in bulk"
+    )
+
+def encode_payload(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode("utf-8"))
+
+def decode_payload(blob):
+    return json.loads(zlib.decompress(blob))
+
+def _promoted_values(data):
+    return tuple(data.get(key) for key in PROMOTED_IPQS_FIELDS.values())
+
+def _store_ipqs_payload(cursor, ip_id, data, fetched_at):
+    """ Keeps the raw IPQS response (latest only) and fills the promoted columns from it. """
+    cursor.execute("""
+        INSERT INTO raw_payloads (ip_id, provider, fetched_at, payload) VALUES (?, 'ipqs', ?, ?)
+        ON CONFLICT(ip_id, provider) DO UPDATE SET fetched_at = excluded.fetched_at, payload = excluded.payload
+    """, (ip_id, fetched_at, encode_payload(data)))
+    assignments = ", ".join(f"{column} = ?" for column in PROMOTED_IPQS_FIELDS)
+    cursor.execute(f"UPDATE ip_records SET {assignments} WHERE id = ?", (*_promoted_values(data), ip_id))
+
+def add_ip_record(ip, country, malicious, score, isp, org, pulses, payload=None):
+    """
+    Stores a fresh IPQS result for an IP that had no row when its lookup started. If another
+    writer created the row in the meantime, the result is applied to that row instead (same
+    rules as update_ip_record_details), so it is never dropped. Returns the IP's ID.
+    `payload` is the raw IPQS response, kept compressed in raw_payloads.
+    """
     conn = create_connection()
-    if conn is None: return []
+    if conn is None: return None
     try:
         cursor = conn.cursor()
-        placeholders = ',' . join('?' for _ in ip_addresses)
-        query = f"SELECT * FROM ip_records WHERE ip_address IN ({placeholders})"
-        cursor.execute(query, ip_addresses)
-        return cursor.fetchall()
+        current_time = datetime.now().isoformat()
+        otx_checked_at = current_time if pulses is not None and pulses >= 0 else None
+        cursor.execute("""
+            INSERT INTO ip_records (ip_address, ip_int, country, is_malicious, fraud_score, isp, organization, otx_pulses,
+                                    last_api_check, ipqs_checked_at, otx_checked_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ip_address) DO UPDATE SET
+                country = excluded.country, is_malicious = excluded.is_malicious, fraud_score = excluded.fraud_score,
+                isp = excluded.isp, organization = excluded.organization,
+                otx_pulses = CASE WHEN excluded.otx_checked_at IS NOT NULL OR (excluded.otx_pulses IS NOT NULL AND otx_pulses IS NULL)
+                                  THEN excluded.otx_pulses ELSE otx_pulses END,
+                otx_checked_at = COALESCE(excluded.otx_checked_at, otx_checked_at),
+                last_api_check = excluded.last_api_check, ipqs_checked_at = excluded.ipqs_checked_at, updated_at = excluded.updated_at,
+                last_error_class = NULL, last_error_at = NULL, error_count = 0
+        """, (ip, _ip_int(ip), country, malicious, score, isp, org, pulses, current_time, current_time, otx_checked_at, current_time))
+        cursor.execute("SELECT id FROM ip_records WHERE ip_address = ?", (ip,))
+        ip_id = cursor.fetchone()['id']
+        if payload is not None:
+            _store_ipqs_payload(cursor, ip_id, payload, current_time)
+        conn.commit()
+        return ip_id
     except Error as e:
-        print(f"Error finding IP details in bulk: {e}")
-        return []
+        print(f"Error adding IP record for {ip}: {e}")
+        return None
     finally:
         if conn:
             conn.close()
 
-def add_ip_record(ip, country, malicious, score, isp, org, pulses):
+def bulk_enrich_ip_records(rows):
+    """
+    Upserts offline geo/ASN context, given as (ip, country, isp, organization) tuples, in one transaction.
+    New IPs get a row without `last_api_check` (so they still count as never queried), and
+    existing rows only have fields filled in that are still empty; API data is never overwritten.
+    """
+    if not rows: return
     conn = create_connection()
-    if conn is None: return None
+    if conn is None: return
+    try:
+        current_time = datetime.now().isoformat()
+        with conn:
+            conn.executemany("""
+                INSERT INTO ip_records (ip_address, ip_int, country, isp, organization, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(ip_address) DO UPDATE SET
+                    country = CASE WHEN country IS NULL OR country = 'N/A' THEN COALESCE(excluded.country, country) ELSE country END,
+                    isp = CASE WHEN isp IS NULL OR isp = 'N/A' THEN COALESCE(excluded.isp, isp) ELSE isp END,
+                    organization = CASE WHEN organization IS NULL OR organization = 'N/A' THEN COALESCE(excluded.organization, organization) ELSE organization END,
+                    updated_at = excluded.updated_at
+                WHERE ((country IS NULL OR country = 'N/A') AND excluded.country IS NOT NULL)
+                   OR ((isp IS NULL OR isp = 'N/A') AND excluded.isp IS NOT NULL)
+                   OR ((organization IS NULL OR organization = 'N/A') AND excluded.organization IS NOT NULL)
+            """, [(ip, _ip_int(ip), country, isp, org, current_time) for ip, country, isp, org in rows])
+    except Error as e:
+        print(f"Error enriching IP records in bulk: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def upsert_feed_records(source, rows):
+    """
+    Upserts entries of an external reputation feed, given as (ip, country, is_malicious,
+    fraud_score, isp, organization, checked_at) tuples, in one transaction, tagged with `source`.
+    An entry only replaces data that is older than its `checked_at` (IPQS results or an earlier
+    feed entry); fields the feed leaves empty (None) keep their current value. Returns success.
+    """
+    if not rows: return True
+    conn = create_connection()
+    if conn is None: return False
+    try:
+        current_time = datetime.now().isoformat()
+        with conn:
+            conn.executemany("""
+                INSERT INTO ip_records (ip_address, ip_int, country, is_malicious, fraud_score, isp, organization,
+                                        feed_source, feed_checked_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(ip_address) DO UPDATE SET
+                    country = COALESCE(excluded.country, country),
+                    is_malicious = COALESCE(excluded.is_malicious, is_malicious),
+                    fraud_score = COALESCE(excluded.fraud_score, fraud_score),
+                    isp = COALESCE(excluded.isp, isp),
+                    organization = COALESCE(excluded.organization, organization),
+                    feed_source = excluded.feed_source, feed_checked_at = excluded.feed_checked_at, updated_at = excluded.updated_at
+                WHERE (ipqs_checked_at IS NULL OR ipqs_checked_at < excluded.feed_checked_at)
+                  AND (feed_checked_at IS NULL OR feed_checked_at <= excluded.feed_checked_at)
+            """, [(ip, _ip_int(ip), country, malicious, score, isp, org, source, checked_at, current_time)
+                  for ip, country, malicious, score, isp, org, checked_at in rows])
+        return True
+    except Error as e:
+        print(f"Error importing feed records from {source}: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def update_ip_record_details(ip_id, country, malicious, score, isp, org, pulses=None, payload=None):
+    """
+    Stores a fresh IPQS result. OTX fields are only touched when `pulses` is given; a failed
+    OTX lookup (-1) keeps an earlier good count and leaves `otx_checked_at` stale so it is retried.
+    `payload` is the raw IPQS response, kept compressed in raw_payloads.
+    """
+    conn = create_connection()
+    if conn is None: return
     try:
         cursor = conn.cursor()
         current_time = datetime.now().isoformat()
+        otx_ok = pulses is not None and pulses >= 0
         cursor.execute("""
-            INSERT INTO ip_records (ip_address, country, is_malicious, fraud_score, isp, organization, otx_pulses, last_api_check)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (ip, country, malicious, score, isp, org, pulses, current_time))
+            UPDATE ip_records 
+            SET country = ?, is_malicious = ?, fraud_score = ?, isp = ?, organization = ?,
+                otx_pulses = CASE WHEN ? OR (? IS NOT NULL AND otx_pulses IS NULL) THEN ? ELSE otx_pulses END,
+                otx_checked_at = CASE WHEN ? THEN ? ELSE otx_checked_at END,
+                last_api_check = ?, ipqs_checked_at = ?, updated_at = ?,
+                last_error_class = NULL, last_error_at = NULL, error_count = 0
+            WHERE id = ?
+        """, (country, malicious, score, isp, org, otx_ok, pulses, pulses, otx_ok, current_time,
+              current_time, current_time, current_time, ip_id))
+        if payload is not None:
+            _store_ipqs_payload(cursor, ip_id, payload, current_time)
         conn.commit()
-        return cursor.lastrowid
     except Error as e:
-        if "UNIQUE constraint failed" not in str(e): print(f"Error adding IP record for {ip}: {e}")
-        return None
+        print(f"Error updating IP record for ip_id {ip_id}: {e}")
     finally:
         if conn:
             conn.close()
 
-def update_ip_record_details(ip_id, country, malicious, score, isp, org, pulses):
+def update_otx_pulses(ip_id, pulses):
+    """ Stores an OTX-only refresh; a failed lookup (-1) leaves the record untouched. """
+    if pulses is None or pulses < 0: return
     conn = create_connection()
     if conn is None: return
     try:
         cursor = conn.cursor()
         current_time = datetime.now().isoformat()
         cursor.execute("""
-            UPDATE ip_records 
-            SET country = ?, is_malicious = ?, fraud_score = ?, isp = ?, organization = ?, otx_pulses = ?, last_api_check = ?
+            UPDATE ip_records SET otx_pulses = ?, otx_checked_at = ?, last_api_check = ?, updated_at = ?
             WHERE id = ?
-        """, (country, malicious, score, isp, org, pulses, current_time, ip_id))
+        """, (pulses, current_time, current_time, current_time, ip_id))
         conn.commit()
     except Error as e:
-        print(f"Error updating IP record for ip_id {ip_id}: {e}")
+        print(f"Error updating OTX pulses for ip_id {ip_id}: {e}")
     finally:
         if conn:
             conn.close()
 
-def link_ip_to_batch(ip_id, batch_id):
+def link_ip_to_batch(ip_id, batch_id, occurrences=None, first_line=None, last_line=None):
+    """
+    Links an IP to a batch. Linking it again (e.g. from a later watch micro-batch) adds to its
+    occurrence count, keeps the first line and moves the last line forward.
+    """
     conn = create_connection()
     if conn is None: return
     try:
         cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO batch_ip_link (ip_id, batch_id) VALUES (?, ?)", (ip_id, batch_id))
+        cursor.execute("""
+            INSERT INTO batch_ip_link (ip_id, batch_id, occurrences, first_line, last_line) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(batch_id, ip_id) DO UPDATE SET
+                occurrences = COALESCE(occurrences, 0) + COALESCE(excluded.occurrences, 0),
+                first_line = COALESCE(first_line, excluded.first_line),
+                last_line = COALESCE(excluded.last_line, last_line)
+        """, (ip_id, batch_id, occurrences, first_line, last_line))
         conn.commit()
     except Error as e:
         print(f"Error linking ip_id {ip_id} to batch_id {batch_id}: {e}")
@@ -212,29 +562,69 @@ def link_ip_to_batch(ip_id, batch_id):
         if conn:
             conn.close()
 
+def add_link_occurrences(batch_id, stats):
+    """ Adds further sightings ({ip_address: (count, first_line, last_line)}) to IPs already linked to a batch. """
+    conn = create_connection()
+    if conn is None: return
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE batch_ip_link SET
+                occurrences = COALESCE(occurrences, 0) + ?,
+                first_line = COALESCE(first_line, ?),
+                last_line = ?
+            WHERE batch_id = ? AND ip_id = (SELECT id FROM ip_records WHERE ip_address = ?)
+        """, [(count, first, last, batch_id, ip) for ip, (count, first, last) in stats.items()])
+        conn.commit()
+    except Error as e:
+        print(f"Error adding occurrences to batch_id {batch_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def record_ip_failure(ip_address, error_class):
+    """
+    Negative-caches a failed lookup: stores the error class and time and bumps the
+    consecutive-failure count, creating the row if needed. Existing API data is kept.
+    Returns the IP's ID.
+    """
+    conn = create_connection()
+    if conn is None: return None
+    try:
+        cursor = conn.cursor()
+        current_time = datetime.now().isoformat()
+        cursor.execute("""
+            INSERT INTO ip_records (ip_address, ip_int, updated_at, last_error_class, last_error_at, error_count)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT(ip_address) DO UPDATE SET
+                last_error_class = excluded.last_error_class,
+                last_error_at = excluded.last_error_at,
+                error_count = error_count + 1
+        """, (ip_address, _ip_int(ip_address), current_time, error_class, current_time))
+        cursor.execute("SELECT id FROM ip_records WHERE ip_address = ?", (ip_address,))
+        conn.commit()
+        return cursor.fetchone()['id']
+    except Error as e:
+        print(f"Error recording failed lookup for {ip_address}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
 def get_or_create_ip_id(ip_address):
     conn = create_connection()
     if conn is None: return None
     try:
         cursor = conn.cursor()
+        # DO NOTHING on conflict: a concurrently created row is simply reused
+        cursor.execute("""
+            INSERT INTO ip_records (ip_address, ip_int, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(ip_address) DO NOTHING
+        """, (ip_address, _ip_int(ip_address), datetime.now().isoformat()))
         cursor.execute("SELECT id FROM ip_records WHERE ip_address = ?", (ip_address,))
-        result = cursor.fetchone()
-        if result:
-            return result['id']
-        cursor.execute("INSERT INTO ip_records (ip_address) VALUES (?)", (ip_address,))
         conn.commit()
-        return cursor.lastrowid
+        return cursor.fetchone()['id']
     except Error as e:
-        if "UNIQUE constraint failed" in str(e):
-            try:
-                conn.rollback()
-                cursor.execute("SELECT id FROM ip_records WHERE ip_address = ?", (ip_address,))
-                result = cursor.fetchone()
-                if result:
-                    return result['id']
-            except Error as e2:
-                print(f"Error in get_or_create_ip_id recovery for {ip_address}: {e2}")
-                return None
         print(f"Error in get_or_create_ip_id for {ip_address}: {e}")
         return None
     finally:
@@ -242,54 +632,400 @@ def get_or_create_ip_id(ip_address):
             conn.close()
 
 def get_all_batches():
+    return _query_list("SELECT id, description, file_name FROM import_batches ORDER BY id DESC", (), "getting all batches")
+
+def _ip_query_sql(batch_ids, columns, search=None, order_by=None, descending=True):
+    """
+    SELECT for IP rows of the given batches (all IPs if empty), one row per IP, projected to
+    `columns` and narrowed by `search` (see _batch_filter_sql). Volume columns are summed over
+    the given batches, or over all batches (without line numbers) when none are given.
+    Ordered by `order_by` (any of IP_QUERY_COLUMNS), else by fraud score and OTX pulses.
+    """
+    unknown = [col for col in list(columns) + [order_by] if col is not None and col not in IP_QUERY_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown ip_records columns: {unknown}")
+    if not batch_ids:
+        volume = {
+            "occurrences": "(SELECT SUM(v.occurrences) FROM batch_ip_link v WHERE v.ip_id = r.id)",
+            "first_line": "NULL", "last_line": "NULL",
+        }
+        group_sql = ""
+    else:
+        volume = {"occurrences": "SUM(l.occurrences)", "first_line": "MIN(l.first_line)", "last_line": "MAX(l.last_line)"}
+        group_sql = "GROUP BY r.id"
+    source_sql, params = _batch_filter_sql(batch_ids, search)
+    select_list = ", ".join(f"{volume[col]} AS {col}" if col in volume else f"r.{col}" for col in columns)
+    if order_by is None:
+        order_sql = "r.fraud_score DESC, r.otx_pulses DESC"
+    else:
+        # Addresses sort numerically; volume columns sort by their aggregate
+        key = volume[order_by] if order_by in volume else "r.ip_int" if order_by == "ip_address" else f"r.{order_by}"
+        order_sql = f"{key} {'DESC' if descending else 'ASC'}, r.id"
+    return f"SELECT {select_list} {source_sql} {group_sql} ORDER BY {order_sql}", params
+
+def get_ip_page(batch_ids, columns=IP_QUERY_COLUMNS, search=None, order_by=None, descending=True, offset=0, limit=PAGE_SIZE):
+    """
+    Returns one page of IP rows (Records of `columns`) plus their volume: `occurrences` summed
+    over the given batches (or all batches), and `first_line`/`last_line` where a batch is given.
+    Reports should stream with iter_ips_by_batch_ids() instead.
+    """
+    sql, params = _ip_query_sql(batch_ids, columns, search, order_by, descending)
+    return _query_list(f"{sql} LIMIT ? OFFSET ?", params + [limit, offset], "getting a page of IPs")
+
+def _batch_filter_sql(batch_ids, search=None):
+    """
+    Builds the FROM/WHERE part shared by the batch-scoped queries. `search` keeps only IPs with
+    the text (case-insensitive) in one of SEARCH_COLUMNS.
+    """
+    conditions, params = [], []
+    if not batch_ids:
+        source_sql = "FROM ip_records r"
+    else:
+        source_sql = "FROM ip_records r JOIN batch_ip_link l ON r.id = l.ip_id"
+        conditions.append(f"l.batch_id IN ({','.join('?' for _ in batch_ids)})")
+        params.extend(batch_ids)
+    if search:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("(" + " OR ".join(f"r.{col} LIKE ? ESCAPE '\\'" for col in SEARCH_COLUMNS) + ")")
+        params.extend([pattern] * len(SEARCH_COLUMNS))
+    if conditions:
+        source_sql += " WHERE " + " AND ".join(conditions)
+    return source_sql, params
+
+def count_ips_by_batch_ids(batch_ids, search=None):
     conn = create_connection()
-    if conn is None: return []
+    if conn is None: return 0
+    source_sql, params = _batch_filter_sql(batch_ids, search)
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, description, file_name FROM import_batches ORDER BY id DESC")
-        return cursor.fetchall()
+        cursor.execute(f"SELECT COUNT(DISTINCT r.id) AS count {source_sql}", params)
+        return cursor.fetchone()['count']
     except Error as e:
-        print(f"Error getting all batches: {e}")
-        return []
+        print(f"Error counting IPs by batch IDs: {e}")
+        return 0
     finally:
         if conn:
             conn.close()
 
-def get_ips_by_batch_ids(batch_ids):
+def get_report_stats(batch_ids):
+    """ Aggregates the numbers a summary report needs without loading the rows themselves. """
+    stats = {"total_ips": 0, "malicious_count": 0, "country_counts": {}}
     conn = create_connection()
-    if conn is None: return []
-    if not batch_ids: 
-        query = "SELECT * FROM ip_records ORDER BY fraud_score DESC, otx_pulses DESC"
-        params = []
+    if conn is None: return stats
+    source_sql, params = _batch_filter_sql(batch_ids)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) AS total, COALESCE(SUM(r.is_malicious = 1), 0) AS malicious {source_sql}", params)
+        totals = cursor.fetchone()
+        stats["total_ips"] = totals['total']
+        stats["malicious_count"] = totals['malicious']
+        country_filter = "r.is_malicious = 1 AND r.country IS NOT NULL AND r.country != 'N/A'"
+        where_sql = f"{source_sql} AND {country_filter}" if batch_ids else f"{source_sql} WHERE {country_filter}"
+        cursor.execute(f"SELECT r.country AS country, COUNT(*) AS count {where_sql} GROUP BY r.country ORDER BY count DESC", params)
+        stats["country_counts"] = {row['country']: row['count'] for row in cursor.fetchall()}
+    except Error as e:
+        print(f"Error getting report stats: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return stats
+
+def get_batch_fingerprint(batch_ids):
+    """
+    Summarizes the membership and last-modified state of the given batches (all IPs if empty)
+    in one indexed aggregate. Any edit bumps `updated_at`, and any link added or removed changes
+    the count/sum, so a cached artifact built from an older fingerprint is never served.
+    """
+    conn = create_connection()
+    if conn is None: return None
+    source_sql, params = _batch_filter_sql(batch_ids)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT COUNT(*), TOTAL(r.id), MAX(r.updated_at), MAX(r.last_api_check) {source_sql}
+        """, params)
+        return tuple(cursor.fetchone())
+    except Error as e:
+        print(f"Error computing batch fingerprint: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def iter_ips_by_batch_ids(batch_ids, columns=IP_RECORD_COLUMNS, chunk_size=ARRAYSIZE):
+    """
+    Streams the IPs of the given batches (all IPs if empty), one row per IP, as lists of
+    Records of `columns` (any of IP_QUERY_COLUMNS), `chunk_size` rows at a time.
+    """
+    sql, params = _ip_query_sql(batch_ids, columns)
+    return iter_query(sql, params, chunk_size)
+
+def update_ip_details(ip_id, tags, notes):
+    conn = create_connection()
+    if conn is None: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE ip_records SET tags = ?, notes = ?, updated_at = ? WHERE id = ?", (tags, notes, datetime.now().isoformat(), ip_id))
+        conn.commit()
+    except Error as e:
+        print(f"Error updating details for ip_id {ip_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def get_latest_batch_id():
+    rows = _query_list("SELECT MAX(id) AS id FROM import_batches", (), "getting the latest batch")
+    return rows[0]['id'] if rows else None
+
+def iter_recurring_ips(batch_id=None, baseline_batches=None, baseline_days=None, columns=RECURRENCE_COLUMNS, chunk_size=ARRAYSIZE):
+    """
+    Streams the IPs of a batch (default: the latest one) that also appear in earlier batches,
+    as lists of Records of `columns` plus `previous_batches` (appearances inside the baseline)
+    and `first_seen`. The baseline can be limited to the last N batches or to batches imported
+    in the last N days.
+    """
+    unknown = [col for col in columns if col not in IP_RECORD_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown ip_records columns: {unknown}")
+    if batch_id is None:
+        batch_id = get_latest_batch_id()
+        if batch_id is None:
+            return iter(())
+
+    if baseline_batches:
+        baseline_sql = "SELECT id FROM import_batches WHERE id < :batch_id ORDER BY id DESC LIMIT :limit"
+    elif baseline_days:
+        baseline_sql = "SELECT id FROM import_batches WHERE id < :batch_id AND import_timestamp >= :cutoff"
     else:
-        placeholders = ','.join('?' for _ in batch_ids)
-        query = f"""
-            SELECT r.* FROM ip_records r
-            JOIN batch_ip_link l ON r.id = l.ip_id
-            WHERE l.batch_id IN ({placeholders})
-            ORDER BY r.fraud_score DESC, r.otx_pulses DESC
-        """
-        params = batch_ids
+        baseline_sql = "SELECT id FROM import_batches WHERE id < :batch_id"
+    params = {
+        'batch_id': batch_id,
+        'limit': baseline_batches or -1,
+        'cutoff': (datetime.now() - timedelta(days=baseline_days or 0)).isoformat(),
+    }
+    select_list = ", ".join(f"r.{col}" for col in columns)
+
+    return iter_query(f"""
+        WITH baseline(id) AS ({baseline_sql})
+        SELECT {select_list},
+            (SELECT COUNT(*) FROM batch_ip_link p
+             WHERE p.ip_id = l.ip_id AND p.batch_id IN baseline) AS previous_batches,
+            (SELECT MIN(b.import_timestamp) FROM batch_ip_link p
+             JOIN import_batches b ON b.id = p.batch_id
+             WHERE p.ip_id = l.ip_id) AS first_seen
+        FROM batch_ip_link l
+        JOIN ip_records r ON r.id = l.ip_id
+        WHERE l.batch_id = :batch_id
+          AND EXISTS (SELECT 1 FROM batch_ip_link p WHERE p.ip_id = l.ip_id AND p.batch_id IN baseline)
+        ORDER BY previous_batches DESC, r.fraud_score DESC, r.otx_pulses DESC
+    """, params, chunk_size)
+
+def get_api_usage(provider, day=None):
+    """ Returns how many calls were made to `provider` on `day` (default: today). """
+    conn = create_connection()
+    if conn is None: return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT calls FROM api_usage WHERE day = ? AND provider = ?",
+                       (day or datetime.now().date().isoformat(), provider))
+        row = cursor.fetchone()
+        return row['calls'] if row else 0
+    except Error as e:
+        print(f"Error getting API usage: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def add_api_usage(provider, calls):
+    if not calls: return
+    conn = create_connection()
+    if conn is None: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO api_usage (day, provider, calls) VALUES (?, ?, ?)
+            ON CONFLICT(day, provider) DO UPDATE SET calls = calls + excluded.calls
+        """, (datetime.now().date().isoformat(), provider, calls))
+        conn.commit()
+    except Error as e:
+        print(f"Error recording API usage: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def get_batch_counts(ip_ids):
+    """ Returns {ip_id: number of batches the IP appears in} for the given IDs. """
+    if not ip_ids: return {}
+    conn = create_connection()
+    if conn is None: return {}
     try:
         cursor = conn.cursor()
-        cursor.execute(query, params)
+        cursor.execute("""
+            SELECT ip_id, COUNT(*) AS batches FROM batch_ip_link
+            WHERE ip_id IN (SELECT value FROM json_each(?))
+            GROUP BY ip_id
+        """, (json.dumps(list(ip_ids)),))
+        return {row['ip_id']: row['batches'] for row in cursor.fetchall()}
+    except Error as e:
+        print(f"Error getting batch counts: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+def get_refresh_candidates(expires_before, expired_after, min_batches, min_score, limit):
+    """
+    Returns rows whose IPQS data expires in (expired_after, expires_before] (ISO timestamps of
+    the last check) and that recur in at least `min_batches` batches or scored `min_score`+,
+    with their batch count. High scorers come first, then the most recurring, then the oldest.
+    """
+    conn = create_connection()
+    if conn is None: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.*, (SELECT COUNT(*) FROM batch_ip_link l WHERE l.ip_id = r.id) AS batches
+            FROM ip_records r
+            WHERE r.ipqs_checked_at <= ? AND r.ipqs_checked_at > ?
+              AND (r.fraud_score >= ? OR (SELECT COUNT(*) FROM batch_ip_link l WHERE l.ip_id = r.id) >= ?)
+            ORDER BY (r.fraud_score >= ?) DESC, batches DESC, r.ipqs_checked_at ASC
+            LIMIT ?
+        """, (expires_before, expired_after, min_score, min_batches, min_score, limit))
         return cursor.fetchall()
     except Error as e:
-        print(f"Error getting IPs by batch IDs: {e}")
+        print(f"Error getting refresh-ahead candidates: {e}")
         return []
     finally:
         if conn:
             conn.close()
 
-def update_ip_details(ip_id, tags, notes):
+def rederive_ip_records(malicious_threshold, chunk_size=1000):
+    """
+    Recomputes derived ip_records columns without any API call, in one transaction: the
+    promoted IPQS fields from the stored raw payloads (decoded `chunk_size` at a time into a
+    temp table, then applied with one UPDATE) and `is_malicious` from `fraud_score` with a
+    single set-based UPDATE (verdicts taken from a newer feed entry are kept). Only rows
+    whose values change get a new `updated_at`.
+    Returns {'payloads': decoded, 'promoted': rows changed, 'malicious': rows changed}.
+    """
+    counts = {'payloads': 0, 'promoted': 0, 'malicious': 0}
+    conn = create_connection()
+    if conn is None: return counts
+    columns = list(PROMOTED_IPQS_FIELDS)
+    try:
+        current_time = datetime.now().isoformat()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(f"CREATE TEMP TABLE derived (ip_id INTEGER PRIMARY KEY, {', '.join(columns)})")
+            reader = conn.cursor()
+            reader.arraysize = chunk_size
+            reader.execute("SELECT ip_id, payload FROM raw_payloads WHERE provider = 'ipqs'")
+            while True:
+                rows = reader.fetchmany()
+                if not rows:
+                    break
+                cursor.executemany(f"INSERT INTO derived VALUES (?, {', '.join('?' for _ in columns)})",
+                                   [(row['ip_id'], *_promoted_values(decode_payload(row['payload']))) for row in rows])
+                counts['payloads'] += len(rows)
+
+            changed = " OR ".join(f"r.{column} IS NOT d.{column}" for column in columns)
+            cursor.execute(f"""
+                UPDATE ip_records SET ({', '.join(columns)}, updated_at) =
+                    (SELECT {', '.join(f'd.{column}' for column in columns)}, ? FROM derived d WHERE d.ip_id = ip_records.id)
+                WHERE id IN (SELECT d.ip_id FROM derived d JOIN ip_records r ON r.id = d.ip_id WHERE {changed})
+            """, (current_time,))
+            counts['promoted'] = cursor.rowcount
+            cursor.execute("DROP TABLE derived")
+
+            cursor.execute("""
+                UPDATE ip_records SET is_malicious = (fraud_score >= ?), updated_at = ?
+                WHERE fraud_score IS NOT NULL AND is_malicious IS NOT (fraud_score >= ?)
+                  AND (feed_checked_at IS NULL OR ipqs_checked_at >= feed_checked_at)
+            """, (malicious_threshold, current_time, malicious_threshold))
+            counts['malicious'] = cursor.rowcount
+        return counts
+    except (Error, zlib.error, ValueError) as e:
+        print(f"Error re-deriving IP records: {e}")
+        return counts
+    finally:
+        if conn:
+            conn.close()
+
+def record_skipped_ips(batch_id, skipped):
+    """ Stores (ip_address, reason) pairs that a batch deliberately did not query. """
+    if not skipped: return
+    conn = create_connection()
+    if conn is None: return
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO batch_skipped_ips (batch_id, ip_address, reason) VALUES (?, ?, ?)",
+                             [(batch_id, ip, reason) for ip, reason in skipped])
+    except Error as e:
+        print(f"Error recording skipped IPs for batch_id {batch_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def save_batch_run_summary(batch_id, summary):
+    """ Stores the metrics summary (a dict, see metrics.py) of the batch's latest analysis run. """
     conn = create_connection()
     if conn is None: return
     try:
         cursor = conn.cursor()
-        cursor.execute("UPDATE ip_records SET tags = ?, notes = ? WHERE id = ?", (tags, notes, ip_id))
+        cursor.execute("UPDATE import_batches SET run_summary = ? WHERE id = ?", (json.dumps(summary), batch_id))
         conn.commit()
     except Error as e:
-        print(f"Error updating details for ip_id {ip_id}: {e}")
+        print(f"Error saving run summary for batch_id {batch_id}: {e}")
     finally:
         if conn:
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+def get_batch_run_summary(batch_id):
+    """ Returns the batch's stored run summary as a dict, or None. """
+    conn = create_connection()
+    if conn is None: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT run_summary FROM import_batches WHERE id = ?", (batch_id,))
+        row = cursor.fetchone()
+        return json.loads(row['run_summary']) if row and row['run_summary'] else None
+    except (Error, ValueError) as e:
+        print(f"Error getting run summary for batch_id {batch_id}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_watch_offset(path):
+    """ Returns (file_id, offset, line_no) persisted for a watched file, or None if it was never watched. """
+    conn = create_connection()
+    if conn is None: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_id, offset, line_no FROM watch_offsets WHERE path = ?", (path,))
+        row = cursor.fetchone()
+        return (row['file_id'], row['offset'], row['line_no']) if row else None
+    except Error as e:
+        print(f"Error getting watch offset for {path}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def save_watch_offset(path, file_id, offset, line_no=0):
+    conn = create_connection()
+    if conn is None: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO watch_offsets (path, file_id, offset, line_no, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET file_id = excluded.file_id, offset = excluded.offset,
+                line_no = excluded.line_no, updated_at = excluded.updated_at
+        """, (path, file_id, offset, line_no, datetime.now().isoformat()))
+        conn.commit()
+    except Error as e:
+        print(f"Error saving watch offset for {path}: {e}")
+    finally:
+        if conn:
+            conn.close()
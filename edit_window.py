@@ -1,6 +1,7 @@
 import customtkinter as ctk
 from tkinter import messagebox
 import database
+import report_cache
 
 class EditWindow(ctk.CTkToplevel):
     def __init__(self, master, item_values_dict, callback):
@@ -47,6 +48,7 @@ class EditWindow(ctk.CTkToplevel):
 
         try:
             database.update_ip_details(ip_id, new_tags, new_notes)
+            report_cache.invalidate_ips([ip_id])
             messagebox.showinfo("Success", "Details updated successfully.")
             self.callback()
             self.destroy()
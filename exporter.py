@@ -0,0 +1,202 @@
+import csv
+import json
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+import database
+
+CHUNK_SIZE = 2000
+
+# --- Columnar format ("IPPC"): magic, JSON header, then per-chunk zlib-compressed column blocks ---
+COLUMNAR_MAGIC = b"IPPC1\n"
+INTEGER_COLUMNS = {"id", "is_malicious", "fraud_score", "otx_pulses", "occurrences", "first_line", "last_line"}
+
+EXPORT_FORMATS = {
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".ippc": "columnar",
+}
+
+class ExportCancelled(Exception):
+    pass
+
+def format_for_path(file_path):
+    """ Picks the export format from the file extension (CSV by default). """
+    return EXPORT_FORMATS.get(os.path.splitext(file_path)[1].lower(), "csv")
+
+# --- Writers: each takes the column names and an iterator of row chunks ---
+class CsvWriter:
+    def __init__(self, f, columns):
+        self.writer = csv.writer(f)
+        self.writer.writerow(columns)
+
+    def write_chunk(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        pass
+
+class NdjsonWriter:
+    def __init__(self, f, columns):
+        self.f = f
+        self.columns = columns
+
+    def write_chunk(self, rows):
+        self.f.write("".join(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n" for row in rows))
+
+    def close(self):
+        pass
+
+class ColumnarWriter:
+    """
+    Writes one block per column per chunk. Integer columns are packed as int64 arrays,
+    text columns as an offsets array plus one UTF-8 blob; each block carries a null bitmap
+    and is zlib-compressed on its own. A zero row count terminates the file.
+    """
+    def __init__(self, f, columns):
+        self.f = f
+        self.columns = columns
+        self.types = ["int" if col in INTEGER_COLUMNS else "text" for col in columns]
+        header = json.dumps({"columns": list(columns), "types": self.types}).encode("utf-8")
+        f.write(COLUMNAR_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+
+    def write_chunk(self, rows):
+        self.f.write(struct.pack("<I", len(rows)))
+        for index, col_type in enumerate(self.types):
+            values = [row[index] for row in rows]
+            block = zlib.compress(_encode_column(values, col_type))
+            self.f.write(struct.pack("<I", len(block)))
+            self.f.write(block)
+
+    def close(self):
+        self.f.write(struct.pack("<I", 0))
+
+def _null_bitmap(values):
+    bitmap = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value is None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bytes(bitmap)
+
+def _encode_column(values, col_type):
+    bitmap = _null_bitmap(values)
+    if col_type == "int":
+        data = array("q")
+        for value in values:
+            try:
+                data.append(int(value) if value is not None else 0)
+            except (TypeError, ValueError):
+                data.append(0)
+        return bitmap + data.tobytes()
+    offsets = array("I", [0])
+    blob = bytearray()
+    for value in values:
+        if value is not None:
+            blob += str(value).encode("utf-8")
+        offsets.append(len(blob))
+    return bitmap + offsets.tobytes() + bytes(blob)
+
+def _decode_column(block, col_type, row_count):
+    bitmap_len = (row_count + 7) // 8
+    bitmap, payload = block[:bitmap_len], block[bitmap_len:]
+    is_null = lambda i: bitmap[i >> 3] & (1 << (i & 7))
+    if col_type == "int":
+        data = array("q")
+        data.frombytes(payload)
+        return [None if is_null(i) else data[i] for i in range(row_count)]
+    offsets = array("I")
+    offsets.frombytes(payload[:(row_count + 1) * 4])
+    blob = payload[(row_count + 1) * 4:]
+    return [None if is_null(i) else blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(row_count)]
+
+def read_columnar(file_path):
+    """ Yields (columns, rows) chunk by chunk from an IPPC file. """
+    with open(file_path, "rb") as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("Not an IP Prism columnar export.")
+        header_len, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_len))
+        columns, types = header["columns"], header["types"]
+        while True:
+            row_count, = struct.unpack("<I", f.read(4))
+            if row_count == 0:
+                break
+            column_values = []
+            for col_type in types:
+                block_len, = struct.unpack("<I", f.read(4))
+                column_values.append(_decode_column(zlib.decompress(f.read(block_len)), col_type, row_count))
+            yield columns, list(zip(*column_values))
+
+WRITERS = {"csv": CsvWriter, "ndjson": NdjsonWriter, "columnar": ColumnarWriter}
+
+def export_rows(file_path, columns, chunks, export_format, total=0, progress_callback=None, cancel_event=None):
+    """
+    Writes row chunks to `file_path` via a temporary `.part` file that is renamed on success,
+    so a cancelled or failed export never leaves a truncated file behind. Returns rows written.
+    """
+    part_path = file_path + ".part"
+    written = 0
+    binary = export_format == "columnar"
+    try:
+        with open(part_path, "wb" if binary else "w", newline=None if binary else "", encoding=None if binary else "utf-8") as f:
+            writer = WRITERS[export_format](f, columns)
+            for rows in chunks:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ExportCancelled()
+                writer.write_chunk(rows)
+                written += len(rows)
+                if progress_callback:
+                    progress_callback(written, total)
+            writer.close()
+        os.replace(part_path, file_path)
+        return written
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        # --- Release the cursor's connection even when the export stops early ---
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+class ExportJob:
+    """
+    Streams the IPs of a batch filter straight from a SQLite cursor into a file on a worker thread.
+    Callbacks are invoked from the worker thread; GUI callers must marshal them with `after()`.
+    """
+    def __init__(self, file_path, batch_ids, columns, progress_callback=None, done_callback=None, chunk_size=CHUNK_SIZE):
+        self.file_path = file_path
+        self.batch_ids = batch_ids
+        self.columns = columns
+        self.progress_callback = progress_callback
+        self.done_callback = done_callback
+        self.chunk_size = chunk_size
+        self.export_format = format_for_path(file_path)
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _run(self):
+        try:
+            total = database.count_ips_by_batch_ids(self.batch_ids)
+            chunks = database.iter_ips_by_batch_ids(self.batch_ids, self.columns, self.chunk_size)
+            written = export_rows(self.file_path, self.columns, chunks, self.export_format,
+                                  total, self.progress_callback, self.cancel_event)
+            result = {'rows': written}
+        except ExportCancelled:
+            result = {'cancelled': True}
+        except Exception as e:
+            result = {'error': str(e)}
+        if self.done_callback:
+            self.done_callback(result)
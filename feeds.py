@@ -0,0 +1,165 @@
+import argparse
+import csv
+import json
+import os
+from datetime import datetime
+
+import api
+import database
+import ingest
+import ip_filter
+
+CHUNK_SIZE = 50000  # Rows upserted per transaction
+
+# --- Feed columns recognised for each ip_records field (case-insensitive); --map overrides them ---
+FIELD_ALIASES = {
+    "ip_address": ("ip_address", "ip", "ipaddress", "address", "indicator", "src_ip"),
+    "country": ("country", "country_code"),
+    "is_malicious": ("is_malicious", "malicious"),
+    "fraud_score": ("fraud_score", "score", "risk_score", "risk"),
+    "isp": ("isp",),
+    "organization": ("organization", "org", "as_org"),
+    "checked_at": ("checked_at", "last_seen", "timestamp", "last_api_check"),
+}
+TRUE_VALUES = {"1", "true", "yes", "y", "malicious"}
+
+def _format_for_path(path):
+    """ "ndjson", "csv", "tsv" or "list" (one address per line), judged past any compression suffix. """
+    base, ext = os.path.splitext(path)
+    if ext.lower() in ingest.COMPRESSED_OPENERS:
+        ext = os.path.splitext(base)[1]
+    return {".ndjson": "ndjson", ".jsonl": "ndjson", ".json": "ndjson", ".csv": "csv", ".tsv": "tsv"}.get(ext.lower(), "list")
+
+def iter_feed_rows(path):
+    """ Streams a feed as dicts with lower-cased keys; plain lists yield {'ip': first token of each line}. """
+    feed_format = _format_for_path(path)
+    with ingest.open_text(path) as f:
+        if feed_format == "ndjson":
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    yield {str(key).lower(): value for key, value in record.items()} if isinstance(record, dict) else {}
+        elif feed_format in ("csv", "tsv"):
+            for record in csv.DictReader(f, delimiter="\t" if feed_format == "tsv" else ","):
+                yield {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+        else:
+            for line in f:
+                token = line.split("#", 1)[0].split(";", 1)[0].strip().split()
+                if token:
+                    yield {"ip": token[0]}
+
+def resolve_columns(keys, mapping=None):
+    """ {field: feed column} for the first alias of each field found in `keys`, overridden by `mapping`. """
+    columns = {}
+    for field, aliases in FIELD_ALIASES.items():
+        for alias in aliases:
+            if alias in keys:
+                columns[field] = alias
+                break
+    columns.update({field: column.lower() for field, column in (mapping or {}).items()})
+    return columns
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _score(value):
+    try:
+        return max(0, min(100, int(float(value))))
+    except (TypeError, ValueError):
+        return None
+
+def _flag(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+def _timestamp(value, default):
+    """ ISO local time like the rest of the database (zone-aware values are converted), or `default`. """
+    if value is None:
+        return default
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return default
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.isoformat()
+
+def _field(record, columns, field):
+    return record.get(columns[field]) if field in columns else None
+
+def import_feed(path, source, timestamp=None, mapping=None, listed_malicious=None, progress_callback=None):
+    """
+    Streams a CSV/TSV/NDJSON feed (or a plain list of addresses, optionally compressed) into
+    ip_records, CHUNK_SIZE rows per transaction, tagged with `source`. Entries are dated by
+    their own timestamp column, else `timestamp`, else now; while younger than FEED_CACHE_HOURS
+    they count as cache hits and the IP is not sent to IPQS.
+
+    A feed without a verdict or score column is a blocklist: its IPs are marked malicious
+    unless `listed_malicious` is False. With a score but no verdict, MALICIOUS_THRESHOLD decides.
+    Returns {'imported': n, 'invalid': n}.
+    """
+    default_time = _timestamp(timestamp, datetime.now().isoformat())
+    threshold = api.get_malicious_threshold()
+    counts = {'imported': 0, 'invalid': 0}
+    columns, chunk = None, []
+    for record in iter_feed_rows(path):
+        if columns is None:
+            columns = resolve_columns(record.keys(), mapping)
+            if "ip_address" not in columns:
+                raise ValueError(f"No IP address column found in {os.path.basename(path)} (use a mapping for ip_address).")
+            if listed_malicious is None:
+                listed_malicious = "is_malicious" not in columns and "fraud_score" not in columns
+
+        ip = ip_filter.canonicalize(str(_field(record, columns, "ip_address") or ""))
+        if ip is None:
+            counts['invalid'] += 1
+            continue
+        score = _score(_field(record, columns, "fraud_score"))
+        malicious = _flag(_field(record, columns, "is_malicious"))
+        if malicious is None:
+            malicious = score >= threshold if score is not None else (True if listed_malicious else None)
+        chunk.append((ip, _text(_field(record, columns, "country")), malicious, score, _text(_field(record, columns, "isp")),
+                      _text(_field(record, columns, "organization")), _timestamp(_field(record, columns, "checked_at"), default_time)))
+
+        if len(chunk) >= CHUNK_SIZE:
+            counts['imported'] += _flush(source, chunk)
+            chunk = []
+            if progress_callback:
+                progress_callback(counts['imported'])
+    counts['imported'] += _flush(source, chunk)
+    return counts
+
+def _flush(source, chunk):
+    if not database.upsert_feed_records(source, chunk):
+        raise RuntimeError(f"Could not store feed entries from {source}; see the console for details.")
+    return len(chunk)
+
+def main():
+    parser = argparse.ArgumentParser(description="Import an external reputation feed into the LOCKON IP Prism cache.")
+    parser.add_argument("file", help="CSV/TSV/NDJSON feed or a plain list of addresses (.gz/.bz2/.xz allowed)")
+    parser.add_argument("--source", help="provenance tag stored with every entry (default: the file name)")
+    parser.add_argument("--timestamp", help="ISO date of the feed when rows carry none (default: now)")
+    parser.add_argument("--map", action="append", default=[], metavar="FIELD=COLUMN",
+                        help=f"feed column for a field ({', '.join(FIELD_ALIASES)}); may be repeated")
+    parser.add_argument("--not-malicious", action="store_true", help="do not mark the IPs of a plain blocklist malicious")
+    args = parser.parse_args()
+
+    mapping = dict(item.split("=", 1) for item in args.map)
+    unknown = [field for field in mapping if field not in FIELD_ALIASES]
+    if unknown:
+        parser.error(f"unknown fields: {', '.join(unknown)}")
+
+    database.setup_database()
+    source = args.source or os.path.basename(args.file)
+    counts = import_feed(args.file, source, args.timestamp, mapping, False if args.not_malicious else None)
+    print(f"{source}: imported {counts['imported']} entries, skipped {counts['invalid']} invalid addresses.")
+
+if __name__ == "__main__":
+    main()
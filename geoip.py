@@ -0,0 +1,173 @@
+import csv
+import gzip
+import io
+import os
+import threading
+from array import array
+from bisect import bisect_right
+
+from ip_filter import ip_to_int
+
+# --- Offline GeoIP/ASN enrichment ---
+# Supported range files (plain or .gz):
+#   * Country: "start,end,country_code[,...]"  (IP2Location LITE DB1, DB-IP country lite)
+#   * ASN:     "start<TAB>end<TAB>asn<TAB>country<TAB>description"  (iptoasn.com ip2asn-v4.tsv)
+#              or "start,end,asn,organization"
+# Range bounds may be dotted quads or 32-bit integers.
+
+def _parse_bound(value):
+    value = value.strip()
+    return int(value) if value.isdigit() else ip_to_int(value)
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+class RangeTable:
+    """
+    Sorted, non-overlapping integer intervals with an interned label per interval.
+    Starts/ends live in compact unsigned arrays and lookups are a single binary search.
+    """
+    def __init__(self):
+        self.starts = array("L")
+        self.ends = array("L")
+        self.label_ids = array("L")
+        self.labels = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def load(self, rows):
+        """ Builds the table from (start, end, label) tuples; range files are usually pre-sorted. """
+        label_index = {}
+        starts, ends, label_ids = array("L"), array("L"), array("L")
+        in_order = True
+        for start, end, label in rows:
+            if starts and start < starts[-1]:
+                in_order = False
+            label_id = label_index.get(label)
+            if label_id is None:
+                label_id = label_index[label] = len(self.labels)
+                self.labels.append(label)
+            starts.append(start)
+            ends.append(end)
+            label_ids.append(label_id)
+
+        order = range(len(starts)) if in_order else sorted(range(len(starts)), key=starts.__getitem__)
+        for i in order:
+            if self.ends and starts[i] <= self.ends[-1]:
+                continue  # Overlapping range: the one with the lowest start wins.
+            self.starts.append(starts[i])
+            self.ends.append(ends[i])
+            self.label_ids.append(label_ids[i])
+
+    def lookup(self, ip_int):
+        index = bisect_right(self.starts, ip_int) - 1
+        if index >= 0 and ip_int <= self.ends[index]:
+            return self.labels[self.label_ids[index]]
+        return None
+
+def _read_rows(path):
+    with _open_text(path) as f:
+        sample = f.readline()
+        f.seek(0)
+        delimiter = "\t" if "\t" in sample else ","
+        for row in csv.reader(f, delimiter=delimiter):
+            if len(row) < 3 or row[0].startswith("#"):
+                continue
+            try:
+                yield _parse_bound(row[0]), _parse_bound(row[1]), row[2:]
+            except ValueError:
+                continue  # Header line or malformed bound.
+
+def load_country_ranges(path):
+    table = RangeTable()
+    table.load(
+        (start, end, rest[0].strip().upper())
+        for start, end, rest in _read_rows(path)
+        if rest[0].strip() not in ("", "-", "None", "ZZ")
+    )
+    return table
+
+def load_asn_ranges(path):
+    def entries():
+        for start, end, rest in _read_rows(path):
+            asn = rest[0].strip().upper()
+            if asn.startswith("AS"):
+                asn = asn[2:]
+            if not asn.isdigit() or asn == "0":
+                continue
+            if len(rest) >= 3:
+                country, org = rest[1].strip().upper(), rest[2].strip()
+            else:
+                country, org = "", rest[1].strip() if len(rest) == 2 else ""
+            yield start, end, (int(asn), org or "N/A", country if len(country) == 2 and country != "ZZ" else None)
+    table = RangeTable()
+    table.load(entries())
+    return table
+
+class GeoIPEngine:
+    def __init__(self, country_path=None, asn_path=None):
+        self.country_path = country_path
+        self.asn_path = asn_path
+        self.countries = load_country_ranges(country_path) if country_path else None
+        self.asns = load_asn_ranges(asn_path) if asn_path else None
+
+    def is_loaded(self):
+        return bool(self.countries or self.asns)
+
+    def lookup(self, ip):
+        """
+        Returns (country, isp, organization) for one IP; unknown fields are None.
+        The ASN file's registry country is used when no country file covers the IP.
+        """
+        try:
+            ip_int = ip_to_int(ip)
+        except ValueError:
+            return None, None, None
+        country = self.countries.lookup(ip_int) if self.countries else None
+        asn_info = self.asns.lookup(ip_int) if self.asns else None
+        org = asn_info[1] if asn_info else None
+        if country is None and asn_info:
+            country = asn_info[2]
+        return country, org, org
+
+    def enrich(self, ips):
+        """ Looks up every IP and returns {ip: (country, isp, organization)} for the ones found. """
+        results = {}
+        for ip in ips:
+            found = self.lookup(ip)
+            if any(found):
+                results[ip] = found
+        return results
+
+# --- Process-wide engine, reloaded only when the configured paths change ---
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+    country_path = os.getenv("GEOIP_COUNTRY_DB", "").strip() or None
+    asn_path = os.getenv("GEOIP_ASN_DB", "").strip() or None
+    with _engine_lock:
+        if _engine is None or (_engine.country_path, _engine.asn_path) != (country_path, asn_path):
+            try:
+                _engine = GeoIPEngine(
+                    country_path if country_path and os.path.exists(country_path) else None,
+                    asn_path if asn_path and os.path.exists(asn_path) else None,
+                )
+                _engine.country_path, _engine.asn_path = country_path, asn_path
+            except Exception as e:
+                print(f"Error loading offline GeoIP data: {e}")
+                _engine = GeoIPEngine()
+                _engine.country_path, _engine.asn_path = country_path, asn_path
+        return _engine
+
+def get_skip_countries():
+    """
+    Countries whose IPs are enriched offline only and never sent to IPQS.
+    "*" skips IPQS for every IP the offline data can place.
+    """
+    value = os.getenv("IPQS_SKIP_COUNTRIES", "")
+    return {code.strip().upper() for code in value.split(",") if code.strip()}
@@ -30,9 +30,12 @@ class HelpWindow(ctk.CTkToplevel):
            • ตั้งค่า Cache Duration (จำนวนชั่วโมงที่โปรแกรมจะจำผลลัพธ์ไว้)
 
         2. เลือกไฟล์:
-           • คลิกที่ปุ่ม [Select IP File (.txt, .log)] เพื่อเลือกไฟล์ที่ต้องการ
+           • คลิกที่ปุ่ม [Select IP File(s) (.txt, .log)] เพื่อเลือกไฟล์ (เลือกได้หลายไฟล์)
+             หรือ [Select Folder] เพื่อเลือกทุกไฟล์ในโฟลเดอร์ โดยแต่ละไฟล์จะเป็น Batch ของตัวเอง
            • ไฟล์ .txt: ควรมี IP บรรทัดละหนึ่งอัน
            • ไฟล์ .log: โปรแกรมจะค้นหาและดึง IP ทั้งหมดจากในไฟล์ให้โดยอัตโนมัติ
+           • รองรับไฟล์บีบอัด .gz / .bz2 / .xz โดยไม่ต้องแตกไฟล์ก่อน
+           • ติ๊ก [Merge into one batch] เพื่อรวมหลายไฟล์เป็น Batch เดียว (ประมวลผลขนานทุกคอร์)
 
         3. เพิ่มคำอธิบาย (แนะนำอย่างยิ่ง):
            • ใส่คำอธิบายสั้นๆ สำหรับไฟล์แต่ละชุด (เช่น "Week 32 Blocklist") เพื่อให้คุณ
@@ -40,6 +43,10 @@ class HelpWindow(ctk.CTkToplevel):
 
         4. เริ่มการวิเคราะห์:
            • คลิกที่ปุ่มใหญ่ [Start Analysis] โปรแกรมจะเริ่มประมวลผลและแสดงความคืบหน้า
+           • สามารถเพิ่มไฟล์เข้าคิวได้ระหว่างที่งานอื่นกำลังทำงาน ความคืบหน้าของแต่ละงานจะแสดงใน
+             ส่วน Analysis Jobs และยกเลิกได้ทีละงานด้วยปุ่ม [✕]
+           • ปุ่ม [Watch Log File(s)] ใช้ติดตามไฟล์ Log ที่เขียนต่อเนื่อง โปรแกรมจะอ่านเฉพาะบรรทัดใหม่
+             และวิเคราะห์ IP ใหม่เป็นชุดย่อยอัตโนมัติ (กด [Stop Watching] เพื่อหยุด)
 
         {"-"*90}
 
@@ -77,7 +84,7 @@ class HelpWindow(ctk.CTkToplevel):
         ความสามารถหลัก (Features)
 
         Dashboard: แสดงข้อมูลสรุปภาพรวมของฐานข้อมูลทั้งหมด
-        • Color Coding: IP ที่มีความเสี่ยงสูง (Score > 85) จะเป็น สีแดง และที่น่าสงสัย (Score >= 75) จะเป็น สีเหลือง เพื่อให้สังเกตได้ง่าย
+        • Color Coding: IP ที่มีความเสี่ยงสูง (Score >= Malicious Threshold, ค่าเริ่มต้น 85) จะเป็น สีแดง และที่น่าสงสัย (Score >= 75) จะเป็น สีเหลือง เพื่อให้สังเกตได้ง่าย
         • Recurrence Report: สร้างรายงานเปรียบเทียบ IP จาก "ไฟล์ล่าสุด" กับ "ไฟล์ก่อนหน้าทั้งหมด" เพื่อค้นหา "ผู้กระทำผิดซ้ำซาก"
         • Multi-Batch Compare: สร้างรายงานเปรียบเทียบ IP ระหว่างไฟล์ชุดใดๆ ที่คุณเลือก
         • Generate PDF / Export to CSV: สร้างรายงานสรุปในรูปแบบ PDF หรือไฟล์ตาราง CSV
@@ -2,16 +2,20 @@ import customtkinter as ctk
 from tkinter import ttk, messagebox, filedialog
 import tkinter
 import pyperclip
-import tempfile
-import os
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import threading
+import itertools
+import shutil
 
 import database
 from edit_window import EditWindow
 from multi_compare_setup_window import MultiCompareSetupWindow
 from recurrence_report_window import RecurrenceReportWindow
+from cluster_report_window import ClusterReportWindow
 import pdf_generator
+import exporter
+import report_cache
+
+SEARCH_DELAY_MS = 300  # Typing pause before the search query runs
 
 class HistoryWindow(ctk.CTkToplevel):
     def __init__(self, master):
@@ -23,6 +27,15 @@ class HistoryWindow(ctk.CTkToplevel):
         self.transient(master)
         self.grab_set()
 
+        # --- View state: one page of the selected batch is held at a time ---
+        self.page_rows = []
+        self.page_offset = 0
+        self.total_rows = 0
+        self.order_by = None  # Default: fraud score, then OTX pulses
+        self.descending = True
+        self.search = ""
+        self._search_job = None
+
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(2, weight=1)
 
@@ -51,31 +64,54 @@ class HistoryWindow(ctk.CTkToplevel):
         self.recurrence_report_button = ctk.CTkButton(self.action_frame, text="Recurrence Report", command=self.open_recurrence_report)
         self.recurrence_report_button.pack(side="left", padx=5)
 
+        self.cluster_report_button = ctk.CTkButton(self.action_frame, text="Cluster Report", command=self.open_cluster_report)
+        self.cluster_report_button.pack(side="left", padx=5)
+
         self.pdf_report_button = ctk.CTkButton(self.action_frame, text="Generate PDF Report", command=self.generate_pdf_report)
         self.pdf_report_button.pack(side="left", padx=5)
 
-        self.export_button = ctk.CTkButton(self.action_frame, text="Export to CSV", command=self.export_to_csv)
+        self.export_button = ctk.CTkButton(self.action_frame, text="Export Data", command=self.export_data)
         self.export_button.pack(side="left", padx=5)
 
+        # --- Export progress (shown only while an export is running) ---
+        self.export_job = None
+        self.export_progress = ctk.CTkProgressBar(self.action_frame, width=150)
+        self.export_progress.set(0)
+        self.export_cancel_button = ctk.CTkButton(self.action_frame, text="Cancel Export", width=100, command=self.cancel_export)
+
         self.delete_selected_button = ctk.CTkButton(self.action_frame, text="Delete Selected Batch", fg_color="#E74C3C", hover_color="#C0392B", command=self.delete_selected_batch)
         self.delete_selected_button.pack(side="right", padx=5)
 
-        self.columns = ("id", "ip_address", "country", "is_malicious", "fraud_score", "isp", "organization", "otx_pulses", "tags", "notes")
+        self.columns = ("id", "ip_address", "country", "is_malicious", "fraud_score", "isp", "organization", "otx_pulses", "occurrences", "first_line", "last_line", "tags", "notes")
         self.tree = ttk.Treeview(self, columns=self.columns, show="headings")
         
         for col in self.columns:
-            self.tree.heading(col, text=col.replace("_", " ").title(), command=lambda c=col: self.sort_by_column(c, False))
+            self.tree.heading(col, text=col.replace("_", " ").title(), command=lambda c=col: self.sort_by_column(c))
             self.tree.column(col, width=100, anchor="w")
         
         self.tree.column("ip_address", width=120)
         self.tree.column("isp", width=150)
         self.tree.column("organization", width=150)
+        for col in ("occurrences", "first_line", "last_line"):
+            self.tree.column(col, width=80, anchor="e")
         
         self.tree.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
 
         scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscroll=scrollbar.set)
         scrollbar.grid(row=2, column=1, sticky="ns")
+
+        # --- Paging ---
+        self.paging_frame = ctk.CTkFrame(self)
+        self.paging_frame.grid(row=3, column=0, padx=10, pady=(0, 10), sticky="ew")
+        self.summary_label = ctk.CTkLabel(self.paging_frame, text="", font=ctk.CTkFont(weight="bold"))
+        self.summary_label.pack(side="left", padx=10, pady=5)
+        self.next_button = ctk.CTkButton(self.paging_frame, text="Next >", width=80, command=self.next_page)
+        self.next_button.pack(side="right", padx=(5, 10), pady=5)
+        self.page_label = ctk.CTkLabel(self.paging_frame, text="")
+        self.page_label.pack(side="right", padx=5, pady=5)
+        self.prev_button = ctk.CTkButton(self.paging_frame, text="< Prev", width=80, command=self.prev_page)
+        self.prev_button.pack(side="right", padx=5, pady=5)
         
         self.context_menu = tkinter.Menu(self, tearoff=0)
         self.context_menu.add_command(label="Copy IP Address", command=self.copy_ip)
@@ -96,28 +132,38 @@ class HistoryWindow(ctk.CTkToplevel):
         else:
             self.batch_combobox.set("All Batches")
 
-    def load_data(self, batch_id=None):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        self.all_data = database.get_ips_by_batch_ids([batch_id] if batch_id else [])
-        self.display_data(self.all_data)
+    def load_data(self):
+        """ Reloads the batch list and shows the first page of all batches. """
         self.load_batches()
-        if batch_id is None:
-            self.batch_combobox.set("All Batches")
+        self.batch_combobox.set("All Batches")
+        self.page_offset = 0
+        self.refresh_page()
+
+    def refresh_page(self):
+        """ Queries the current page of the selected batch (with the search and sort applied) and shows it. """
+        batch_ids = self.selected_batch_ids()
+        self.total_rows = database.count_ips_by_batch_ids(batch_ids, self.search)
+        if self.page_offset >= self.total_rows:
+            self.page_offset = max(0, (self.total_rows - 1) // database.PAGE_SIZE * database.PAGE_SIZE)
+        self.page_rows = database.get_ip_page(batch_ids, self.columns, self.search, self.order_by, self.descending, self.page_offset)
+        self.display_data(self.page_rows)
+
+        last_row = min(self.page_offset + database.PAGE_SIZE, self.total_rows)
+        first_row = self.page_offset + 1 if self.total_rows else 0
+        self.summary_label.configure(text=f"{self.total_rows} IPs" + (f" matching '{self.search}'" if self.search else ""))
+        self.page_label.configure(text=f"{first_row}-{last_row} of {self.total_rows}")
+        self.prev_button.configure(state="normal" if self.page_offset > 0 else "disabled")
+        self.next_button.configure(state="normal" if last_row < self.total_rows else "disabled")
 
     def display_data(self, data):
         for item in self.tree.get_children():
             self.tree.delete(item)
         self.tree.tag_configure('high_risk', background='#E74C3C', foreground='white')
         self.tree.tag_configure('medium_risk', background='#F39C12', foreground='black')
+        high_risk_score = pdf_generator.high_risk_threshold()
         for row in data:
             if not row: continue
-            tags_to_apply = ()
-            score = row['fraud_score'] or 0
-            if score > 85:
-                tags_to_apply = ('high_risk',)
-            elif score >= 75:
-                tags_to_apply = ('medium_risk',)
+            tags_to_apply = pdf_generator.risk_tags(row['fraud_score'], high_risk_score)
             try:
                 values_tuple = tuple(row[col] for col in self.columns)
                 self.tree.insert("", "end", values=values_tuple, tags=tags_to_apply)
@@ -125,48 +171,48 @@ class HistoryWindow(ctk.CTkToplevel):
                 print(f"Skipping row with mismatched data: {dict(row)}. Error: {e}")
 
     def filter_by_batch(self, choice):
-        if choice == "All Batches":
-            self.load_data()
-        else:
-            selected_batch_id = int(choice.split(":")[0])
-            self.all_data = database.get_ips_by_batch_ids([selected_batch_id])
-            self.display_data(self.all_data)
-            self.batch_combobox.set(choice)
+        self.batch_combobox.set(choice)
+        self.search = ""
         self.search_var.set("")
+        self.page_offset = 0
+        self.refresh_page()
 
     def reset_filter(self):
-        self.batch_combobox.set("All Batches")
-        self.load_data()
+        self.search = ""
         self.search_var.set("")
+        self.load_data()
 
     def search_data(self, *args):
-        query = self.search_var.get().lower()
-        if not query:
-            self.display_data(self.all_data)
-            return
+        """ Runs the search in SQL once typing pauses, instead of on every keystroke. """
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(SEARCH_DELAY_MS, self._apply_search)
 
-        filtered_data = [
-            row for row in self.all_data
-            if any(query in str(row[key]).lower() for key in row.keys() if row[key] is not None)
-        ]
-        self.display_data(filtered_data)
+    def _apply_search(self):
+        self._search_job = None
+        search = self.search_var.get().strip()
+        if search != self.search:
+            self.search = search
+            self.page_offset = 0
+            self.refresh_page()
 
-    def sort_by_column(self, col, reverse):
-        data_list = []
-        for k in self.tree.get_children(''):
-            try:
-                val = self.tree.set(k, col)
-                data_list.append((val, k))
-            except tkinter.TclError:
-                print(f"Warning: Could not find column '{col}' for sorting.")
-                return
-        try:
-            data_list.sort(key=lambda t: float(t[0] if t[0] and t[0] != 'None' else 0), reverse=reverse)
-        except (ValueError, TypeError):
-            data_list.sort(key=lambda t: str(t[0]), reverse=reverse)
-        for index, (val, k) in enumerate(data_list):
-            self.tree.move(k, '', index)
-        self.tree.heading(col, command=lambda c=col: self.sort_by_column(c, not reverse))
+    def sort_by_column(self, col):
+        if self.order_by == col:
+            self.descending = not self.descending
+        else:
+            self.order_by, self.descending = col, True
+        self.page_offset = 0
+        self.refresh_page()
+
+    def next_page(self):
+        if self.page_offset + database.PAGE_SIZE < self.total_rows:
+            self.page_offset += database.PAGE_SIZE
+            self.refresh_page()
+
+    def prev_page(self):
+        if self.page_offset > 0:
+            self.page_offset = max(0, self.page_offset - database.PAGE_SIZE)
+            self.refresh_page()
 
     def show_context_menu(self, event):
         selection = self.tree.identify_row(event.y)
@@ -190,18 +236,14 @@ class HistoryWindow(ctk.CTkToplevel):
         if selected_item:
             item_id = self.tree.item(selected_item[0])['values'][0]
             item_values_dict = None
-            for row in self.all_data:
+            for row in self.page_rows:
                 if row['id'] == item_id:
                     item_values_dict = dict(row)
                     break
             if item_values_dict is None:
                 messagebox.showerror("Error", "Could not find details for the selected item.")
                 return
-            current_batch_choice = self.batch_combobox.get()
-            batch_id = None
-            if current_batch_choice != "All Batches":
-                batch_id = int(current_batch_choice.split(":")[0])
-            EditWindow(self, item_values_dict, lambda: self.load_data(batch_id))
+            EditWindow(self, item_values_dict, self.refresh_page)
 
     def open_multi_compare_setup(self):
         MultiCompareSetupWindow(self)
@@ -211,18 +253,15 @@ class HistoryWindow(ctk.CTkToplevel):
         if len(all_batches) < 2:
             messagebox.showinfo("Not Enough Data", "You need at least two import batches to generate a recurrence report.")
             return
-        latest_batch_id = all_batches[0]['id']
-        previous_batch_ids = [b['id'] for b in all_batches[1:]]
-        latest_ips_raw = database.get_ips_by_batch_ids([latest_batch_id])
-        previous_ips_raw = database.get_ips_by_batch_ids(previous_batch_ids)
-        latest_ip_set = {ip['ip_address'] for ip in latest_ips_raw if ip}
-        previous_ip_set = {ip['ip_address'] for ip in previous_ips_raw if ip}
-        recurring_ip_addresses = latest_ip_set.intersection(previous_ip_set)
-        recurring_ip_details = [ip for ip in latest_ips_raw if ip and ip['ip_address'] in recurring_ip_addresses]
-        if not recurring_ip_details:
+        chunks = database.iter_recurring_ips()
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
             messagebox.showinfo("No Recurrence", "No recurring IPs found between the latest batch and all previous batches.")
             return
-        RecurrenceReportWindow(self, data=recurring_ip_details)
+        RecurrenceReportWindow(self, data=itertools.chain([first_chunk], chunks))
+
+    def open_cluster_report(self):
+        ClusterReportWindow(self)
 
     def delete_selected_batch(self):
         selected_batch_str = self.batch_combobox.get()
@@ -238,28 +277,61 @@ class HistoryWindow(ctk.CTkToplevel):
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to delete batch: {e}")
 
-    def export_to_csv(self):
+    def selected_batch_ids(self):
+        """ Returns the batch filter currently applied to the view ([] means all batches). """
+        choice = self.batch_combobox.get()
+        if not choice or choice == "All Batches":
+            return []
+        return [int(choice.split(":")[0])]
+
+    def export_data(self):
+        if self.export_job is not None:
+            messagebox.showwarning("Export Running", "An export is already in progress.", parent=self)
+            return
         file_path = filedialog.asksaveasfilename(
             defaultextension=".csv",
-            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")],
-            title="Save data as CSV"
+            filetypes=[("CSV files", "*.csv"), ("NDJSON files", "*.ndjson"), ("Columnar files", "*.ippc"), ("All files", "*.*")],
+            title="Export data"
         )
         if not file_path:
             return
-        try:
-            import csv
-            with open(file_path, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(self.columns)
-                for row in self.all_data:
-                    writer.writerow(tuple(row[col] for col in self.columns))
-            messagebox.showinfo("Success", f"Data successfully exported to\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to export data: {e}")
+
+        def on_progress(done, total):
+            if total:
+                self.after(0, lambda: self.export_progress.set(done / total))
+
+        def on_done(result):
+            self.after(0, self.export_finished, file_path, result)
+
+        self.export_job = exporter.ExportJob(file_path, self.selected_batch_ids(), self.columns, on_progress, on_done)
+        self.export_button.configure(state="disabled")
+        self.export_progress.set(0)
+        self.export_progress.pack(side="left", padx=5)
+        self.export_cancel_button.pack(side="left", padx=5)
+        self.export_job.start()
+
+    def cancel_export(self):
+        if self.export_job is not None:
+            self.export_job.cancel()
+            self.export_cancel_button.configure(state="disabled", text="Cancelling...")
+
+    def export_finished(self, file_path, result):
+        """ Runs on the main thread once the export worker has finished. """
+        self.export_job = None
+        if not self.winfo_exists():
+            return
+        self.export_progress.pack_forget()
+        self.export_cancel_button.pack_forget()
+        self.export_cancel_button.configure(state="normal", text="Cancel Export")
+        self.export_button.configure(state="normal")
+        if 'error' in result:
+            messagebox.showerror("Error", f"Failed to export data: {result['error']}", parent=self)
+        elif not result.get('cancelled'):
+            messagebox.showinfo("Success", f"{result['rows']} rows successfully exported to\n{file_path}", parent=self)
 
     def generate_pdf_report(self):
-        current_data = self.all_data
-        if not current_data:
+        batch_ids = self.selected_batch_ids()
+        if not database.count_ips_by_batch_ids(batch_ids):
             messagebox.showwarning("No Data", "There is no data to generate a report from.")
             return
         file_path = filedialog.asksaveasfilename(
@@ -269,42 +341,49 @@ class HistoryWindow(ctk.CTkToplevel):
         )
         if not file_path:
             return
+        report_title = self.batch_combobox.get()
+        self.pdf_report_button.configure(state="disabled", text="Generating...")
+        threading.Thread(target=self._run_pdf_report, args=(file_path, report_title, batch_ids), daemon=True).start()
+
+    def _run_pdf_report(self, file_path, report_title, batch_ids):
+        """ Worker: aggregates in SQL, renders charts in memory and streams the rows into the PDF. """
         try:
-            report_title = self.batch_combobox.get()
-            stats = {
-                "total_ips": len(current_data),
-                "malicious_count": sum(1 for row in current_data if row['is_malicious'] == 1),
-            }
-            country_counts = {}
-            for row in current_data:
-                if row['is_malicious'] == 1 and row['country'] and row['country'] != 'N/A':
-                    country_counts[row['country']] = country_counts.get(row['country'], 0) + 1
-            stats["top_country"] = max(country_counts, key=country_counts.get) if country_counts else "N/A"
-            top_malicious_ips = sorted(current_data, key=lambda row: row['fraud_score'] or 0, reverse=True)[:10]
-            temp_dir = tempfile.gettempdir()
-            graph_paths = {}
-            fig1 = Figure(figsize=(5, 4), dpi=100)
-            ax1 = fig1.add_subplot(111)
-            if country_counts:
-                ax1.pie(country_counts.values(), labels=country_counts.keys(), autopct='%1.1f%%', startangle=90)
-                ax1.set_title('Malicious IP Distribution')
+            high_risk_score = pdf_generator.high_risk_threshold()
+            cache_key = report_cache.compute_key("history_pdf", batch_ids, report_title, high_risk_score)
+            cached_path = report_cache.get(cache_key)
+            if cached_path:
+                shutil.copyfile(cached_path, file_path)
             else:
-                ax1.text(0.5, 0.5, 'No Malicious IPs', ha='center', va='center')
-            fig1.tight_layout()
-            pie_chart_path = os.path.join(temp_dir, "pie_chart.png")
-            fig1.savefig(pie_chart_path)
-            graph_paths['pie_chart'] = pie_chart_path
-            fig2 = Figure(figsize=(4, 3), dpi=100)
-            ax2 = fig2.add_subplot(111)
-            benign_count = stats['total_ips'] - stats['malicious_count']
-            ax2.bar(['Malicious', 'Benign'], [stats['malicious_count'], benign_count], color=['#e74c3c', '#2ecc71'])
-            ax2.set_title('Security Assessment')
-            ax2.set_ylabel('Count')
-            fig2.tight_layout()
-            bar_chart_path = os.path.join(temp_dir, "bar_chart.png")
-            fig2.savefig(bar_chart_path)
-            graph_paths['bar_chart'] = bar_chart_path
-            pdf_generator.create_report(file_path, report_title, stats, top_malicious_ips, graph_paths)
-            messagebox.showinfo("Success", f"PDF report successfully generated at\n{file_path}")
+                stats = database.get_report_stats(batch_ids)
+                country_counts = stats.pop("country_counts")
+                stats["top_country"] = next(iter(country_counts), "N/A")
+                benign_count = stats['total_ips'] - stats['malicious_count']
+                charts = {
+                    'pie_chart': report_cache.cached_chart("pie", [country_counts, 'Malicious IP Distribution'],
+                        lambda: pdf_generator.build_pie_chart(country_counts, 'Malicious IP Distribution', 'No Malicious IPs')),
+                    'bar_chart': report_cache.cached_chart("bar", [stats['malicious_count'], benign_count],
+                        lambda: pdf_generator.build_assessment_chart(stats['malicious_count'], benign_count)),
+                }
+                chunks = database.iter_ips_by_batch_ids(batch_ids, ("ip_address", "country", "isp", "fraud_score", "otx_pulses"))
+                # Rows come sorted by score, so the high-risk table ends at the first row below the threshold
+                high_risk = itertools.takewhile(lambda row: (row['fraud_score'] or 0) >= high_risk_score,
+                                                itertools.chain.from_iterable(chunks))
+                try:
+                    pdf_generator.create_report(file_path, report_title, stats, high_risk, charts)
+                finally:
+                    chunks.close()  # Releases the connection when the table stopped early
+                report_cache.put(cache_key, batch_ids, file_path, ".pdf")
+            result = {}
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate PDF report: {e}")
\ No newline at end of file
+            result = {'error': str(e)}
+        try:
+            self.after(0, self.pdf_report_finished, file_path, result)
+        except (RuntimeError, tkinter.TclError):
+            pass  # Window closed while the report was being generated.
+
+    def pdf_report_finished(self, file_path, result):
+        self.pdf_report_button.configure(state="normal", text="Generate PDF Report")
+        if 'error' in result:
+            messagebox.showerror("Error", f"Failed to generate PDF report: {result['error']}", parent=self)
+        else:
+            messagebox.showinfo("Success", f"PDF report successfully generated at\n{file_path}", parent=self)
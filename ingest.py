@@ -0,0 +1,178 @@
+import bz2
+import gzip
+import lzma
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ip_filter import IP_TOKEN_PATTERN, canonicalize
+
+# Matching on bytes skips decoding; IPv4 tokens are plain ASCII.
+IP_BYTES_REGEX = re.compile(IP_TOKEN_PATTERN.encode('ascii'))
+
+BLOCK_SIZE = 4 * 1024 * 1024        # Streaming read size for compressed input
+SPLIT_SIZE = 64 * 1024 * 1024       # Plain files larger than this are split across workers
+
+COMPRESSED_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+def _opener(path):
+    return COMPRESSED_OPENERS.get(os.path.splitext(path)[1].lower(), open)
+
+def open_text(path):
+    """ Opens a plain or .gz/.bz2/.xz file for streaming text reads. """
+    return _opener(path)(path, 'rt', encoding='utf-8', errors='ignore')
+
+def scan_bytes(data, stats, line_offset=0):
+    """
+    Counts every IP token in `data` (whole lines) into `stats` ({ip bytes: [count, first_line, last_line]},
+    1-based lines numbered from `line_offset`) and returns the line number reached.
+    """
+    line = line_offset + 1
+    position = 0
+    for match in IP_BYTES_REGEX.finditer(data):
+        start = match.start()
+        line += data.count(b"\n", position, start)
+        position = start
+        entry = stats.get(match.group())
+        if entry is None:
+            stats[match.group()] = [1, line, line]
+        else:
+            entry[0] += 1
+            entry[2] = line
+    return line_offset + data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+
+def decode_stats(stats):
+    """ Turns scan_bytes() output into {ip: (count, first_line, last_line)}. """
+    return {ip.decode('ascii'): tuple(entry) for ip, entry in stats.items()}
+
+def _extract_stream(path):
+    """ Worker: decompresses a whole file block by block, never holding more than one block. """
+    stats = {}
+    line = 0
+    carry = b""
+    with _opener(path)(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            block = carry + block
+            end = block.rfind(b"\n") + 1
+            carry = block[end:] if end else block
+            line = scan_bytes(block[:end], stats, line)
+            if len(carry) > BLOCK_SIZE:  # A single enormous line; don't let it grow unbounded
+                scan_bytes(carry, stats, line)
+                carry = b""
+    line = scan_bytes(carry, stats, line)
+    return decode_stats(stats), line
+
+def _extract_range(path, start, end):
+    """
+    Worker: extracts the lines of a plain file that start inside [start, end), numbered from 1
+    within the range. A line straddling `start` belongs to the previous range, which reads
+    past `end` to finish it.
+    """
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        data = f.read(max(0, end - position)) if position < end else b""
+        if data and not data.endswith(b"\n"):
+            data += f.readline()
+    stats = {}
+    lines = scan_bytes(data, stats)
+    return decode_stats(stats), lines
+
+def merge_stats(into, stats, line_offset=0):
+    """
+    Folds per-IP (count, first_line, last_line) stats that come *after* everything already in
+    `into`, shifting their line numbers by `line_offset`.
+    """
+    for ip, (count, first, last) in stats.items():
+        entry = into.get(ip)
+        if entry is None:
+            into[ip] = (count, first + line_offset, last + line_offset)
+        else:
+            into[ip] = (entry[0] + count, entry[1], last + line_offset)
+    return into
+
+def canonicalize_stats(stats):
+    """ Re-keys stats by canonical address, merging spellings such as "010.0.0.1" and "10.0.0.1". """
+    canonical = {}
+    for ip, (count, first, last) in stats.items():
+        key = canonicalize(ip)
+        if key is None:
+            continue
+        entry = canonical.get(key)
+        if entry is None:
+            canonical[key] = (count, first, last)
+        else:
+            canonical[key] = (entry[0] + count, min(entry[1], first), max(entry[2], last))
+    return canonical
+
+def _work_items(paths):
+    """ One item per compressed file, and one per SPLIT_SIZE range of a large plain file. """
+    items = []
+    for path in paths:
+        if _opener(path) is not open:
+            items.append((path, _extract_stream, (path,)))
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), SPLIT_SIZE):
+            items.append((path, _extract_range, (path, start, min(start + SPLIT_SIZE, size))))
+    return items
+
+def get_worker_count():
+    value = os.getenv("INGEST_WORKERS", "").strip()
+    return int(value) if value.isdigit() and int(value) > 0 else (os.cpu_count() or 1)
+
+def extract_ip_stats_from_files(paths, log=print):
+    """
+    Extracts every IPv4-looking token from many plain or compressed files, spreading files
+    (and ranges of large plain files) across a process pool. Per-worker results are merged
+    into one {ip: (occurrences, first_line, last_line)} dict in a single pass. Line numbers
+    are counted within each file; across merged files the first/last line is the one in the
+    first/last file (in the given order) that contains the IP. Unreadable files are
+    reported through `log` and skipped.
+    """
+    items = []
+    for path in paths:
+        try:
+            items.extend(_work_items([path]))
+        except OSError as e:
+            log(f"Warning: skipping '{os.path.basename(path)}': {e}")
+
+    results = [None] * len(items)
+    workers = min(get_worker_count(), len(items))
+    if workers <= 1:
+        for index, (path, func, args) in enumerate(items):
+            try:
+                results[index] = func(*args)
+            except (OSError, EOFError, ValueError, lzma.LZMAError) as e:
+                log(f"Warning: could not read '{os.path.basename(path)}': {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(func, *args): index for index, (path, func, args) in enumerate(items)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except (OSError, EOFError, ValueError, lzma.LZMAError) as e:
+                    log(f"Warning: could not read '{os.path.basename(items[index][0])}': {e}")
+
+    # Ranges of one file are consecutive, so their line numbers continue from the previous range
+    merged = {}
+    line_offset, current_path = 0, None
+    for (path, _, _), result in zip(items, results):
+        if path != current_path:
+            line_offset, current_path = 0, path
+        if result is None:
+            continue
+        stats, lines = result
+        merge_stats(merged, stats, line_offset)
+        line_offset += lines
+    return merged
@@ -0,0 +1,156 @@
+import os
+from array import array
+from bisect import bisect_right
+
+# --- IPv4 special-purpose / non-routable ranges (RFC 6890 and friends) ---
+BOGON_CIDRS = (
+    "0.0.0.0/8",        # "This" network
+    "10.0.0.0/8",       # Private
+    "100.64.0.0/10",    # Carrier-grade NAT
+    "127.0.0.0/8",      # Loopback
+    "169.254.0.0/16",   # Link-local
+    "172.16.0.0/12",    # Private
+    "192.0.0.0/24",     # IETF protocol assignments
+    "192.0.2.0/24",     # TEST-NET-1
+    "192.88.99.0/24",   # 6to4 relay anycast
+    "192.168.0.0/16",   # Private
+    "198.18.0.0/15",    # Benchmarking
+    "198.51.100.0/24",  # TEST-NET-2
+    "203.0.113.0/24",   # TEST-NET-3
+    "224.0.0.0/4",      # Multicast
+    "240.0.0.0/4",      # Reserved + limited broadcast
+)
+
+# IPv4-looking token that is not part of a longer dotted number such as a version string "1.2.3.4.5".
+IP_TOKEN_PATTERN = r'(?<![\d.])(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?!\.?\d)'
+
+def ip_to_int(ip):
+    """
+    Converts a dotted IPv4 string into a 32-bit integer (ValueError if malformed).
+    Octets are read as decimal, so zero-padded forms such as "010.001.002.003" are accepted.
+    """
+    parts = ip.split(".")
+    if len(parts) != 4:
+        raise ValueError(f"Invalid IPv4 address: {ip}")
+    value = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3:
+            raise ValueError(f"Invalid IPv4 address: {ip}")
+        octet = int(part)
+        if octet > 255:
+            raise ValueError(f"Invalid IPv4 address: {ip}")
+        value = (value << 8) | octet
+    return value
+
+def int_to_ip(value):
+    return f"{value >> 24 & 255}.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+
+def canonicalize(ip):
+    """ Returns the canonical dotted form of an IPv4 string, or None if it is not a valid address. """
+    try:
+        return int_to_ip(ip_to_int(ip.strip()))
+    except ValueError:
+        return None
+
+def parse_cidr(cidr):
+    """ Parses "a.b.c.d/len" or a bare address into an inclusive (start, end) integer range. """
+    address, _, prefix = cidr.strip().partition("/")
+    prefix_len = int(prefix) if prefix else 32
+    if not 0 <= prefix_len <= 32:
+        raise ValueError(f"Invalid CIDR prefix: {cidr}")
+    mask = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+    start = ip_to_int(address) & mask
+    return start, start | (~mask & 0xFFFFFFFF)
+
+class CidrSet:
+    """ A set of CIDR blocks merged into sorted, disjoint integer ranges. """
+    def __init__(self, cidrs=()):
+        ranges = sorted(parse_cidr(cidr) for cidr in cidrs)
+        self.starts = array("L")
+        self.ends = array("L")
+        for start, end in ranges:
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, ip_int):
+        index = bisect_right(self.starts, ip_int) - 1
+        return index >= 0 and ip_int <= self.ends[index]
+
+    def members(self, sorted_ints):
+        """
+        Range-checks a whole sorted column of addresses in one merge sweep over the
+        ranges (O(n + m)) and returns a parallel list of booleans.
+        """
+        result = [False] * len(sorted_ints)
+        range_index, range_count = 0, len(self.starts)
+        for i, value in enumerate(sorted_ints):
+            while range_index < range_count and self.ends[range_index] < value:
+                range_index += 1
+            if range_index == range_count:
+                break
+            result[i] = self.starts[range_index] <= value
+        return result
+
+def parse_cidr_list(value):
+    """ Splits a comma/whitespace separated list of CIDRs, ignoring invalid entries. """
+    cidrs = []
+    for item in value.replace(",", " ").split():
+        try:
+            parse_cidr(item)
+            cidrs.append(item)
+        except ValueError:
+            print(f"Warning: ignoring invalid CIDR '{item}'.")
+    return cidrs
+
+_bogons = CidrSet(BOGON_CIDRS)
+
+def classify_ips(raw_ips, allowlist=None, denylist=None, drop_bogons=True):
+    """
+    Validates, canonicalizes and de-duplicates extracted addresses, then drops bogons,
+    addresses outside a non-empty allowlist, and addresses on the denylist (deny wins).
+    Returns {'accepted': [...], 'invalid': n, 'duplicates': n, 'bogons': n, 'not_allowed': n, 'denied': n}.
+    """
+    allowlist = allowlist if allowlist is not None else CidrSet()
+    denylist = denylist if denylist is not None else CidrSet()
+    result = {'accepted': [], 'invalid': 0, 'duplicates': 0, 'bogons': 0, 'not_allowed': 0, 'denied': 0}
+
+    unique_ints = set()
+    seen = 0
+    for ip in raw_ips:
+        try:
+            unique_ints.add(ip_to_int(ip.strip()))
+            seen += 1
+        except ValueError:
+            result['invalid'] += 1
+    result['duplicates'] = seen - len(unique_ints)
+
+    column = sorted(unique_ints)
+    is_bogon = _bogons.members(column) if drop_bogons else [False] * len(column)
+    is_allowed = allowlist.members(column) if len(allowlist) else [True] * len(column)
+    is_denied = denylist.members(column) if len(denylist) else [False] * len(column)
+
+    for value, bogon, allowed, denied in zip(column, is_bogon, is_allowed, is_denied):
+        if bogon:
+            result['bogons'] += 1
+        elif denied:
+            result['denied'] += 1
+        elif not allowed:
+            result['not_allowed'] += 1
+        else:
+            result['accepted'].append(int_to_ip(value))
+    return result
+
+def classify_from_settings(raw_ips):
+    """ Runs classify_ips() with the allow/deny lists and bogon switch configured in .env. """
+    return classify_ips(
+        raw_ips,
+        allowlist=CidrSet(parse_cidr_list(os.getenv("IP_ALLOWLIST", ""))),
+        denylist=CidrSet(parse_cidr_list(os.getenv("IP_DENYLIST", ""))),
+        drop_bogons=os.getenv("DROP_BOGONS", "true").strip().lower() not in ("0", "false", "no"),
+    )
@@ -0,0 +1,475 @@
+import asyncio
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import api
+import budget
+import database
+import geoip
+import ingest
+import ip_filter
+import metrics
+import profiling
+import report_cache
+
+SKIPPED_LOG_LIMIT = 50  # Individual skipped IPs listed in the log before summarizing
+
+# --- Job states ---
+QUEUED = "Queued"
+RUNNING = "Running"
+DONE = "Done"
+CANCELLED = "Cancelled"
+FAILED = "Failed"
+
+_job_ids = itertools.count(1)
+
+def _max_concurrent_jobs():
+    value = os.getenv("MAX_CONCURRENT_JOBS", "").strip()
+    return max(1, int(value)) if value.isdigit() else 3
+
+class AnalysisJob:
+    """
+    One file analyzed into its own import batch. Progress and log lines are reported through
+    the queue's `on_update(job, message)` callback. It is called on the queue's loop thread, but
+    also from a worker thread while the blocking stage (_prepare) runs, so it must be
+    thread-safe (the app hands every update to the GUI thread). `last_api_error` holds the
+    latest failed IPQS reply, for status displays.
+
+    Several files can be merged into one batch by passing them as `source_paths` (with
+    `file_path` naming the set); they are extracted in parallel by ingest.py.
+    Micro-batches (see log_watcher.py) pass already extracted `ip_stats`
+    ({ip: (occurrences, first_line, last_line)}) and the `batch_id` they append to; jobs sharing a `group` are shown as one row, and `on_done(job)` runs on the
+    queue's loop when the job ends.
+
+    Stage timings, provider latencies and cache outcomes are collected in `run_metrics`
+    (a fresh metrics.RunMetrics unless one is shared, e.g. by a watch session) and exported
+    per batch when the job ends.
+    """
+    def __init__(self, file_path, description, api_key_otx, cache_duration_hours,
+                 ip_stats=None, batch_id=None, group=None, on_done=None, source_paths=None, run_metrics=None):
+        self.id = next(_job_ids)
+        self.file_path = file_path
+        self.source_paths = source_paths or [file_path]
+        self.name = os.path.basename(file_path.rstrip("/\\"))
+        if source_paths:
+            self.name = f"{self.name} ({len(source_paths)} files)"
+        self.description = description
+        self.api_key_otx = api_key_otx
+        self.cache_duration_hours = cache_duration_hours
+        self.ip_stats = ip_stats
+        self.occurrences = {}
+        self.group = group
+        self.on_done = on_done
+        self.metrics = run_metrics or metrics.RunMetrics()
+        self.profile = None
+
+        self.status = QUEUED
+        self.batch_id = batch_id
+        self.total = 0
+        self.processed = 0
+        self.ipqs_calls = 0
+        self.exc_info = None
+        self.last_api_error = None
+        self.future = None
+        self.queue = None
+
+    @property
+    def progress(self):
+        if self.status == DONE:
+            return 1.0
+        return self.processed / self.total if self.total else 0.0
+
+    def is_active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def cancel(self):
+        """ Thread-safe: cancels the job's task on the queue's event loop. """
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+    def log(self, message):
+        self.queue.on_update(self, message)
+
+    def advance(self, count=1):
+        self.processed += count
+        self.queue.on_update(self, None)
+
+    async def run(self, queue):
+        self.queue = queue
+        try:
+            async with queue.job_slots:
+                self.status = RUNNING
+                self.log(f"--- Analysis Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+                if profiling.is_enabled():
+                    self._start_profile()
+                await self._analyze()
+            self.status = DONE
+            self.log("--- Analysis Complete! ---")
+        except InterruptedError as e:
+            self.status = DONE
+            self.log(f"--- {e} ---")
+        except asyncio.CancelledError:
+            self.status = CANCELLED
+            self.log("--- Analysis cancelled by user. ---")
+        except Exception:
+            self.status = FAILED
+            self.exc_info = sys.exc_info()
+            self.log(f"--- Analysis failed: {self.exc_info[1]} ---")
+        finally:
+            if self.batch_id is not None:
+                report_cache.invalidate_batches([self.batch_id])
+                self._export_metrics()
+            if self.profile:
+                self._finish_profile()
+            if self.on_done:
+                self.on_done(self)
+
+    def _prepare(self):
+        """
+        Blocking half of the job, run in a worker thread: extraction, classification,
+        offline enrichment and the per-provider cache check.
+        Returns (pending lookups, IP rows to link without a lookup as (row, label) pairs).
+        """
+        if self.batch_id is None:
+            self.batch_id = database.add_import_batch(datetime.now().isoformat(), self.name, self.description)
+
+        if self.ip_stats is not None:
+            self.log(f"Found {len(self.ip_stats)} new IP candidates appended to '{self.name}'.")
+        else:
+            with self.metrics.stage("extraction"):
+                self.ip_stats = ingest.extract_ip_stats_from_files(self.source_paths, log=self.log)
+            self.log(f"Found {len(self.ip_stats)} unique IP candidates in '{self.name}'.")
+        raw_ips = list(self.ip_stats)
+
+        # --- Classification: only routable, unique, non-excluded IPs reach the APIs ---
+        with self.metrics.stage("classification"):
+            classification = ip_filter.classify_from_settings(raw_ips)
+        all_ips_in_file = classification['accepted']
+        self.total = len(all_ips_in_file)
+        self.log(
+            f"Filtered: {classification['invalid']} invalid, {classification['duplicates']} duplicates, "
+            f"{classification['bogons']} bogons, {classification['denied']} denied, "
+            f"{classification['not_allowed']} outside allowlist -> {self.total} IPs to analyze."
+        )
+        if self.total == 0:
+            raise InterruptedError("No routable IPs left to analyze.")
+        # Occurrence counts and line numbers, keyed like the accepted IPs
+        self.occurrences = ingest.canonicalize_stats(self.ip_stats)
+
+        # --- Offline enrichment: geo/ASN context for every IP without spending credits ---
+        offline_geo = {}
+        geo_engine = geoip.get_engine()
+        if geo_engine.is_loaded():
+            with self.metrics.stage("enrichment"):
+                offline_geo = geo_engine.enrich(all_ips_in_file)
+                database.bulk_enrich_ip_records([(ip, *info) for ip, info in offline_geo.items()])
+            self.log(f"Offline GeoIP/ASN: enriched {len(offline_geo)} of {self.total} IPs locally.")
+
+        # --- Per-provider freshness: each IP only queries the providers whose data is stale ---
+        ttls = budget.get_provider_ttls(self.cache_duration_hours)
+        now = datetime.now()
+        pending, linked = [], []
+
+        self.log("Checking database for cached data...")
+        cache_check_started = time.perf_counter()
+        cached_ips_map = {row['ip_address']: row for row in database.find_ip_details_bulk(all_ips_in_file)}
+        cached_count = failed_count = feed_count = 0
+        for ip in all_ips_in_file:
+            details = cached_ips_map.get(ip)
+            providers = budget.stale_providers(details, ttls, now, otx_enabled=bool(self.api_key_otx))
+            if not providers and budget.fresh_reputation_source(details, ttls, now) == budget.PROVIDER_FEED:
+                linked.append((details, f"FEED: {details['feed_source']}"))
+                feed_count += 1
+            elif not providers:
+                linked.append((details, "CACHED"))
+                cached_count += 1
+            # Lookups that failed recently wait out their (growing) retry delay
+            elif budget.PROVIDER_IPQS in providers and api.is_negatively_cached(details, now):
+                linked.append((details, f"FAILED RECENTLY: {details['last_error_class']}"))
+                failed_count += 1
+            else:
+                pending.append({'ip': ip, 'details': details, 'providers': providers,
+                                'occurrences': self.occurrences.get(ip, (0,))[0]})
+        self.metrics.add_stage("cache_check", time.perf_counter() - cache_check_started)
+        if cached_count:
+            self.log(f"Found {cached_count} fresh IPs in cache.")
+        if feed_count:
+            self.log(f"Found {feed_count} IPs covered by imported reputation feeds.")
+        if failed_count:
+            self.log(f"Not retrying {failed_count} IPs whose last lookup failed recently.")
+
+        # --- IPs placed offline in a skipped country are linked without an IPQS lookup ---
+        skip_countries = geoip.get_skip_countries()
+        if skip_countries and offline_geo:
+            remaining, offline_count = [], 0
+            for ip_info in pending:
+                geo = offline_geo.get(ip_info['ip'])
+                if ip_info['details'] and geo and ('*' in skip_countries or geo[0] in skip_countries):
+                    # OTX is free, so a stale pulse count is still refreshed
+                    if budget.PROVIDER_OTX in ip_info['providers']:
+                        remaining.append({**ip_info, 'providers': {budget.PROVIDER_OTX}})
+                    else:
+                        linked.append((ip_info['details'], "OFFLINE GEO"))
+                        offline_count += 1
+                else:
+                    remaining.append(ip_info)
+            pending = remaining
+            if offline_count:
+                self.log(f"Skipping IPQS for {offline_count} IPs covered by offline GeoIP data.")
+            self.metrics.incr("cache_lookups_total", offline_count, result=metrics.CACHE_OFFLINE)
+
+        self.metrics.incr("cache_lookups_total", cached_count, result=metrics.CACHE_FRESH)
+        self.metrics.incr("cache_lookups_total", feed_count, result=metrics.CACHE_FEED)
+        self.metrics.incr("cache_lookups_total", failed_count, result=metrics.CACHE_NEGATIVE)
+        new_count = sum(1 for info in pending if not info['details'])
+        self.metrics.incr("cache_lookups_total", new_count, result=metrics.CACHE_NEW)
+        self.metrics.incr("cache_lookups_total", len(pending) - new_count, result=metrics.CACHE_STALE)
+        return pending, linked
+
+    def _link(self, ip_id, ip):
+        with self.metrics.stage("link"):
+            database.link_ip_to_batch(ip_id, self.batch_id, *self.occurrences.get(ip, (None, None, None)))
+
+    def _link_without_lookup(self, linked):
+        for details, label in linked:
+            self._link(details['id'], details['ip_address'])
+            self.log(f"({self.processed + 1}/{self.total}) Processing IP: {details['ip_address']}... -> [{label}]")
+            self.advance()
+
+    def _apply_plan(self, plan):
+        """ Logs and records what the credit budget left out; returns (stale rows to link, OTX-only downgrades). """
+        stale_skipped, downgraded, never_seen = [], [], []
+        for info in plan.skipped:
+            if not info['details'] or not info['details']['ipqs_checked_at']:
+                never_seen.append(info['ip'])
+            elif budget.PROVIDER_OTX in info['providers']:
+                downgraded.append({**info, 'providers': {budget.PROVIDER_OTX}})
+            else:
+                stale_skipped.append((info['details'], "STALE"))
+        database.record_skipped_ips(self.batch_id, [(ip, plan.limit_reason) for ip in never_seen])
+        self.metrics.incr("budget_skipped_total", len(plan.skipped))
+        self.log(
+            f"[BUDGET] {plan.limit_reason} allows {plan.budget} lookups: querying {len(plan.to_query)}, "
+            f"skipping {len(plan.skipped)} IPQS lookups ({len(plan.skipped) - len(never_seen)} stale kept from cache, {len(never_seen)} never seen)."
+        )
+        for info in plan.skipped[:SKIPPED_LOG_LIMIT]:
+            self.log(f" -> [SKIPPED] {info['ip']}")
+        if len(plan.skipped) > SKIPPED_LOG_LIMIT:
+            self.log(f" -> ... and {len(plan.skipped) - SKIPPED_LOG_LIMIT} more.")
+        # Never-seen IPs are not part of the batch, so they no longer count towards its progress
+        self.total -= len(never_seen)
+        return stale_skipped, downgraded
+
+    def progress_callback(self, ip_info):
+        self.log(f"({self.processed + 1}/{self.total}) Processing IP: {ip_info['ip']}...")
+        if ip_info.get('otx_only'):
+            self.log(f" -> OTX refresh: Pulses={ip_info['result']['pulses']}")
+        elif 'result' in ip_info:
+            if not ip_info.get('shared'):
+                self.ipqs_calls += 1  # A joined lookup was paid for by whoever ran it
+            res = ip_info['result']
+            self.log(f" -> IPQS: Score={res['score']}, Country={res['country']}")
+            if self.api_key_otx: self.log(f" -> OTX: Pulses={res['pulses']}")
+        else:
+            self.last_api_error = ip_info.get('error', 'Unknown')
+            self.log(f" -> [API ERROR] Could not get IPQS data ({ip_info.get('error_class', 'api')}): {self.last_api_error}")
+
+    def _link_result(self, result, ip):
+        if result and result.get('ip_id'):
+            self._link(result['ip_id'], ip)
+
+    def lookup_done(self, result, info):
+        self._link_result(result, info['ip'])
+        self.advance()
+
+    async def _wait_for_shared(self, info, future):
+        result = await asyncio.shield(future)
+        self._link_result(result, info['ip'])
+        self.log(f"({self.processed + 1}/{self.total}) Processing IP: {info['ip']}... -> [SHARED WITH ANOTHER JOB]")
+        self.advance()
+        return result
+
+    async def _analyze(self):
+        loop = asyncio.get_running_loop()
+        prepare = functools.partial(self.profile.call, self._prepare) if self.profile else self._prepare
+        pending, linked = await loop.run_in_executor(None, prepare)
+        if self.profile:
+            self.profile.checkpoint("after extraction and cache check")
+
+        planning_started = time.perf_counter()
+        async with self.queue.plan_lock:
+            # --- IPs another job is already looking up are shared instead of bought twice ---
+            shared, own = [], []
+            for info in pending:
+                future = self.queue.inflight_future(info)
+                if future:
+                    shared.append((info, future))
+                else:
+                    own.append(info)
+            if shared:
+                self.log(f"{len(shared)} IPs are already being looked up by another queued job; sharing those results.")
+                self.metrics.incr("shared_lookups_total", len(shared))
+
+            # --- Credit budget: query the most valuable IPs first, report exactly what was skipped ---
+            ipqs_pending = [info for info in own if budget.PROVIDER_IPQS in info['providers']]
+            to_query = [info for info in own if budget.PROVIDER_IPQS not in info['providers']]
+            reserved = 0
+            if ipqs_pending:
+                credits_remaining = await api.get_ipqs_credits_remaining_async(self.queue.session)
+                plan = budget.plan_queries(ipqs_pending, credits_remaining, reserved=self.queue.reserved_credits)
+                to_query = plan.to_query + to_query
+                reserved = len(plan.to_query)
+                if plan.is_limited():
+                    stale_skipped, downgraded = self._apply_plan(plan)
+                    linked += stale_skipped
+                    to_query += downgraded
+            self.queue.reserved_credits += reserved
+            # Registered before the lock is released, so later jobs see these as in flight
+            lookups = [self.queue.start_lookup(self, info) for info in to_query]
+        self.metrics.add_stage("planning", time.perf_counter() - planning_started)
+
+        try:
+            self._link_without_lookup(linked)
+
+            if to_query or shared:
+                otx_only_count = sum(1 for info in to_query if budget.PROVIDER_IPQS not in info['providers'])
+                self.log(f"Querying APIs for {len(to_query)} new/stale IPs ({otx_only_count} need only an OTX refresh)...")
+            with self.metrics.stage("lookups"):
+                results = await asyncio.gather(*lookups, *[self._wait_for_shared(info, future) for info, future in shared],
+                                               return_exceptions=True)
+        finally:
+            database.add_api_usage(budget.PROVIDER_IPQS, self.ipqs_calls)
+            self.queue.reserved_credits -= reserved
+
+        # --- Re-analyzed rows may belong to older batches too; drop their cached reports ---
+        report_cache.invalidate_ips([res['ip_id'] for res in results if isinstance(res, dict) and res.get('ip_id')])
+
+    def _start_profile(self):
+        profile = profiling.ProfileSession(self.name)
+        if profile.start(asyncio.get_running_loop()):
+            self.profile = profile
+            self.log("[PROFILE] Profiling this run (cProfile, task timing, tracemalloc).")
+        else:
+            self.log("[PROFILE] Another job is being profiled; this one runs unprofiled.")
+
+    def _finish_profile(self):
+        # Never lets a profiling problem keep run() from reaching on_done
+        try:
+            path = self.profile.stop(self.batch_id)
+            self.log(f"[PROFILE] Report written to '{path}'.")
+        except Exception as e:
+            self.log(f"Warning: could not write profile report: {e}")
+        finally:
+            self.profile = None
+
+    def _export_metrics(self):
+        """ Persists the run summary on the batch and writes the JSON/Prometheus metrics files. """
+        summary = self.metrics.summary()
+        database.save_batch_run_summary(self.batch_id, summary)
+        try:
+            path = metrics.export(self.metrics, self.batch_id)
+        except OSError as e:
+            self.log(f"Warning: could not write metrics: {e}")
+            return
+        if summary['cache_hit_ratio'] is not None:
+            self.log(f"Metrics: cache hit ratio {summary['cache_hit_ratio']:.0%}, written to '{path}'.")
+
+class JobQueue:
+    """
+    Runs AnalysisJobs concurrently (MAX_CONCURRENT_JOBS at a time) on one background event loop.
+    All jobs share a single HTTP session, the per-provider rate limiters, the credit reservation
+    and an in-flight map, so an IP queued in several files is looked up only once and then
+    linked to every batch it belongs to.
+    """
+    def __init__(self, on_update):
+        self.on_update = on_update
+        self.jobs = []
+        self.inflight = {}
+        self.reserved_credits = 0
+        self.loop = None
+        self.thread = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open())
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.session.close())
+            self.loop.close()
+
+    async def _open(self):
+        self.session = api.create_session()
+        self.limiters = api.get_rate_limiters()
+        self.job_slots = asyncio.Semaphore(_max_concurrent_jobs())
+        self.plan_lock = asyncio.Lock()
+
+    def start(self):
+        """ Starts the background loop if it is not running yet (thread-safe). """
+        with self._start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run_loop, daemon=True)
+                self.thread.start()
+                self._ready.wait()
+
+    def submit(self, job):
+        """ Queues a job (thread-safe); the background loop is started on first use. """
+        self.start()
+        with self._start_lock:
+            job.queue = self
+            # Finished jobs are dropped so long watch sessions do not accumulate them
+            self.jobs = [queued for queued in self.jobs if queued.is_active()] + [job]
+        job.future = asyncio.run_coroutine_threadsafe(job.run(self), self.loop)
+        self.on_update(job, None)
+        return job
+
+    def is_busy(self):
+        return any(job.is_active() for job in self.jobs)
+
+    def shutdown(self):
+        for job in self.jobs:
+            job.cancel()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # --- Cross-job lookup dedupe (event loop thread only) ---
+    def inflight_future(self, info):
+        """ The pending lookup of this IP that covers every provider `info` needs, if any. """
+        entry = self.inflight.get(info['ip'])
+        if entry is not None and info['providers'] <= entry[0]:
+            return entry[1]
+        return None
+
+    def start_lookup(self, job, info):
+        """
+        Starts looking up one IP for `job` and registers it so other jobs can share the result.
+        `job` is an AnalysisJob or any client with the same api_key_otx, progress_callback,
+        metrics and lookup_done(result, info) members (see lookup_service.py).
+        """
+        future = self.loop.create_future()
+        self.inflight[info['ip']] = (info['providers'], future)
+        task = asyncio.ensure_future(self._lookup(job, info, future))
+        task.set_name(f"lookup {info['ip']}")
+        return task
+
+    async def _lookup(self, job, info, future):
+        result = None
+        try:
+            result = await api.process_single_ip_and_save(self.session, info, job.api_key_otx, job.progress_callback,
+                                                       self.limiters, job.metrics)
+            job.lookup_done(result, info)
+            return result
+        finally:
+            if not future.done():
+                future.set_result(result)
+            if self.inflight.get(info['ip'], (None, None))[1] is future:
+                del self.inflight[info['ip']]
@@ -0,0 +1,203 @@
+import os
+import threading
+from datetime import datetime
+
+import database
+import ingest
+import job_queue
+import metrics
+
+READ_LIMIT = 16 * 1024 * 1024  # Bytes read per file per poll; the rest waits for the next poll
+SEEN_LIMIT = 200000            # IPs remembered per watch session before the set is reset
+
+def _env_number(name, default):
+    value = os.getenv(name, "").strip()
+    try:
+        return max(1, float(value)) if value else default
+    except ValueError:
+        return default
+
+def _file_id(stat_result):
+    """ Identifies the file behind a path so a rotated (renamed/recreated) log is noticed. """
+    return f"{stat_result.st_dev}:{stat_result.st_ino}"
+
+class TailReader:
+    """
+    Follows one growing log file from a persisted byte offset (and the line number reached
+    there, so occurrence line numbers stay file-relative). Only complete lines are consumed. If the file is rotated, whatever was appended to the old file is drained
+    before following the new one. If it is truncated in place, reading restarts at zero.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.handle = None
+        self.file_id = None
+        self.offset = 0
+        self.line_no = 0
+
+    def _open(self, resume=True):
+        self.handle = open(self.path, 'rb')
+        stat_result = os.fstat(self.handle.fileno())
+        self.file_id = _file_id(stat_result)
+        self.offset = self.line_no = 0
+        saved = database.get_watch_offset(self.path) if resume else None
+        if saved and saved[0] == self.file_id and saved[1] <= stat_result.st_size:
+            self.offset, self.line_no = saved[1], saved[2]
+
+    def position(self):
+        return (self.file_id, self.offset, self.line_no)
+
+    def _read_available(self, stats, final=False):
+        self.handle.seek(self.offset)
+        data = self.handle.read(READ_LIMIT)
+        if not final:
+            # Leave a trailing partial line for the next poll (unless one line fills the whole read)
+            end = data.rfind(b"\n") + 1
+            if end or len(data) < READ_LIMIT:
+                data = data[:end]
+        self.offset += len(data)
+        self.line_no = ingest.scan_bytes(data, stats, self.line_no)
+
+    def read_new_stats(self):
+        """
+        Scans what was appended since the last call and returns its IPs as
+        {ip: (count, first_line, last_line)} (empty if nothing new or the file is missing).
+        """
+        stats = {}
+        if self.handle is None:
+            try:
+                self._open()
+            except OSError:
+                return {}
+        self._read_available(stats)
+        try:
+            stat_result = os.stat(self.path)
+        except OSError:
+            return ingest.decode_stats(stats)  # Mid-rotation: keep the old handle until the new file appears
+
+        if _file_id(stat_result) != self.file_id:
+            self._read_available(stats, final=True)
+            self.close()
+            try:
+                self._open(resume=False)
+                self._read_available(stats)
+            except OSError:
+                pass
+        elif stat_result.st_size < self.offset:
+            self.offset = self.line_no = 0
+            self._read_available(stats)
+        return ingest.decode_stats(stats)
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+
+class WatchedFile:
+    """ A TailReader plus the batch its micro-batches are appended to. """
+    def __init__(self, path, batch_id):
+        self.reader = TailReader(path)
+        self.batch_id = batch_id
+        self.pending = {}
+        self.seen = set()
+        self.repeats = {}  # Further sightings of already submitted IPs, added to their links later
+        self.active_job = None
+        self.active_stats = {}  # The IPs of active_job, handed back to pending if it does not finish
+        self.saved_offset = None
+        self.metrics = metrics.RunMetrics()  # Accumulated over the watch session's micro-batches
+
+    def is_busy(self):
+        # The job's future completes only after on_done has run (and also if it was cancelled before starting)
+        return self.active_job is not None and (self.active_job.future is None or not self.active_job.future.done())
+
+    def requeue_unfinished(self):
+        """ Puts the IPs of a failed or cancelled micro-batch back into pending, with any sightings collected meanwhile. """
+        job, self.active_job = self.active_job, None
+        if job is None or job.status == job_queue.DONE:
+            return
+        failed, self.active_stats = self.active_stats, {}
+        self.seen.difference_update(failed)
+        ingest.merge_stats(self.pending, failed)
+        ingest.merge_stats(self.pending, {ip: self.repeats.pop(ip) for ip in failed if ip in self.repeats})
+
+class LogWatcher:
+    """
+    Polls the watched files every WATCH_POLL_SECONDS and feeds newly appended IPs into the
+    job queue as micro-batches of at most WATCH_MAX_BATCH_IPS. Each file gets one import
+    batch per watch session. Only one micro-batch per file is in flight, and its offset is
+    persisted once that micro-batch has been analyzed, so a restart resumes where it stopped.
+    """
+    def __init__(self, paths, description, queue, api_key_otx, cache_duration_hours, log):
+        self.queue = queue
+        self.api_key_otx = api_key_otx
+        self.cache_duration_hours = cache_duration_hours
+        self.log = log
+        self.poll_seconds = _env_number("WATCH_POLL_SECONDS", 5)
+        self.max_batch_ips = int(_env_number("WATCH_MAX_BATCH_IPS", 500))
+        self.stop_event = threading.Event()
+        self.files = []
+        for path in paths:
+            file_name = f"{os.path.basename(path)} (watch)"
+            batch_id = database.add_import_batch(datetime.now().isoformat(), file_name, description)
+            self.files.append(WatchedFile(path, batch_id))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        self.log(f"[WATCH] Watching {len(self.files)} file(s), polling every {self.poll_seconds:g}s.")
+        try:
+            while not self.stop_event.is_set():
+                for watched in self.files:
+                    self._poll(watched)
+                self.stop_event.wait(self.poll_seconds)
+        finally:
+            for watched in self.files:
+                watched.reader.close()
+            self.log("[WATCH] Stopped watching.")
+
+    def _poll(self, watched):
+        stats = watched.reader.read_new_stats()
+        if stats:
+            ingest.merge_stats(watched.pending, {ip: entry for ip, entry in stats.items() if ip not in watched.seen})
+            ingest.merge_stats(watched.repeats, {ip: entry for ip, entry in stats.items() if ip in watched.seen})
+        if watched.is_busy():
+            return
+        watched.requeue_unfinished()
+        if watched.repeats:
+            database.add_link_occurrences(watched.batch_id, ingest.canonicalize_stats(watched.repeats))
+            watched.repeats = {}
+        if not stats and not watched.pending and watched.reader.handle is not None:
+            # Nothing new or in flight (e.g. only known IPs were appended): persist the offset as-is
+            self._save_offset(watched, watched.reader.position())
+
+        if not watched.pending:
+            return
+        ips = sorted(watched.pending)[:self.max_batch_ips]
+        ip_stats = {ip: watched.pending.pop(ip) for ip in ips}
+        if len(watched.seen) > SEEN_LIMIT:
+            watched.seen.clear()
+        watched.seen.update(ips)
+
+        # Persist the offset only if this micro-batch drains everything read so far
+        offset = watched.reader.position() if not watched.pending else None
+        def on_done(job):
+            if job.status == job_queue.DONE and offset:
+                self._save_offset(watched, offset)
+
+        path = watched.reader.path
+        watched.active_stats = ip_stats
+        watched.active_job = job_queue.AnalysisJob(
+            path, None, self.api_key_otx, self.cache_duration_hours,
+            ip_stats=ip_stats, batch_id=watched.batch_id, group=f"watch:{path}", on_done=on_done,
+            run_metrics=watched.metrics
+        )
+        self.queue.submit(watched.active_job)
+
+    def _save_offset(self, watched, offset):
+        if offset != watched.saved_offset:
+            database.save_watch_offset(watched.reader.path, *offset)
+            watched.saved_offset = offset
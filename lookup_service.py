@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+import api
+import budget
+import database
+import ip_filter
+import job_queue
+import metrics
+
+MAX_BULK_IPS = 1000
+RESPONSE_FIELDS = ("country", "is_malicious", "fraud_score", "isp", "organization", "otx_pulses", "ipqs_checked_at", "otx_checked_at",
+                   "feed_source", "feed_checked_at", *database.PROMOTED_IPQS_FIELDS)
+BOOLEAN_FIELDS = ("is_malicious", *(column for column in database.PROMOTED_IPQS_FIELDS if column not in database.PROMOTED_COLUMN_TYPES))
+
+# --- Where an answer came from ---
+SOURCE_CACHE = "cache"                # Fresh row served straight from SQLite
+SOURCE_FEED = "feed"                  # Fresh entry of an imported reputation feed (see feeds.py)
+SOURCE_NEGATIVE = "negative_cache"    # Last lookup failed recently; not retried yet
+SOURCE_STALE = "stale_cache"          # Daily credit cap reached: last known data
+SOURCE_API = "api"                    # Looked up now
+SOURCE_SHARED = "shared"              # Joined a lookup already in flight (analysis job or another request)
+
+class _ServiceClient:
+    """ The lookup client JobQueue.start_lookup() reports to for service requests. """
+    def __init__(self, api_key_otx, run_metrics):
+        self.api_key_otx = api_key_otx
+        self.metrics = run_metrics
+
+    def progress_callback(self, ip_info):
+        if 'result' in ip_info and not ip_info.get('otx_only') and not ip_info.get('shared'):
+            database.add_api_usage(budget.PROVIDER_IPQS, 1)
+
+    def lookup_done(self, result, info):
+        pass
+
+class LookupService:
+    """
+    Serves IP reputation over local HTTP for other tools (SIEM enrichment, SOAR playbooks):
+
+        GET  /lookup/{ip}          one IP
+        POST /lookup               {"ips": [...]} (at most MAX_BULK_IPS)
+        GET  /health, GET /metrics (Prometheus text)
+
+    Fresh rows are answered from SQLite without touching the network. Misses go through the
+    job queue's session, rate limiters and in-flight map, so concurrent requests (and running
+    analysis jobs) for the same IP share a single provider lookup. IPQS lookups respect
+    IPQS_CREDIT_CAP_DAY; beyond it, stale rows are served as they are.
+    """
+    def __init__(self, queue, api_key_otx, cache_duration_hours, host=None, port=None):
+        self.queue = queue
+        self.host = host or os.getenv("SERVICE_HOST", "").strip() or "127.0.0.1"
+        self.port = port or int(os.getenv("SERVICE_PORT", "").strip() or 8765)
+        self.token = os.getenv("SERVICE_TOKEN", "").strip()
+        self.ttls = budget.get_provider_ttls(cache_duration_hours)
+        self.metrics = metrics.RunMetrics()
+        self.client = _ServiceClient(api_key_otx, self.metrics)
+        self.runner = None
+
+    # --- Lifecycle (thread-safe; the server runs on the queue's event loop) ---
+    def start(self):
+        self.queue.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.queue.loop).result()
+
+    def stop(self):
+        if self.runner is not None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.queue.loop).result()
+            self.runner = None
+
+    async def _start(self):
+        app = web.Application(middlewares=[self._check_token])
+        app.add_routes([
+            web.get('/health', self.handle_health),
+            web.get('/metrics', self.handle_metrics),
+            web.get('/lookup/{ip}', self.handle_lookup_one),
+            web.post('/lookup', self.handle_lookup_bulk),
+        ])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        self.runner = runner
+
+    @web.middleware
+    async def _check_token(self, request, handler):
+        if self.token and request.headers.get("Authorization") != f"Bearer {self.token}":
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        return await handler(request)
+
+    # --- Handlers ---
+    async def handle_health(self, request):
+        return web.json_response({'status': 'ok', 'inflight': len(self.queue.inflight)})
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.metrics.to_prometheus(source="service"), content_type="text/plain")
+
+    async def handle_lookup_one(self, request):
+        answer = (await self.resolve([request.match_info['ip']]))[0]
+        return web.json_response(answer, status=400 if answer.get('error') == "invalid" else 200)
+
+    async def handle_lookup_bulk(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({'error': 'body must be JSON: {"ips": [...]}'}, status=400)
+        ips = body.get('ips') if isinstance(body, dict) else body
+        if not isinstance(ips, list):
+            return web.json_response({'error': 'body must be JSON: {"ips": [...]}'}, status=400)
+        if len(ips) > MAX_BULK_IPS:
+            return web.json_response({'error': f'at most {MAX_BULK_IPS} IPs per request'}, status=413)
+        return web.json_response({'results': await self.resolve(ips)})
+
+    # --- Lookup pipeline ---
+    def _credits_left_today(self):
+        """ IPQS credits left under IPQS_CREDIT_CAP_DAY before reservations (None = no cap); blocking. """
+        day_cap = budget.get_caps()[1]
+        if day_cap is None:
+            return None
+        return day_cap - database.get_api_usage(budget.PROVIDER_IPQS)
+
+    def _answer(self, ip, details, source):
+        answer = {'ip': ip, 'source': source}
+        if details:
+            answer.update({field: details[field] for field in RESPONSE_FIELDS})
+            for field in BOOLEAN_FIELDS:
+                if details[field] is not None:
+                    answer[field] = bool(details[field])
+            if details['error_count']:
+                answer['last_error'] = details['last_error_class']
+        return answer
+
+    async def resolve(self, raw_ips):
+        """ Answers each requested address (in request order) from the cache or a shared lookup. """
+        started = time.perf_counter()
+        canonical = [ip_filter.canonicalize(raw.strip()) if isinstance(raw, str) else None for raw in raw_ips]
+        accepted = set(ip_filter.classify_from_settings([ip for ip in canonical if ip])['accepted'])
+
+        # SQLite runs in a worker thread: the loop is shared with analysis jobs and other requests
+        loop = asyncio.get_running_loop()
+        with self.metrics.stage("cache_check"):
+            rows = {row['ip_address']: row for row in await loop.run_in_executor(None, database.find_ip_details_bulk, sorted(accepted))}
+        now = datetime.now()
+        answers, waits, misses = {}, {}, []
+        for ip in sorted(accepted):
+            details = rows.get(ip)
+            providers = budget.stale_providers(details, self.ttls, now, otx_enabled=bool(self.client.api_key_otx))
+            if not providers and budget.fresh_reputation_source(details, self.ttls, now) == budget.PROVIDER_FEED:
+                answers[ip] = self._answer(ip, details, SOURCE_FEED)
+                self.metrics.incr("cache_lookups_total", result=metrics.CACHE_FEED)
+            elif not providers:
+                answers[ip] = self._answer(ip, details, SOURCE_CACHE)
+                self.metrics.incr("cache_lookups_total", result=metrics.CACHE_FRESH)
+            elif budget.PROVIDER_IPQS in providers and api.is_negatively_cached(details, now):
+                answers[ip] = self._answer(ip, details, SOURCE_NEGATIVE)
+                self.metrics.incr("cache_lookups_total", result=metrics.CACHE_NEGATIVE)
+            else:
+                misses.append({'ip': ip, 'details': details, 'providers': providers})
+
+        reserved = 0
+        if misses:
+            # Only misses wait for the plan lock (jobs hold it while they plan). Credits of lookups
+            # started here stay reserved until they finish, so overlapping requests and jobs cannot
+            # each spend the same remaining budget.
+            async with self.queue.plan_lock:
+                credits_left = await loop.run_in_executor(None, self._credits_left_today)
+                if credits_left is not None:
+                    credits_left -= self.queue.reserved_credits
+                for info in misses:
+                    ip, details, providers = info['ip'], info['details'], info['providers']
+                    if self.queue.inflight_future(info):
+                        waits[ip] = (SOURCE_SHARED, asyncio.shield(self.queue.inflight_future(info)))
+                        self.metrics.incr("shared_lookups_total")
+                    elif budget.PROVIDER_IPQS in providers and credits_left is not None and credits_left <= 0:
+                        answers[ip] = self._answer(ip, details, SOURCE_STALE)
+                        if not details:
+                            answers[ip]['error'] = "credit cap reached"
+                        self.metrics.incr("budget_skipped_total")
+                    else:
+                        if budget.PROVIDER_IPQS in providers:
+                            reserved += 1
+                            if credits_left is not None:
+                                credits_left -= 1
+                        self.metrics.incr("cache_lookups_total", result=metrics.CACHE_STALE if details else metrics.CACHE_NEW)
+                        waits[ip] = (SOURCE_API, self.queue.start_lookup(self.client, info))
+                self.queue.reserved_credits += reserved
+
+        if waits:
+            try:
+                with self.metrics.stage("lookups"):
+                    await asyncio.gather(*[wait for _, wait in waits.values()], return_exceptions=True)
+            finally:
+                self.queue.reserved_credits -= reserved
+            refreshed = {row['ip_address']: row for row in await loop.run_in_executor(None, database.find_ip_details_bulk, list(waits))}
+            for ip, (source, _) in waits.items():
+                answers[ip] = self._answer(ip, refreshed.get(ip), source)
+
+        results = []
+        for raw, ip in zip(raw_ips, canonical):
+            if ip is None:
+                results.append({'ip': raw, 'error': "invalid"})
+            elif ip not in accepted:
+                results.append({'ip': ip, 'error': "filtered"})  # Bogon, denylisted or outside the allowlist
+            else:
+                results.append(answers[ip])
+        self.metrics.add_stage("request", time.perf_counter() - started)
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve IP reputation lookups from the LOCKON IP Prism cache.")
+    parser.add_argument("--host", help="interface to bind (default SERVICE_HOST or 127.0.0.1)")
+    parser.add_argument("--port", type=int, help="port to listen on (default SERVICE_PORT or 8765)")
+    args = parser.parse_args()
+
+    database.setup_database()
+    queue = job_queue.JobQueue(on_update=lambda job, message: None)
+    service = LookupService(queue, api.get_otx_api_key(), int(os.getenv("CACHE_DURATION_HOURS", 24)), args.host, args.port)
+    service.start()
+    print(f"Serving lookups on http://{service.host}:{service.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        queue.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = "metrics"
+
+# Upper bounds (seconds) of the provider latency histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+# --- Cache outcomes per IP (see AnalysisJob._prepare) ---
+CACHE_FRESH = "fresh"          # Every provider fresh: served from SQLite
+CACHE_FEED = "feed"            # Covered by a fresh imported feed entry instead of IPQS
+CACHE_NEGATIVE = "negative"    # Failed recently: waiting out the retry delay
+CACHE_OFFLINE = "offline"      # Covered by offline GeoIP data in a skipped country
+CACHE_STALE = "stale"          # Known, but at least one provider needs refreshing
+CACHE_NEW = "new"              # Never seen before
+CACHE_HITS = (CACHE_FRESH, CACHE_FEED, CACHE_NEGATIVE, CACHE_OFFLINE)
+
+class Histogram:
+    """ A fixed-bucket histogram with Prometheus semantics (cumulative buckets, sum and count). """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ [(upper bound, observations <= bound), ...] ending with ("+Inf", count). """
+        total, result = 0, []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile (None without observations). """
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': {str(bound): total for bound, total in self.cumulative()},
+        }
+
+class RunMetrics:
+    """
+    Instrumentation for one analysis run (or one watch session): wall time per pipeline
+    stage, per-provider latency histograms, labelled counters (errors, retries, cache
+    outcomes). Safe to update from the job's worker thread and its event loop at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.latency = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def observe_latency(self, provider, seconds):
+        with self._lock:
+            self.latency.setdefault(provider, Histogram()).observe(seconds)
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def counter_total(self, name, **labels):
+        """ Sum of a counter over every label set that includes `labels`. """
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(value for (counter, key), value in self.counters.items()
+                       if counter == name and wanted <= set(key))
+
+    def cache_hit_ratio(self):
+        hits = sum(self.counter_total("cache_lookups_total", result=result) for result in CACHE_HITS)
+        total = self.counter_total("cache_lookups_total")
+        return hits / total if total else None
+
+    def summary(self):
+        """ The compact run summary persisted on the import_batches row. """
+        ratio = self.cache_hit_ratio()
+        with self._lock:
+            stage_seconds = {name: round(seconds, 3) for name, (seconds, _) in self.stages.items()}
+            latency = {provider: {'count': hist.count, 'p50': hist.quantile(0.5), 'p95': hist.quantile(0.95)}
+                       for provider, hist in self.latency.items()}
+        return {
+            'duration_seconds': round(time.time() - self.started, 3),
+            'stage_seconds': stage_seconds,
+            'cache_hit_ratio': round(ratio, 4) if ratio is not None else None,
+            'cache_hits': sum(self.counter_total("cache_lookups_total", result=result) for result in CACHE_HITS),
+            'cache_misses': self.counter_total("cache_lookups_total", result=CACHE_STALE)
+                            + self.counter_total("cache_lookups_total", result=CACHE_NEW),
+            'provider_requests': {provider: self.counter_total("provider_requests_total", provider=provider)
+                                  for provider in latency},
+            'provider_errors': self.counter_total("provider_errors_total"),
+            'retries': self.counter_total("retries_total"),
+            'latency': latency,
+        }
+
+    def to_dict(self):
+        summary = self.summary()
+        with self._lock:
+            return {
+                **summary,
+                'stages': {name: {'seconds': round(seconds, 6), 'count': count} for name, (seconds, count) in self.stages.items()},
+                'latency': {provider: hist.to_dict() for provider, hist in self.latency.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+            }
+
+    def to_prometheus(self, **base_labels):
+        """ Renders the metrics in the Prometheus text exposition format; `base_labels` go on every sample. """
+        def labels(**items):
+            items = {**base_labels, **items}
+            return "{" + ",".join(f'{key}="{value}"' for key, value in items.items()) + "}"
+
+        lines = [
+            "# HELP ipprism_stage_seconds_total Wall time spent per pipeline stage.",
+            "# TYPE ipprism_stage_seconds_total counter",
+        ]
+        with self._lock:
+            for name, (seconds, _) in sorted(self.stages.items()):
+                lines.append(f"ipprism_stage_seconds_total{labels(stage=name)} {seconds:.6f}")
+            lines += [
+                "# HELP ipprism_provider_latency_seconds Provider request latency.",
+                "# TYPE ipprism_provider_latency_seconds histogram",
+            ]
+            for provider, hist in sorted(self.latency.items()):
+                for bound, total in hist.cumulative():
+                    lines.append(f"ipprism_provider_latency_seconds_bucket{labels(provider=provider, le=bound)} {total}")
+                lines.append(f"ipprism_provider_latency_seconds_sum{labels(provider=provider)} {hist.sum:.6f}")
+                lines.append(f"ipprism_provider_latency_seconds_count{labels(provider=provider)} {hist.count}")
+            typed = set()
+            for (name, label_items), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE ipprism_{name} counter")
+                    typed.add(name)
+                lines.append(f"ipprism_{name}{labels(**dict(label_items))} {value}")
+        return "\n".join(lines) + "\n"
+
+class NullMetrics:
+    """ Stand-in for callers that do not collect metrics; every update is a no-op. """
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_stage(self, name, seconds):
+        pass
+
+    def observe_latency(self, provider, seconds):
+        pass
+
+    def incr(self, name, amount=1, **labels):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+def get_metrics_dir():
+    return os.getenv("METRICS_DIR", "").strip() or METRICS_DIR
+
+def export(run_metrics, batch_id):
+    """ Writes batch_<id>.json and batch_<id>.prom into METRICS_DIR; returns the JSON path. """
+    directory = get_metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"batch_{batch_id}")
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump({'batch_id': batch_id, **run_metrics.to_dict()}, f, indent=2)
+    with open(base + ".prom", "w", encoding="utf-8") as f:
+        f.write(run_metrics.to_prometheus(batch_id=batch_id))
+    return base + ".json"
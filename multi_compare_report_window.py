@@ -1,25 +1,30 @@
 import customtkinter as ctk
 from tkinter import ttk, messagebox, filedialog
-import tempfile
-import os
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import tkinter
+import threading
+import shutil
 
 import pdf_generator
+import report_cache
+from comparison_engine import ComparisonEngine, PAGE_SIZE, MODE_UNION, MODE_INTERSECTION, MODE_ONLY_IN, MODE_AT_LEAST
 
 class MultiCompareReportWindow(ctk.CTkToplevel):
-    def __init__(self, master, comparison_data, batch_names):
+    def __init__(self, master, engine, batch_names):
         super().__init__(master)
         self.title("Multi-Batch Comparison Report")
         self.geometry("1000x700")
         self.transient(master)
         self.grab_set()
 
-        self.data = comparison_data
+        self.engine = engine
         self.batch_names = batch_names
+        self.filter_mode = MODE_UNION
+        self.filter_arg = None
+        self.page_offset = 0
+        self.total_rows = 0
         
         self.grid_columnconfigure(0, weight=1)
-        self.grid_rowconfigure(1, weight=1)
+        self.grid_rowconfigure(2, weight=1)
 
         # --- Header ---
         self.header_frame = ctk.CTkFrame(self)
@@ -32,6 +37,29 @@ class MultiCompareReportWindow(ctk.CTkToplevel):
         self.pdf_button = ctk.CTkButton(self.header_frame, text="Generate PDF Report", command=self.generate_pdf_report)
         self.pdf_button.pack(side="right", padx=10, pady=5)
 
+        # --- Filter & Paging ---
+        self.filter_frame = ctk.CTkFrame(self)
+        self.filter_frame.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="ew")
+
+        self.filter_options = {"All IPs (Union)": (MODE_UNION, None), "In All Batches (Intersection)": (MODE_INTERSECTION, None)}
+        for batch_id, name in zip(self.engine.batch_ids, self.batch_names):
+            self.filter_options[f"Only In {name}"] = (MODE_ONLY_IN, batch_id)
+        self.filter_options["In At Least K Batches"] = (MODE_AT_LEAST, None)
+
+        self.filter_menu = ctk.CTkOptionMenu(self.filter_frame, values=list(self.filter_options), command=self.apply_filter, width=300)
+        self.filter_menu.pack(side="left", padx=10, pady=5)
+
+        self.k_entry = ctk.CTkEntry(self.filter_frame, width=50, placeholder_text="K")
+        self.k_entry.pack(side="left", padx=5, pady=5)
+        self.k_entry.bind("<Return>", lambda event: self.apply_filter(self.filter_menu.get()))
+
+        self.next_button = ctk.CTkButton(self.filter_frame, text="Next >", width=80, command=self.next_page)
+        self.next_button.pack(side="right", padx=(5, 10), pady=5)
+        self.page_label = ctk.CTkLabel(self.filter_frame, text="")
+        self.page_label.pack(side="right", padx=5, pady=5)
+        self.prev_button = ctk.CTkButton(self.filter_frame, text="< Prev", width=80, command=self.prev_page)
+        self.prev_button.pack(side="right", padx=5, pady=5)
+
         # --- Treeview for Data ---
         self.columns = ("ip_address", "count", "countries", "isps", "score", "otx")
         self.tree = ttk.Treeview(self, columns=self.columns, show="headings")
@@ -47,44 +75,80 @@ class MultiCompareReportWindow(ctk.CTkToplevel):
         self.tree.column("score", anchor="center", width=120)
         self.tree.column("otx", anchor="center", width=120)
 
-        self.tree.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="nsew")
+        self.tree.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
 
         # Scrollbar
         scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
         self.tree.configure(yscroll=scrollbar.set)
-        scrollbar.grid(row=1, column=1, sticky="ns")
-
+        scrollbar.grid(row=2, column=1, sticky="ns")
+
+        self.filter_menu.set("All IPs (Union)")
+        self.apply_filter("All IPs (Union)")
+
+    def destroy(self):
+        self.engine.close()
+        super().destroy()
+
+    def apply_filter(self, choice):
+        """ Switches the set operation shown in the table and jumps back to the first page. """
+        mode, arg = self.filter_options[choice]
+        if mode == MODE_AT_LEAST:
+            k = self.k_entry.get().strip()
+            if not k.isdigit() or not 1 <= int(k) <= len(self.batch_names):
+                messagebox.showerror("Invalid Input", f"K must be between 1 and {len(self.batch_names)}.", parent=self)
+                return
+            arg = int(k)
+        self.filter_mode, self.filter_arg = mode, arg
+        self.page_offset = 0
+        self.total_rows = self.engine.count(mode, arg)
         self.populate_data()
+
+    def next_page(self):
+        if self.page_offset + PAGE_SIZE < self.total_rows:
+            self.page_offset += PAGE_SIZE
+            self.populate_data()
+
+    def prev_page(self):
+        if self.page_offset > 0:
+            self.page_offset = max(0, self.page_offset - PAGE_SIZE)
+            self.populate_data()
     
     def populate_data(self):
-        """ Populates the treeview with comparison data. """
+        """ Populates the treeview with the current page of comparison data. """
+        for item in self.tree.get_children():
+            self.tree.delete(item)
         self.tree.tag_configure('high_recurrence', background='#E74C3C', foreground='white')
         self.tree.tag_configure('medium_recurrence', background='#F39C12', foreground='black')
 
-        for ip, details in self.data.items():
-            if not details: continue
-
+        total_batches = len(self.batch_names)
+        for row in self.engine.fetch_page(self.filter_mode, self.filter_arg, offset=self.page_offset):
             display_values = (
-                ip,
-                f"{details.get('count', 0)} / {len(self.batch_names)}",
-                ', '.join(c for c in details.get('countries', []) if c),
-                ', '.join(i for i in details.get('isps', []) if i),
-                details.get('max_score', 0),
-                details.get('max_otx', 0)
+                row['ip_address'],
+                f"{row['batch_count']} / {total_batches}",
+                row['country'] or "",
+                row['isp'] or "",
+                row['max_score'],
+                row['max_otx']
             )
 
             tags_to_apply = ()
-            count = details.get('count', 0)
-            if count == len(self.batch_names):
+            count = row['batch_count']
+            if count == total_batches:
                 tags_to_apply = ('high_recurrence',)
             elif count > 1:
                 tags_to_apply = ('medium_recurrence',)
 
             self.tree.insert("", "end", values=display_values, tags=tags_to_apply)
 
+        last_row = min(self.page_offset + PAGE_SIZE, self.total_rows)
+        first_row = self.page_offset + 1 if self.total_rows else 0
+        self.page_label.configure(text=f"{first_row}-{last_row} of {self.total_rows}")
+        self.prev_button.configure(state="normal" if self.page_offset > 0 else "disabled")
+        self.next_button.configure(state="normal" if last_row < self.total_rows else "disabled")
+
     def generate_pdf_report(self):
-        """ Generates a PDF report of the comparison data """
-        if not self.data:
+        """ Generates a PDF report of the recurring IPs in the comparison """
+        if self.engine.count() == 0:
             messagebox.showwarning("No Data", "There is no data to generate a report from.")
             return
 
@@ -95,61 +159,45 @@ class MultiCompareReportWindow(ctk.CTkToplevel):
         )
         if not file_path:
             return
-            
-        try:
-            report_title = f"Comparison for: {', '.join(self.batch_names)}"
-            
-            recurring_ips = {ip: details for ip, details in self.data.items() if details.get('count', 0) > 1}
-            
-            stats = {
-                "total_ips": len(self.data),
-                "malicious_count": len(recurring_ips),
-            }
-
-            country_counts = {}
-            for ip, details in recurring_ips.items():
-                for country in details.get('countries', []):
-                    if country and country != 'N/A':
-                        country_counts[country] = country_counts.get(country, 0) + 1
-            
-            stats["top_country"] = max(country_counts, key=country_counts.get) if country_counts else "N/A"
-
-            top_malicious_ips_data = sorted(recurring_ips.items(), key=lambda item: (item[1].get('count', 0), item[1].get('max_score', 0)), reverse=True)[:10]
-            
-            # --- FIXED: Create a list of DICTIONARIES, not lists ---
-            top_malicious_ips_for_pdf = []
-            for ip, details in top_malicious_ips_data:
-                countries_str = ', '.join(c for c in details.get('countries', []) if c)
-                isps_str = ', '.join(i for i in details.get('isps', []) if i)
-                # Create a dictionary that matches the keys used in pdf_generator.py
-                row_dict = {
-                    'ip_address': ip,
-                    'country': countries_str,
-                    'isp': isps_str,
-                    'fraud_score': details.get('max_score', 0),
-                    'otx_pulses': details.get('max_otx', 0)
-                }
-                top_malicious_ips_for_pdf.append(row_dict)
 
-            temp_dir = tempfile.gettempdir()
-            graph_paths = {}
+        report_title = f"Comparison for: {', '.join(self.batch_names)}"
+        self.pdf_button.configure(state="disabled", text="Generating...")
+        threading.Thread(target=self._run_pdf_report, args=(file_path, report_title), daemon=True).start()
 
-            fig1 = Figure(figsize=(5, 4), dpi=100)
-            ax1 = fig1.add_subplot(111)
-            if country_counts:
-                ax1.pie(country_counts.values(), labels=country_counts.keys(), autopct='%1.1f%%', startangle=90)
-                ax1.set_title('Recurring IP Geolocation')
+    def _run_pdf_report(self, file_path, report_title):
+        """ Worker thread: SQLite connections are per-thread, so it aggregates with its own engine. """
+        engine = None
+        try:
+            cache_key = report_cache.compute_key("compare_pdf", self.engine.batch_ids, report_title)
+            cached_path = report_cache.get(cache_key)
+            if cached_path:
+                shutil.copyfile(cached_path, file_path)
             else:
-                ax1.text(0.5, 0.5, 'No Recurring IPs', ha='center', va='center')
-            fig1.tight_layout()
-            pie_chart_path = os.path.join(temp_dir, "comp_pie_chart.png")
-            fig1.savefig(pie_chart_path)
-            graph_paths['pie_chart'] = pie_chart_path
-            
-            pdf_generator.create_report(file_path, report_title, stats, top_malicious_ips_for_pdf, graph_paths)
-            
-            messagebox.showinfo("Success", f"PDF report successfully generated at\n{file_path}")
-
+                engine = ComparisonEngine(self.engine.batch_ids)
+                stats = {
+                    "total_ips": engine.count(),
+                    "malicious_count": engine.count(MODE_AT_LEAST, 2),
+                }
+                country_counts = engine.country_counts(MODE_AT_LEAST, 2)
+                stats["top_country"] = next(iter(country_counts), "N/A")
+                charts = {'pie_chart': report_cache.cached_chart("pie", [country_counts, 'Recurring IP Geolocation'],
+                    lambda: pdf_generator.build_pie_chart(country_counts, 'Recurring IP Geolocation', 'No Recurring IPs'))}
+                pdf_generator.create_report(file_path, report_title, stats, engine.iter_rows(MODE_AT_LEAST, 2), charts, table_title="Recurring IPs")
+                report_cache.put(cache_key, self.engine.batch_ids, file_path, ".pdf")
+            result = {}
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate PDF report: {e}")
-
+            result = {'error': str(e)}
+        finally:
+            if engine:
+                engine.close()
+        try:
+            self.after(0, self.pdf_report_finished, file_path, result)
+        except (RuntimeError, tkinter.TclError):
+            pass  # Window closed while the report was being generated.
+
+    def pdf_report_finished(self, file_path, result):
+        self.pdf_button.configure(state="normal", text="Generate PDF Report")
+        if 'error' in result:
+            messagebox.showerror("Error", f"Failed to generate PDF report: {result['error']}", parent=self)
+        else:
+            messagebox.showinfo("Success", f"PDF report successfully generated at\n{file_path}", parent=self)
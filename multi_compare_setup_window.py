@@ -2,6 +2,7 @@ import customtkinter as ctk
 from tkinter import messagebox
 
 import database
+from comparison_engine import ComparisonEngine
 from multi_compare_report_window import MultiCompareReportWindow
 
 class MultiCompareSetupWindow(ctk.CTkToplevel):
@@ -44,7 +45,7 @@ class MultiCompareSetupWindow(ctk.CTkToplevel):
             self.checkboxes[cb] = var
 
     def generate_report(self):
-        """ Gathers data for selected batches and opens the report window, now fully armored. """
+        """ Aggregates the selected batches in SQLite and opens the report window. """
         selected_ids = [int(var.get()) for var in self.checkboxes.values() if var.get() != "off"]
         
         if len(selected_ids) < 2:
@@ -52,48 +53,16 @@ class MultiCompareSetupWindow(ctk.CTkToplevel):
             return
 
         selected_batch_names = [cb.cget("text") for cb, var in self.checkboxes.items() if var.get() != "off"]
-        
-        all_ips_by_batch = {}
-        for batch_id in selected_ids:
-            all_ips_by_batch[batch_id] = database.get_ips_by_batch_ids([batch_id])
-
-        comparison_data = {}
-        for batch_id, ips in all_ips_by_batch.items():
-            for ip_details in ips:
-                try:
-                    if not ip_details: continue
-                    
-                    ip_address = ip_details['ip_address']
-                    if not ip_address: continue
 
-                    if ip_address not in comparison_data:
-                        comparison_data[ip_address] = {
-                            'count': 0, 'batches': set(), 'countries': set(), 'isps': set(),
-                            'max_score': 0, 'max_otx': 0
-                        }
-                    
-                    data = comparison_data[ip_address]
-                    data['count'] += 1
-                    data['batches'].add(batch_id)
-                    
-                    if ip_details['country']: data['countries'].add(ip_details['country'])
-                    if ip_details['isp']: data['isps'].add(ip_details['isp'])
-                    
-                    current_score = int(ip_details['fraud_score'] or 0)
-                    if current_score > data.get('max_score', 0):
-                        data['max_score'] = current_score
+        try:
+            engine = ComparisonEngine(selected_ids)
+        except (ValueError, RuntimeError) as e:
+            messagebox.showerror("Comparison Error", str(e))
+            return
 
-                    current_otx = int(ip_details['otx_pulses'] or 0)
-                    if current_otx > data.get('max_otx', 0):
-                        data['max_otx'] = current_otx
-                except (IndexError, TypeError, ValueError, KeyError) as e:
-                    # Now that we use dicts, this error is less likely, but we keep it for safety
-                    print(f"Skipping malformed row during comparison: {dict(ip_details) if ip_details else 'Empty'}. Error: {e}")
-                    continue
-        
-        if not comparison_data:
+        if engine.count() == 0:
+            engine.close()
             messagebox.showinfo("No Data", "No common or unique IPs found in the selected batches to compare.")
             return
             
-        MultiCompareReportWindow(self, comparison_data, selected_batch_names)
-
+        MultiCompareReportWindow(self, engine, selected_batch_names)
@@ -1,17 +1,102 @@
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
-from reportlab.platypus import Table, TableStyle
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib import colors
+from matplotlib.figure import Figure
 from datetime import datetime
-import os
+import io
 
-def create_report(filename, report_title, stats, top_malicious_ips, graph_paths):
+import api
+
+# --- Table layout (columns: IP Address, Country, ISP, Score, OTX) ---
+TABLE_HEADERS = ['IP Address', 'Country', 'ISP', 'Score', 'OTX']
+TABLE_COL_WIDTHS = [1.5*inch, 1*inch, 3*inch, 0.7*inch, 0.6*inch]
+ROW_HEIGHT = 0.22*inch
+TABLE_FONT_SIZE = 9
+BOTTOM_MARGIN = 0.9*inch
+
+# --- Risk bands shared by the reports and the history, recurrence and cluster views ---
+MEDIUM_RISK_SCORE = 75
+
+def high_risk_threshold():
+    """ Fraud score from which an IP counts as high risk: the MALICIOUS_THRESHOLD behind `is_malicious`. """
+    return api.get_malicious_threshold()
+
+def risk_tags(score, high_risk_score=None):
+    """ Treeview tags for a fraud score: ('high_risk',), ('medium_risk',) or (). """
+    score = score or 0
+    if score >= (high_risk_score if high_risk_score is not None else high_risk_threshold()):
+        return ('high_risk',)
+    if score >= MEDIUM_RISK_SCORE:
+        return ('medium_risk',)
+    return ()
+
+def figure_to_png(fig):
+    """ Renders a matplotlib figure into an in-memory PNG buffer. """
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    buffer.seek(0)
+    return buffer
+
+def build_pie_chart(counts, title, empty_text):
+    fig = Figure(figsize=(5, 4), dpi=100)
+    ax = fig.add_subplot(111)
+    if counts:
+        ax.pie(counts.values(), labels=counts.keys(), autopct='%1.1f%%', startangle=90)
+        ax.set_title(title)
+    else:
+        ax.text(0.5, 0.5, empty_text, ha='center', va='center')
+    fig.tight_layout()
+    return figure_to_png(fig)
+
+def build_assessment_chart(malicious_count, benign_count):
+    fig = Figure(figsize=(4, 3), dpi=100)
+    ax = fig.add_subplot(111)
+    ax.bar(['Malicious', 'Benign'], [malicious_count, benign_count], color=['#e74c3c', '#2ecc71'])
+    ax.set_title('Security Assessment')
+    ax.set_ylabel('Count')
+    fig.tight_layout()
+    return figure_to_png(fig)
+
+def _fit(text, width, font="Helvetica", size=TABLE_FONT_SIZE):
+    """ Truncates a cell value so it stays inside its column. """
+    text = str(text)
+    if stringWidth(text, font, size) <= width:
+        return text
+    while text and stringWidth(text + "...", font, size) > width:
+        text = text[:-1]
+    return text + "..."
+
+def _draw_footer(c, width, page_number):
+    c.setFont("Helvetica-Oblique", 9)
+    c.setFillColor(colors.black)
+    c.drawString(inch, 0.5*inch, "Generated by LOCKON IP Prism v2.2")
+    c.drawRightString(width - inch, 0.5*inch, f"Page {page_number}")
+
+def _draw_table_row(c, y_pos, values, header=False, shaded=False):
+    x_pos = inch
+    total_width = sum(TABLE_COL_WIDTHS)
+    c.setFillColor(colors.grey if header else (colors.beige if shaded else colors.white))
+    c.rect(x_pos, y_pos, total_width, ROW_HEIGHT, stroke=1, fill=1)
+    c.setFillColor(colors.whitesmoke if header else colors.black)
+    font = "Helvetica-Bold" if header else "Helvetica"
+    c.setFont(font, TABLE_FONT_SIZE)
+    for value, col_width in zip(values, TABLE_COL_WIDTHS):
+        c.drawCentredString(x_pos + col_width / 2, y_pos + 0.07*inch, _fit(value, col_width - 6, font))
+        x_pos += col_width
+
+def create_report(filename, report_title, stats, rows, charts, table_title="High-Risk IPs"):
     """
-    สร้างรายงานสรุปในรูปแบบไฟล์ PDF, now fully robust to handle dict-like objects.
+    สร้างรายงานสรุปในรูปแบบไฟล์ PDF.
+    `rows` is any iterable of (ip_address, country, isp, fraud_score, otx_pulses) tuples and is
+    consumed lazily; the table continues onto as many pages as needed. `charts` maps
+    'pie_chart'/'bar_chart' to in-memory PNG buffers.
     """
     c = canvas.Canvas(filename, pagesize=letter)
     width, height = letter
+    page_number = 1
 
     # --- Header ---
     c.setFont("Helvetica-Bold", 18)
@@ -25,65 +110,40 @@ def create_report(filename, report_title, stats, top_malicious_ips, graph_paths)
     y_pos = height - 2.2*inch
     c.setFont("Helvetica-Bold", 14)
     c.drawString(inch, y_pos, "Key Metrics")
-    
+
     c.setFont("Helvetica", 12)
     c.drawString(1.2*inch, y_pos - 0.3*inch, f"• Total Unique IPs Analyzed: {stats.get('total_ips', 0)}")
     c.drawString(1.2*inch, y_pos - 0.5*inch, f"• Malicious IPs Detected: {stats.get('malicious_count', 0)}")
     c.drawString(1.2*inch, y_pos - 0.7*inch, f"• Top Malicious Country: {stats.get('top_country', 'N/A')}")
-    
+
     # --- Graphs ---
     y_pos -= 1.2*inch
     c.setFont("Helvetica-Bold", 14)
     c.drawString(inch, y_pos, "Visualizations")
 
-    if 'pie_chart' in graph_paths and os.path.exists(graph_paths['pie_chart']):
-        c.drawImage(graph_paths['pie_chart'], inch, y_pos - 2.7*inch, width=3.5*inch, height=2.5*inch, preserveAspectRatio=True)
-    if 'bar_chart' in graph_paths and os.path.exists(graph_paths['bar_chart']):
-        c.drawImage(graph_paths['bar_chart'], inch + 4*inch, y_pos - 2.7*inch, width=3*inch, height=2.4*inch, preserveAspectRatio=True)
+    if charts.get('pie_chart'):
+        c.drawImage(ImageReader(charts['pie_chart']), inch, y_pos - 2.7*inch, width=3.5*inch, height=2.5*inch, preserveAspectRatio=True)
+    if charts.get('bar_chart'):
+        c.drawImage(ImageReader(charts['bar_chart']), inch + 4*inch, y_pos - 2.7*inch, width=3*inch, height=2.4*inch, preserveAspectRatio=True)
 
-    # --- Top Malicious IPs Table ---
+    # --- IP Table (paginated) ---
     y_pos -= 3.2*inch
     c.setFont("Helvetica-Bold", 14)
-    c.drawString(inch, y_pos, "Top 10 High-Risk IPs")
-
-    table_data = [['IP Address', 'Country', 'ISP', 'Score', 'OTX']]
-    for ip_data in top_malicious_ips:
-        # --- FIXED: Use direct key access which works for both dict and sqlite3.Row ---
-        # The 'or' operator provides a safe fallback for None values.
-        table_data.append([
-            ip_data['ip_address'] or '',
-            ip_data['country'] or 'N/A',
-            ip_data['isp'] or '',
-            ip_data['fraud_score'] or 0,
-            ip_data['otx_pulses'] or 0
-        ])
-
-    table = Table(table_data, colWidths=[1.5*inch, 1*inch, 2.5*inch, 0.7*inch, 0.6*inch])
-    style = TableStyle([
-        ('BACKGROUND', (0,0), (-1,0), colors.grey),
-        ('TEXTCOLOR',(0,0),(-1,0),colors.whitesmoke),
-        ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0,0), (-1,0), 12),
-        ('BACKGROUND', (0,1), (-1,-1), colors.beige),
-        ('GRID', (0,0), (-1,-1), 1, colors.black)
-    ])
-    table.setStyle(style)
-
-    table.wrapOn(c, width, height)
-    table.drawOn(c, inch, y_pos - (len(table_data) * 0.25 + 0.3)*inch)
+    c.drawString(inch, y_pos, table_title)
+    y_pos -= 0.2*inch + ROW_HEIGHT
+    _draw_table_row(c, y_pos, TABLE_HEADERS, header=True)
 
-    # --- Footer ---
-    c.setFont("Helvetica-Oblique", 9)
-    c.drawString(inch, 0.5*inch, f"Generated by LOCKON IP Prism v2.2")
+    for index, row in enumerate(rows):
+        if y_pos - ROW_HEIGHT < BOTTOM_MARGIN:
+            _draw_footer(c, width, page_number)
+            c.showPage()
+            page_number += 1
+            y_pos = height - inch - ROW_HEIGHT
+            _draw_table_row(c, y_pos, TABLE_HEADERS, header=True)
+        y_pos -= ROW_HEIGHT
+        ip_address, country, isp, score, otx = row
+        _draw_table_row(c, y_pos, (ip_address or '', country or 'N/A', isp or '', score or 0, otx or 0), shaded=index % 2 == 0)
 
+    # --- Footer ---
+    _draw_footer(c, width, page_number)
     c.save()
-    
-    # --- Cleanup temporary graph files ---
-    for path in graph_paths.values():
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-            except OSError as e:
-                print(f"Error cleaning up temp graph file {path}: {e}")
-
@@ -0,0 +1,166 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+PROFILE_DIR = "profiles"
+TOP_FUNCTIONS = 30
+TOP_COROUTINES = 20
+TOP_ALLOCATIONS = 20
+
+# cProfile and tracemalloc are process-wide resources, so only one job is profiled at a time
+_session_lock = threading.Lock()
+
+# From 3.12 cProfile runs on sys.monitoring: one profiler per interpreter, seeing every thread
+PROFILER_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+def is_enabled():
+    return os.getenv("PROFILE_ANALYSIS", "false").strip().lower() in ("1", "true", "yes")
+
+def get_profile_dir():
+    return os.getenv("PROFILE_DIR", "").strip() or PROFILE_DIR
+
+class TaskTimer:
+    """ Times every asyncio task created on a loop while installed as its task factory. """
+    def __init__(self):
+        self.loop = None
+        self.previous_factory = None
+        self.durations = []  # (seconds, coroutine name, task name)
+
+    def install(self, loop):
+        self.loop = loop
+        self.previous_factory = loop.get_task_factory()
+        loop.set_task_factory(self._create_task)
+
+    def uninstall(self):
+        if self.loop is not None:
+            self.loop.set_task_factory(self.previous_factory)
+            self.loop = None
+
+    def _create_task(self, loop, coro, **kwargs):
+        if self.previous_factory is not None:
+            task = self.previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        started = time.perf_counter()
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        task.add_done_callback(lambda done: self.durations.append((time.perf_counter() - started, name, done.get_name())))
+        return task
+
+    def slowest(self, limit=TOP_COROUTINES):
+        return sorted(self.durations, reverse=True)[:limit]
+
+    def by_coroutine(self):
+        """ {coroutine name: (count, total seconds, max seconds)}, slowest total first. """
+        totals = {}
+        for seconds, name, _ in self.durations:
+            count, total, longest = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (count + 1, total + seconds, max(longest, seconds))
+        return dict(sorted(totals.items(), key=lambda item: item[1][1], reverse=True))
+
+class ProfileSession:
+    """
+    Profiles one analysis job: cProfile on the queue's event loop thread and inside the
+    job's worker-thread stages (see call()), per-task wall time on the loop, and tracemalloc
+    snapshots at checkpoints. The loop is shared, so concurrently running jobs show up in
+    the loop-side numbers too.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.loop_profile = cProfile.Profile()
+        self.profiles = []  # Every profiler that was actually enabled; merged by stop()
+        self.tasks = TaskTimer()
+        self.started_tracemalloc = False
+        self.started = None
+        self.peak_snapshot = None  # (traced bytes, checkpoint label, snapshot)
+
+    def start(self, loop):
+        """ Starts profiling on the loop thread; returns False if another job is already profiled. """
+        if not _session_lock.acquire(blocking=False):
+            return False
+        try:
+            self.loop_profile.enable()
+        except ValueError:  # Another profiling tool (e.g. a debugger or an outer cProfile) is active
+            _session_lock.release()
+            return False
+        self.profiles.append(self.loop_profile)
+        self.started = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.tasks.install(loop)
+        return True
+
+    def call(self, func, *args):
+        """
+        Runs a blocking stage in a worker thread under the session's profiling. Before 3.12
+        cProfile only sees the thread it was enabled on, so the stage gets a profiler of its own;
+        from 3.12 the loop's profiler already covers it.
+        """
+        if PROFILER_SEES_ALL_THREADS:
+            return func(*args)
+        profile = cProfile.Profile()
+        profile.enable()
+        self.profiles.append(profile)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+
+    def checkpoint(self, label):
+        """ Keeps the allocation snapshot of whichever checkpoint held the most traced memory. """
+        current, _ = tracemalloc.get_traced_memory()
+        if self.peak_snapshot is None or current > self.peak_snapshot[0]:
+            self.peak_snapshot = (current, label, tracemalloc.take_snapshot())
+
+    def stop(self, batch_id):
+        """ Stops profiling and writes the text report plus a .prof file; returns the report path. """
+        try:
+            self.loop_profile.disable()
+            self.tasks.uninstall()
+            self.checkpoint("end of run")
+            _, peak = tracemalloc.get_traced_memory()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+            stats = pstats.Stats(*self.profiles, stream=io.StringIO())
+
+            directory = get_profile_dir()
+            os.makedirs(directory, exist_ok=True)
+            base = os.path.join(directory, f"batch_{batch_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            stats.dump_stats(base + ".prof")
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(self._render(stats, peak))
+            return base + ".txt"
+        finally:
+            _session_lock.release()
+
+    def _render(self, stats, peak):
+        out = io.StringIO()
+        out.write(f"Profile of '{self.name}' ({datetime.now().isoformat(timespec='seconds')})\n")
+        out.write(f"Wall time: {time.perf_counter() - self.started:.3f}s, peak traced memory: {peak / 1024 / 1024:.1f} MB\n\n")
+
+        out.write(f"=== Top {TOP_FUNCTIONS} functions by cumulative time ===\n")
+        stats.stream = out
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+        out.write(f"=== Slowest {TOP_COROUTINES} asyncio tasks ===\n")
+        for seconds, name, task_name in self.tasks.slowest():
+            out.write(f"{seconds:10.3f}s  {name}  [{task_name}]\n")
+        out.write("\n=== Tasks by coroutine (count, total, max) ===\n")
+        for name, (count, total, longest) in self.tasks.by_coroutine().items():
+            out.write(f"{count:8d} {total:10.3f}s {longest:10.3f}s  {name}\n")
+
+        if self.peak_snapshot:
+            current, label, snapshot = self.peak_snapshot
+            out.write(f"\n=== Top {TOP_ALLOCATIONS} allocations by line at '{label}' ({current / 1024 / 1024:.1f} MB traced) ===\n")
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                out.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}\n")
+        return out.getvalue()
@@ -1,10 +1,16 @@
 import customtkinter as ctk
 from tkinter import ttk, messagebox
+import itertools
+
+import database
+import pdf_generator
+
+BASELINE_OPTIONS = ("All Previous Batches", "Last N Batches", "Last N Days")
 
 class RecurrenceReportWindow(ctk.CTkToplevel):
     def __init__(self, master, data):
         super().__init__(master)
-        self.title("Recurrence Report (Latest vs. All Previous)")
+        self.title("Recurrence Report (Latest vs. Previous)")
         self.geometry("1200x600")
         self.transient(master)
         self.grab_set()
@@ -16,11 +22,25 @@ class RecurrenceReportWindow(ctk.CTkToplevel):
         self.header_frame = ctk.CTkFrame(self)
         self.header_frame.grid(row=0, column=0, padx=10, pady=10, sticky="ew")
         
-        self.title_label = ctk.CTkLabel(self.header_frame, text=f"Found {len(data)} Recurring IPs", font=ctk.CTkFont(weight="bold"))
-        self.title_label.pack(padx=10, pady=5)
+        self.title_label = ctk.CTkLabel(self.header_frame, text="", font=ctk.CTkFont(weight="bold"))
+        self.title_label.pack(side="left", padx=10, pady=5)
+
+        # --- Baseline Window ---
+        self.apply_button = ctk.CTkButton(self.header_frame, text="Apply", width=80, command=self.apply_baseline)
+        self.apply_button.pack(side="right", padx=(5, 10), pady=5)
+
+        self.baseline_entry = ctk.CTkEntry(self.header_frame, width=60, placeholder_text="N")
+        self.baseline_entry.pack(side="right", padx=5, pady=5)
+
+        self.baseline_menu = ctk.CTkOptionMenu(self.header_frame, values=list(BASELINE_OPTIONS))
+        self.baseline_menu.set(BASELINE_OPTIONS[0])
+        self.baseline_menu.pack(side="right", padx=5, pady=5)
+
+        self.baseline_label = ctk.CTkLabel(self.header_frame, text="Baseline:")
+        self.baseline_label.pack(side="right", padx=5, pady=5)
 
         # --- Treeview for Data ---
-        self.columns = ("ip_address", "country", "fraud_score", "isp", "organization", "otx_pulses", "tags")
+        self.columns = ("ip_address", "country", "fraud_score", "isp", "organization", "otx_pulses", "previous_batches", "first_seen", "tags")
         self.tree = ttk.Treeview(self, columns=self.columns, show="headings")
         
         for col in self.columns:
@@ -29,6 +49,8 @@ class RecurrenceReportWindow(ctk.CTkToplevel):
         self.tree.column("ip_address", width=120)
         self.tree.column("isp", width=150)
         self.tree.column("organization", width=150)
+        self.tree.column("previous_batches", width=110, anchor="center")
+        self.tree.column("first_seen", width=140)
         self.tree.column("tags", width=150)
 
         self.tree.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="nsew")
@@ -40,13 +62,33 @@ class RecurrenceReportWindow(ctk.CTkToplevel):
 
         self.populate_data(data)
 
-    def populate_data(self, data):
-        """ Populates the treeview with recurring IP details, now fully armored. """
+    def apply_baseline(self):
+        """ Re-runs the recurrence query against the selected baseline window. """
+        choice = self.baseline_menu.get()
+        baseline_batches = baseline_days = None
+        if choice != BASELINE_OPTIONS[0]:
+            value = self.baseline_entry.get().strip()
+            if not value.isdigit() or int(value) < 1:
+                messagebox.showerror("Invalid Input", "N must be a positive number.", parent=self)
+                return
+            if choice == "Last N Batches":
+                baseline_batches = int(value)
+            else:
+                baseline_days = int(value)
+        self.populate_data(database.iter_recurring_ips(baseline_batches=baseline_batches, baseline_days=baseline_days))
+
+    def populate_data(self, chunks):
+        """ Populates the treeview from streamed chunks of recurring IP details, now fully armored. """
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+
         self.tree.tag_configure('high_risk', background='#E74C3C', foreground='white')
         self.tree.tag_configure('medium_risk', background='#F39C12', foreground='black')
 
-        for row in data:
-            if not row: continue
+        high_risk_score = pdf_generator.high_risk_threshold()
+        found = 0
+        for row in itertools.chain.from_iterable(chunks):
+            found += 1
 
             # --- Fully Armored Data Preparation for Display ---
             display_values = (
@@ -56,15 +98,13 @@ class RecurrenceReportWindow(ctk.CTkToplevel):
                 row['isp'] or "",
                 row['organization'] or "",
                 row['otx_pulses'] or 0,
+                row['previous_batches'] or 0,
+                (row['first_seen'] or "").replace("T", " ")[:19],
                 row['tags'] or ""
             )
 
-            tags_to_apply = ()
-            score = display_values[2] 
-            if score > 85:
-                tags_to_apply = ('high_risk',)
-            elif score >= 75:
-                tags_to_apply = ('medium_risk',)
+            tags_to_apply = pdf_generator.risk_tags(display_values[2], high_risk_score)
 
             self.tree.insert("", "end", values=display_values, tags=tags_to_apply)
 
+        self.title_label.configure(text=f"Found {found} Recurring IPs")
@@ -0,0 +1,27 @@
+import argparse
+
+import api
+import database
+
+def run(threshold=None, log=print):
+    """
+    Re-derives `is_malicious` (at MALICIOUS_THRESHOLD unless `threshold` is given) and the
+    promoted IPQS columns from what is already stored; no provider is queried.
+    """
+    if threshold is None:
+        threshold = api.get_malicious_threshold()
+    counts = database.rederive_ip_records(threshold)
+    log(f"[REDERIVE] Decoded {counts['payloads']} stored IPQS payloads: {counts['promoted']} records got new "
+        f"proxy/VPN/Tor/bot fields, {counts['malicious']} changed malicious status (threshold {threshold}).")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-derive LOCKON IP Prism verdicts from stored provider data (no API calls).")
+    parser.add_argument("--threshold", type=int, help="fraud score from which an IP is malicious (default MALICIOUS_THRESHOLD or 85)")
+    args = parser.parse_args()
+
+    database.setup_database()
+    run(args.threshold)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta
+
+import api
+import budget
+import database
+import metrics
+import report_cache
+
+PROVIDER_REFRESH = "ipqs_refresh"  # api_usage row counting the IPQS credits spent ahead of expiry
+CHUNK_SIZE = 10                    # Lookups started together; the queue is re-checked between chunks
+CANDIDATE_LIMIT = 500              # Most IPs considered per pass
+
+def _env_int(name, default):
+    value = os.getenv(name, "").strip()
+    return int(value) if value.isdigit() else default
+
+class _RefreshClient:
+    """ The lookup client JobQueue.start_lookup() reports to for refresh-ahead lookups. """
+    def __init__(self, api_key_otx, run_metrics):
+        self.api_key_otx = api_key_otx
+        self.metrics = run_metrics
+        self.ipqs_calls = 0
+
+    def progress_callback(self, ip_info):
+        if 'result' in ip_info and not ip_info.get('otx_only') and not ip_info.get('shared'):
+            self.ipqs_calls += 1
+
+    def lookup_done(self, result, info):
+        pass
+
+class RefreshScheduler:
+    """
+    Refresh-ahead: every REFRESH_AHEAD_INTERVAL_MINUTES, while no analysis job is queued or
+    running, re-queries IPs that recur in REFRESH_AHEAD_MIN_BATCHES+ batches or scored high
+    and whose IPQS data expires within REFRESH_AHEAD_WINDOW_HOURS, so the next batch over
+    known infrastructure is served from the cache. At most REFRESH_AHEAD_CREDITS_PER_DAY IPQS
+    credits are spent this way (0 disables it), never more than IPQS_CREDIT_CAP_DAY leaves.
+    """
+    def __init__(self, queue, api_key_otx, cache_duration_hours, log):
+        self.queue = queue
+        self.api_key_otx = api_key_otx
+        self.log = log
+        self.daily_credits = _env_int("REFRESH_AHEAD_CREDITS_PER_DAY", 0)
+        self.window = timedelta(hours=_env_int("REFRESH_AHEAD_WINDOW_HOURS", max(1, cache_duration_hours // 6)))
+        self.min_batches = _env_int("REFRESH_AHEAD_MIN_BATCHES", 2)
+        self.interval = max(1, _env_int("REFRESH_AHEAD_INTERVAL_MINUTES", 15)) * 60
+        self.ttls = budget.get_provider_ttls(cache_duration_hours)
+        self.metrics = metrics.RunMetrics()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def is_enabled(self):
+        return self.daily_credits > 0 and bool(api.get_ipqs_api_key())
+
+    def start(self):
+        if self.is_enabled():
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            if self.queue.is_busy():
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log(f"[REFRESH] Refresh-ahead pass failed: {e}")
+
+    def credits_available(self):
+        available = self.daily_credits - database.get_api_usage(PROVIDER_REFRESH)
+        day_cap = budget.get_caps()[1]
+        if day_cap is not None:
+            available = min(available, day_cap - database.get_api_usage(budget.PROVIDER_IPQS) - self.queue.reserved_credits)
+        return max(0, available)
+
+    def run_once(self):
+        """ One blocking refresh pass; returns the number of IPQS credits spent. """
+        credits = self.credits_available()
+        if not credits:
+            return 0
+        now = datetime.now()
+        ttl = self.ttls[budget.PROVIDER_IPQS]
+        rows = database.get_refresh_candidates(
+            (now - ttl + self.window).isoformat(), (now - ttl - self.window).isoformat(),
+            self.min_batches, budget.HIGH_SCORE, min(credits, CANDIDATE_LIMIT)
+        )
+        # A failing IP would otherwise be retried (and maybe charged) on every pass
+        rows = [row for row in rows if not api.is_negatively_cached(row, now)]
+        if not rows:
+            return 0
+        self.queue.start()
+        return asyncio.run_coroutine_threadsafe(self._refresh(rows), self.queue.loop).result()
+
+    async def _refresh(self, rows):
+        client = _RefreshClient(self.api_key_otx, self.metrics)
+        # Providers count as stale `window` before they actually expire
+        ahead = {provider: max(ttl - self.window, timedelta(0)) for provider, ttl in self.ttls.items()}
+        refreshed_ids = []
+        self.queue.reserved_credits += len(rows)
+        try:
+            for start in range(0, len(rows), CHUNK_SIZE):
+                # Analysis jobs have priority: stop as soon as one is queued
+                if self.stop_event.is_set() or self.queue.is_busy():
+                    break
+                lookups = []
+                for details in rows[start:start + CHUNK_SIZE]:
+                    providers = budget.stale_providers(details, ahead, otx_enabled=bool(self.api_key_otx))
+                    info = {'ip': details['ip_address'], 'details': details, 'providers': providers}
+                    if budget.PROVIDER_IPQS not in providers or self.queue.inflight_future(info):
+                        continue
+                    lookups.append(self.queue.start_lookup(client, info))
+                    refreshed_ids.append(details['id'])
+                await asyncio.gather(*lookups, return_exceptions=True)
+        finally:
+            self.queue.reserved_credits -= len(rows)
+            database.add_api_usage(budget.PROVIDER_IPQS, client.ipqs_calls)
+            database.add_api_usage(PROVIDER_REFRESH, client.ipqs_calls)
+
+        report_cache.invalidate_ips(refreshed_ids)
+        if refreshed_ids:
+            self.log(f"[REFRESH] Refreshed {client.ipqs_calls} of {len(refreshed_ids)} soon-to-expire recurring/high-risk IPs ahead of time.")
+        return client.ipqs_calls
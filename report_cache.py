@@ -0,0 +1,161 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+from sqlite3 import Error
+
+import database
+
+CACHE_DIR = "report_cache"
+ALL_BATCHES = 0  # batch_id recorded for artifacts built from the "All Batches" view
+
+_lock = threading.Lock()
+
+def get_max_bytes():
+    return int(os.getenv("REPORT_CACHE_MAX_MB", 200)) * 1024 * 1024
+
+def compute_key(kind, batch_ids, *extra):
+    """
+    Content address of a report: the artifact kind, the batches it covers, their current
+    fingerprint (membership + last-modified state) and any extra inputs such as the title.
+    Returns None when the fingerprint cannot be computed, which disables caching for that call.
+    """
+    fingerprint = database.get_batch_fingerprint(batch_ids)
+    if fingerprint is None:
+        return None
+    material = json.dumps([kind, sorted(batch_ids), fingerprint, extra], default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def _path_for(file_name):
+    return os.path.join(CACHE_DIR, file_name)
+
+def get(key):
+    """ Returns the cached file path for `key` (refreshing its LRU position) or None. """
+    if key is None: return None
+    conn = database.create_connection()
+    if conn is None: return None
+    try:
+        with _lock:
+            cursor = conn.cursor()
+            cursor.execute("SELECT file_name FROM report_cache WHERE cache_key = ?", (key,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            path = _path_for(row['file_name'])
+            if not os.path.exists(path):
+                cursor.execute("DELETE FROM report_cache WHERE cache_key = ?", (key,))
+                conn.commit()
+                return None
+            cursor.execute("UPDATE report_cache SET last_used = ? WHERE cache_key = ?", (datetime.now().isoformat(), key))
+            conn.commit()
+            return path
+    except Error as e:
+        print(f"Error reading report cache: {e}")
+        return None
+    finally:
+        conn.close()
+
+def put(key, batch_ids, source, extension=""):
+    """
+    Stores an artifact (a file path or raw bytes) under `key`, then evicts the least recently
+    used entries until the cache fits in REPORT_CACHE_MAX_MB. `batch_ids` ties the entry to
+    batches for invalidation ([] = "All Batches", None = not tied to any batch).
+    """
+    if key is None: return None
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file_name = key + extension
+    path = _path_for(file_name)
+    if isinstance(source, (bytes, bytearray)):
+        with open(path, "wb") as f:
+            f.write(source)
+    else:
+        shutil.copyfile(source, path)
+    conn = database.create_connection()
+    if conn is None: return path
+    try:
+        with _lock:
+            cursor = conn.cursor()
+            cursor.execute("INSERT OR REPLACE INTO report_cache (cache_key, file_name, size_bytes, last_used) VALUES (?, ?, ?, ?)",
+                           (key, file_name, os.path.getsize(path), datetime.now().isoformat()))
+            if batch_ids is not None:
+                cursor.executemany("INSERT OR IGNORE INTO report_cache_batches (cache_key, batch_id) VALUES (?, ?)",
+                                   [(key, batch_id) for batch_id in (batch_ids or [ALL_BATCHES])])
+            conn.commit()
+            _evict(conn)
+        return path
+    except Error as e:
+        print(f"Error writing report cache: {e}")
+        return path
+    finally:
+        conn.close()
+
+def _evict(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT TOTAL(size_bytes) AS total FROM report_cache")
+    total = cursor.fetchone()['total']
+    max_bytes = get_max_bytes()
+    if total <= max_bytes:
+        return
+    cursor.execute("SELECT cache_key, file_name, size_bytes FROM report_cache ORDER BY last_used ASC")
+    evicted = []
+    for row in cursor.fetchall():
+        if total <= max_bytes:
+            break
+        evicted.append(row)
+        total -= row['size_bytes']
+    _remove_entries(conn, evicted)
+
+def _remove_entries(conn, rows):
+    for row in rows:
+        try:
+            os.remove(_path_for(row['file_name']))
+        except OSError:
+            pass
+    conn.executemany("DELETE FROM report_cache WHERE cache_key = ?", [(row['cache_key'],) for row in rows])
+    conn.commit()
+
+def invalidate_batches(batch_ids):
+    """ Drops every artifact built from one of `batch_ids` or from the "All Batches" view. """
+    _invalidate("batch_id IN (SELECT value FROM json_each(?))", [json.dumps([ALL_BATCHES] + list(batch_ids))])
+
+def invalidate_ips(ip_ids):
+    """ Drops every artifact whose batches contain one of `ip_ids` (e.g. after an edit). """
+    _invalidate(
+        "batch_id = ? OR batch_id IN (SELECT batch_id FROM batch_ip_link WHERE ip_id IN (SELECT value FROM json_each(?)))",
+        [ALL_BATCHES, json.dumps(list(ip_ids))]
+    )
+
+def _invalidate(condition, params):
+    conn = database.create_connection()
+    if conn is None: return
+    try:
+        with _lock:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT cache_key, file_name FROM report_cache WHERE cache_key IN (
+                    SELECT cache_key FROM report_cache_batches WHERE {condition}
+                )
+            """, params)
+            _remove_entries(conn, cursor.fetchall())
+    except Error as e:
+        print(f"Error invalidating report cache: {e}")
+    finally:
+        conn.close()
+
+def cached_chart(kind, inputs, render):
+    """
+    Returns a PNG buffer for a chart, rendering it with `render()` only when no chart was
+    cached for exactly these inputs. Charts are keyed by their inputs alone, so they never go stale.
+    """
+    key = hashlib.sha256(json.dumps([kind, inputs], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    path = get(key)
+    if path:
+        with open(path, "rb") as f:
+            return io.BytesIO(f.read())
+    buffer = render()
+    put(key, None, buffer.getvalue(), ".png")
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import weakref
+
+import aiohttp
+
+DEFAULT_DNS_CACHE_SECONDS = 300
+REFRESH_AHEAD_FRACTION = 0.2   # Re-resolve in the background during the last 20% of an entry's lifetime
+MAX_STALE_SECONDS = 24 * 3600  # How long an expired answer may still be served while DNS is failing
+
+# --- Last-resort addresses for the provider hosts, used only if they were never resolved and DNS fails ---
+FALLBACK_IPS = {
+    "www.ipqualityscore.com": "104.18.12.18",
+    "otx.alienvault.com": "34.239.115.143",
+}
+
+def get_dns_cache_seconds():
+    """ How long a resolved address is trusted (DNS_CACHE_SECONDS, default 300). """
+    value = os.getenv("DNS_CACHE_SECONDS", "").strip()
+    return int(value) if value.isdigit() and int(value) > 0 else DEFAULT_DNS_CACHE_SECONDS
+
+class DnsCache:
+    """
+    Host -> addresses, shared by every event loop and thread of the process. Nothing is
+    resolved until first asked for, and resolution runs through loop.getaddrinfo(), so it never
+    blocks a loop. Answers are kept for DNS_CACHE_SECONDS; near expiry they are refreshed in
+    the background while the old answer is still served, and if DNS fails an expired answer
+    (or FALLBACK_IPS) is served instead of an error.
+    """
+    def __init__(self, fallback=None):
+        self.fallback = dict(fallback or {})
+        self._entries = {}  # (host, family): (addresses, resolved_at, expires_at)
+        self._lock = threading.Lock()
+        self._inflight = weakref.WeakKeyDictionary()  # loop -> {(host, family): task}
+
+    async def resolve(self, host, family=socket.AF_INET):
+        """ [(family, address), ...] for `host`. """
+        key = (host, family)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            addresses, resolved_at, expires_at = entry
+            if now < expires_at:
+                if now >= expires_at - (expires_at - resolved_at) * REFRESH_AHEAD_FRACTION:
+                    self._lookup(key)  # Refresh ahead; this caller keeps the current answer
+                return addresses
+        try:
+            return await asyncio.shield(self._lookup(key))
+        except OSError as e:
+            if entry is not None and now < entry[2] + MAX_STALE_SECONDS:
+                print(f"Warning: DNS resolution failed for {host} ({e}). Using the last known address.")
+                return entry[0]
+            if host in self.fallback:
+                print(f"Warning: DNS resolution failed for {host} ({e}). Using fallback IP.")
+                return [(socket.AF_INET, self.fallback[host])]
+            raise
+
+    def _lookup(self, key):
+        """ The running resolution task for `key` on this loop, starting one if there is none. """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            tasks = self._inflight.setdefault(loop, {})
+            task = tasks.get(key)
+            if task is None:
+                task = tasks[key] = loop.create_task(self._query(key))
+                task.add_done_callback(lambda done: self._finish(loop, key, done))
+        return task
+
+    def _finish(self, loop, key, task):
+        with self._lock:
+            self._inflight.get(loop, {}).pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Retrieved here so unawaited background refreshes are not reported as lost
+
+    async def _query(self, key):
+        host, family = key
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys((info[0], info[4][0]) for info in infos))
+        if not addresses:
+            raise OSError(f"No addresses found for {host}")
+        resolved_at = time.monotonic()
+        with self._lock:
+            self._entries[key] = (addresses, resolved_at, resolved_at + get_dns_cache_seconds())
+        return addresses
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+dns_cache = DnsCache(FALLBACK_IPS)
+
+class CachingResolver(aiohttp.abc.AbstractResolver):
+    """ aiohttp resolver backed by the process-wide dns_cache. """
+    def __init__(self, cache=None):
+        self.cache = cache or dns_cache
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addresses = await self.cache.resolve(host, family)
+        return [{'hostname': host, 'host': address, 'port': port, 'family': address_family,
+                 'proto': 0, 'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV}
+                for address_family, address in addresses]
+
+    async def close(self):
+        pass
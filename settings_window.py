@@ -1,8 +1,13 @@
 import customtkinter as ctk
-from tkinter import messagebox
+from tkinter import messagebox, filedialog
 from dotenv import find_dotenv, set_key
 import os
+import threading
+import api
 import database
+import feeds
+import ip_filter
+import snapshot
 
 class SettingsWindow(ctk.CTkToplevel):
     def __init__(self, master):
@@ -10,37 +15,129 @@ class SettingsWindow(ctk.CTkToplevel):
         self.master = master
 
         self.title("Settings")
-        self.geometry("500x400") # Increased height for cache setting
+        self.geometry("640x640")
         self.transient(master)
         self.grab_set()
 
-        self.grid_columnconfigure(1, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+        # --- Scrollable form holding every setting ---
+        self.form = ctk.CTkScrollableFrame(self)
+        self.form.grid(row=0, column=0, padx=10, pady=(10, 0), sticky="nsew")
+        self.form.grid_columnconfigure(1, weight=1)
 
         # --- IPQualityScore API Key ---
-        self.ipqs_label = ctk.CTkLabel(self, text="IPQualityScore API Key:")
+        self.ipqs_label = ctk.CTkLabel(self.form, text="IPQualityScore API Key:")
         self.ipqs_label.grid(row=0, column=0, padx=10, pady=(20, 5), sticky="w")
-        self.ipqs_entry = ctk.CTkEntry(self, width=300)
+        self.ipqs_entry = ctk.CTkEntry(self.form, width=300)
         self.ipqs_entry.grid(row=0, column=1, padx=10, pady=(20, 5), sticky="ew")
 
         # --- AlienVault OTX API Key ---
-        self.otx_label = ctk.CTkLabel(self, text="AlienVault OTX API Key:")
+        self.otx_label = ctk.CTkLabel(self.form, text="AlienVault OTX API Key:")
         self.otx_label.grid(row=1, column=0, padx=10, pady=5, sticky="w")
-        self.otx_entry = ctk.CTkEntry(self, width=300)
+        self.otx_entry = ctk.CTkEntry(self.form, width=300)
         self.otx_entry.grid(row=1, column=1, padx=10, pady=5, sticky="ew")
 
         # --- NEW: Cache Duration Setting ---
-        self.cache_label = ctk.CTkLabel(self, text="Cache Duration (hours):")
+        self.cache_label = ctk.CTkLabel(self.form, text="Cache Duration (hours):")
         self.cache_label.grid(row=2, column=0, padx=10, pady=5, sticky="w")
-        self.cache_entry = ctk.CTkEntry(self, width=100)
+        self.cache_entry = ctk.CTkEntry(self.form, width=100)
         self.cache_entry.grid(row=2, column=1, padx=10, pady=5, sticky="w")
         
+        # --- Offline GeoIP/ASN Enrichment ---
+        self.geoip_label = ctk.CTkLabel(self.form, text="GeoIP Country File:")
+        self.geoip_label.grid(row=3, column=0, padx=10, pady=5, sticky="w")
+        self.geoip_entry = ctk.CTkEntry(self.form, width=300, placeholder_text="Optional .csv/.tsv(.gz) range file")
+        self.geoip_entry.grid(row=3, column=1, padx=10, pady=5, sticky="ew")
+        self.geoip_browse = ctk.CTkButton(self.form, text="...", width=30, command=lambda: self.browse_file(self.geoip_entry))
+        self.geoip_browse.grid(row=3, column=2, padx=(0, 10), pady=5)
+
+        self.asn_label = ctk.CTkLabel(self.form, text="ASN File:")
+        self.asn_label.grid(row=4, column=0, padx=10, pady=5, sticky="w")
+        self.asn_entry = ctk.CTkEntry(self.form, width=300, placeholder_text="Optional ip2asn-v4.tsv(.gz)")
+        self.asn_entry.grid(row=4, column=1, padx=10, pady=5, sticky="ew")
+        self.asn_browse = ctk.CTkButton(self.form, text="...", width=30, command=lambda: self.browse_file(self.asn_entry))
+        self.asn_browse.grid(row=4, column=2, padx=(0, 10), pady=5)
+
+        self.skip_countries_label = ctk.CTkLabel(self.form, text="Skip IPQS for Countries:")
+        self.skip_countries_label.grid(row=5, column=0, padx=10, pady=5, sticky="w")
+        self.skip_countries_entry = ctk.CTkEntry(self.form, width=300, placeholder_text="e.g. TH,JP  (* = offline data only)")
+        self.skip_countries_entry.grid(row=5, column=1, padx=10, pady=5, sticky="ew")
+
+        # --- IP Filtering (applied before any API query) ---
+        self.allowlist_label = ctk.CTkLabel(self.form, text="Only Query CIDRs:")
+        self.allowlist_label.grid(row=6, column=0, padx=10, pady=5, sticky="w")
+        self.allowlist_entry = ctk.CTkEntry(self.form, width=300, placeholder_text="Allowlist, e.g. 1.0.0.0/8 (empty = all)")
+        self.allowlist_entry.grid(row=6, column=1, padx=10, pady=5, sticky="ew")
+
+        self.denylist_label = ctk.CTkLabel(self.form, text="Never Query CIDRs:")
+        self.denylist_label.grid(row=7, column=0, padx=10, pady=5, sticky="w")
+        self.denylist_entry = ctk.CTkEntry(self.form, width=300, placeholder_text="Denylist, e.g. 203.0.113.0/24, 8.8.8.8")
+        self.denylist_entry.grid(row=7, column=1, padx=10, pady=5, sticky="ew")
+
+        self.bogons_var = ctk.StringVar(value="true")
+        self.bogons_checkbox = ctk.CTkCheckBox(self.form, text="Drop private, loopback and reserved (bogon) IPs", variable=self.bogons_var, onvalue="true", offvalue="false")
+        self.bogons_checkbox.grid(row=8, column=1, padx=10, pady=5, sticky="w")
+
+        # --- IPQS Credit Budget (empty = unlimited) ---
+        self.batch_cap_label = ctk.CTkLabel(self.form, text="IPQS Credit Cap per Batch:")
+        self.batch_cap_label.grid(row=9, column=0, padx=10, pady=5, sticky="w")
+        self.batch_cap_entry = ctk.CTkEntry(self.form, width=100, placeholder_text="unlimited")
+        self.batch_cap_entry.grid(row=9, column=1, padx=10, pady=5, sticky="w")
+
+        self.day_cap_label = ctk.CTkLabel(self.form, text="IPQS Credit Cap per Day:")
+        self.day_cap_label.grid(row=10, column=0, padx=10, pady=5, sticky="w")
+        self.day_cap_entry = ctk.CTkEntry(self.form, width=100, placeholder_text="unlimited")
+        self.day_cap_entry.grid(row=10, column=1, padx=10, pady=5, sticky="w")
+
+        # --- Negative Cache for Failed Lookups ---
+        self.negative_cache_label = ctk.CTkLabel(self.form, text="Retry Failed Lookups After (min):")
+        self.negative_cache_label.grid(row=11, column=0, padx=10, pady=5, sticky="w")
+        self.negative_cache_entry = ctk.CTkEntry(self.form, width=100)
+        self.negative_cache_entry.grid(row=11, column=1, padx=10, pady=5, sticky="w")
+
+        # --- OTX pulse counts can be kept for a different time than IPQS data ---
+        self.otx_cache_label = ctk.CTkLabel(self.form, text="OTX Cache Duration (hours):")
+        self.otx_cache_label.grid(row=12, column=0, padx=10, pady=5, sticky="w")
+        self.otx_cache_entry = ctk.CTkEntry(self.form, width=100, placeholder_text="same")
+        self.otx_cache_entry.grid(row=12, column=1, padx=10, pady=5, sticky="w")
+
+        # --- Refresh-ahead: spend idle time re-validating recurring/high-risk IPs before they expire ---
+        self.refresh_label = ctk.CTkLabel(self.form, text="Refresh-Ahead Credits per Day:")
+        self.refresh_label.grid(row=13, column=0, padx=10, pady=5, sticky="w")
+        self.refresh_entry = ctk.CTkEntry(self.form, width=100, placeholder_text="0 = off")
+        self.refresh_entry.grid(row=13, column=1, padx=10, pady=5, sticky="w")
+
+        # --- Verdict: fraud score from which an IP counts as malicious (re-derived offline on change) ---
+        self.threshold_label = ctk.CTkLabel(self.form, text="Malicious Score Threshold:")
+        self.threshold_label.grid(row=14, column=0, padx=10, pady=5, sticky="w")
+        self.threshold_entry = ctk.CTkEntry(self.form, width=100, placeholder_text="85")
+        self.threshold_entry.grid(row=14, column=1, padx=10, pady=5, sticky="w")
+
+        # --- Diagnostics ---
+        self.profile_var = ctk.StringVar(value="false")
+        self.profile_checkbox = ctk.CTkCheckBox(self.form, text="Profile analysis runs (slower; writes a report to profiles/)", variable=self.profile_var, onvalue="true", offvalue="false")
+        self.profile_checkbox.grid(row=15, column=1, padx=10, pady=5, sticky="w")
+
+
         # --- Save Button ---
         self.save_button = ctk.CTkButton(self, text="Save and Apply", command=self.save_settings)
-        self.save_button.grid(row=3, column=0, columnspan=2, padx=10, pady=20)
+        self.save_button.grid(row=1, column=0, padx=10, pady=15)
+
+        # --- Cache snapshot: share paid lookups with other analysts' databases ---
+        self.snapshot_frame = ctk.CTkFrame(self, fg_color="transparent")
+        self.snapshot_frame.grid(row=2, column=0, padx=10, pady=(0, 10))
+        self.snapshot_export_button = ctk.CTkButton(self.snapshot_frame, text="Export Cache Snapshot", command=self.export_snapshot)
+        self.snapshot_export_button.pack(side="left", padx=5)
+        self.snapshot_import_button = ctk.CTkButton(self.snapshot_frame, text="Import Cache Snapshot", command=self.import_snapshot)
+        self.snapshot_import_button.pack(side="left", padx=5)
+        self.feed_import_button = ctk.CTkButton(self.snapshot_frame, text="Import Reputation Feed", command=self.import_feed)
+        self.feed_import_button.pack(side="left", padx=5)
 
         # --- Danger Zone ---
         self.danger_frame = ctk.CTkFrame(self, fg_color="transparent", border_color="#E74C3C", border_width=1)
-        self.danger_frame.grid(row=4, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
+        self.danger_frame.grid(row=3, column=0, padx=10, pady=(0, 10), sticky="ew")
         self.danger_frame.grid_columnconfigure(0, weight=1)
         
         self.danger_label = ctk.CTkLabel(self.danger_frame, text="Danger Zone", text_color="#E74C3C", font=ctk.CTkFont(weight="bold"))
@@ -57,6 +154,28 @@ class SettingsWindow(ctk.CTkToplevel):
         self.ipqs_entry.insert(0, self.master.api_key_ipqs or "")
         self.otx_entry.insert(0, self.master.api_key_otx or "")
         self.cache_entry.insert(0, str(self.master.cache_duration_hours))
+        self.geoip_entry.insert(0, os.getenv("GEOIP_COUNTRY_DB", ""))
+        self.asn_entry.insert(0, os.getenv("GEOIP_ASN_DB", ""))
+        self.skip_countries_entry.insert(0, os.getenv("IPQS_SKIP_COUNTRIES", ""))
+        self.allowlist_entry.insert(0, os.getenv("IP_ALLOWLIST", ""))
+        self.denylist_entry.insert(0, os.getenv("IP_DENYLIST", ""))
+        self.bogons_var.set("false" if os.getenv("DROP_BOGONS", "true").strip().lower() in ("0", "false", "no") else "true")
+        self.batch_cap_entry.insert(0, os.getenv("IPQS_CREDIT_CAP_BATCH", ""))
+        self.day_cap_entry.insert(0, os.getenv("IPQS_CREDIT_CAP_DAY", ""))
+        self.negative_cache_entry.insert(0, os.getenv("NEGATIVE_CACHE_MINUTES", "30"))
+        self.otx_cache_entry.insert(0, os.getenv("OTX_CACHE_HOURS", ""))
+        self.refresh_entry.insert(0, os.getenv("REFRESH_AHEAD_CREDITS_PER_DAY", ""))
+        self.threshold_entry.insert(0, str(api.get_malicious_threshold()))
+        self.profile_var.set("true" if os.getenv("PROFILE_ANALYSIS", "false").strip().lower() in ("1", "true", "yes") else "false")
+
+    def browse_file(self, entry):
+        file_path = filedialog.askopenfilename(
+            title="Select a range file",
+            filetypes=(("Range files", "*.csv *.tsv *.gz"), ("All files", "*.*"))
+        )
+        if file_path:
+            entry.delete(0, "end")
+            entry.insert(0, file_path)
 
 
     def save_settings(self):
@@ -70,6 +189,40 @@ class SettingsWindow(ctk.CTkToplevel):
             messagebox.showerror("Invalid Input", "Cache duration must be a positive number.")
             return
 
+        otx_cache_to_save = self.otx_cache_entry.get().strip()
+        if otx_cache_to_save and not otx_cache_to_save.isdigit():
+            messagebox.showerror("Invalid Input", "OTX cache duration must be a whole number of hours or empty.")
+            return
+
+        # Validate failed-lookup retry delay (doubles on every repeat failure)
+        negative_cache_to_save = self.negative_cache_entry.get().strip()
+        if not negative_cache_to_save.isdigit():
+            messagebox.showerror("Invalid Input", "Failed lookup retry delay must be a whole number of minutes.")
+            return
+
+        # Validate credit caps (empty = unlimited / off)
+        for label, entry in (("Credit cap per batch", self.batch_cap_entry), ("Credit cap per day", self.day_cap_entry),
+                             ("Refresh-ahead credits per day", self.refresh_entry)):
+            value = entry.get().strip()
+            if value and not value.isdigit():
+                messagebox.showerror("Invalid Input", f"{label} must be a whole number or empty.")
+                return
+
+        threshold_to_save = self.threshold_entry.get().strip()
+        if not threshold_to_save.isdigit() or int(threshold_to_save) > 100:
+            messagebox.showerror("Invalid Input", "Malicious score threshold must be a whole number from 0 to 100.")
+            return
+        threshold_changed = int(threshold_to_save) != api.get_malicious_threshold()
+
+        # Validate CIDR lists
+        for label, entry in (("Allowlist", self.allowlist_entry), ("Denylist", self.denylist_entry)):
+            for item in entry.get().replace(",", " ").split():
+                try:
+                    ip_filter.parse_cidr(item)
+                except ValueError:
+                    messagebox.showerror("Invalid Input", f"{label}: '{item}' is not a valid IPv4 address or CIDR.")
+                    return
+
         try:
             dotenv_path = find_dotenv()
             if not dotenv_path:
@@ -80,15 +233,89 @@ class SettingsWindow(ctk.CTkToplevel):
             set_key(dotenv_path, "IPQS_API_KEY", ipqs_key_to_save)
             set_key(dotenv_path, "OTX_API_KEY", otx_key_to_save)
             set_key(dotenv_path, "CACHE_DURATION_HOURS", cache_duration_to_save)
+            set_key(dotenv_path, "GEOIP_COUNTRY_DB", self.geoip_entry.get().strip())
+            set_key(dotenv_path, "GEOIP_ASN_DB", self.asn_entry.get().strip())
+            set_key(dotenv_path, "IPQS_SKIP_COUNTRIES", self.skip_countries_entry.get().strip().upper())
+            set_key(dotenv_path, "IP_ALLOWLIST", self.allowlist_entry.get().strip())
+            set_key(dotenv_path, "IP_DENYLIST", self.denylist_entry.get().strip())
+            set_key(dotenv_path, "DROP_BOGONS", self.bogons_var.get())
+            set_key(dotenv_path, "IPQS_CREDIT_CAP_BATCH", self.batch_cap_entry.get().strip())
+            set_key(dotenv_path, "IPQS_CREDIT_CAP_DAY", self.day_cap_entry.get().strip())
+            set_key(dotenv_path, "NEGATIVE_CACHE_MINUTES", negative_cache_to_save)
+            set_key(dotenv_path, "OTX_CACHE_HOURS", otx_cache_to_save)
+            set_key(dotenv_path, "REFRESH_AHEAD_CREDITS_PER_DAY", self.refresh_entry.get().strip())
+            set_key(dotenv_path, "MALICIOUS_THRESHOLD", threshold_to_save)
+            set_key(dotenv_path, "PROFILE_ANALYSIS", self.profile_var.get())
             
             messagebox.showinfo("Success", "Settings saved successfully!")
             
             self.master.check_api_key(from_settings=True)
+            if threshold_changed:
+                self.master.start_rederive()
             self.destroy()
 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save settings:\n{e}")
 
+    def export_snapshot(self):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".ipps", filetypes=[("Cache snapshots", "*.ipps"), ("All files", "*.*")], title="Export cache snapshot"
+        )
+        if file_path:
+            self._run_transfer(lambda: self._snapshot_message(snapshot.export_snapshot(file_path), "exported to", file_path))
+
+    def import_snapshot(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Cache snapshots", "*.ipps"), ("All files", "*.*")], title="Import cache snapshot"
+        )
+        if file_path:
+            self._run_transfer(lambda: self._snapshot_message(snapshot.import_snapshot(file_path), "imported from", file_path))
+
+    def _snapshot_message(self, counts, verb, file_path):
+        return f"{counts['ip_records']} IP records, {counts['import_batches']} batches and {counts['batch_ip_link']} links {verb}\n{file_path}"
+
+    def import_feed(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Feeds", "*.csv *.tsv *.ndjson *.jsonl *.json *.txt *.gz *.bz2 *.xz"), ("All files", "*.*")],
+            title="Import reputation feed"
+        )
+        if not file_path:
+            return
+        dialog = ctk.CTkInputDialog(text=f"Source name for this feed (default: {os.path.basename(file_path)}):", title="Feed Source")
+        source = (dialog.get_input() or "").strip() or os.path.basename(file_path)
+
+        def work():
+            counts = feeds.import_feed(file_path, source)
+            return f"{counts['imported']} entries imported from '{source}' ({counts['invalid']} invalid addresses skipped)."
+
+        self._run_transfer(work)
+
+    def _run_transfer(self, work):
+        """ Runs a snapshot/feed transfer on a worker thread; `work` returns the success message. """
+        buttons = (self.snapshot_export_button, self.snapshot_import_button, self.feed_import_button)
+        for button in buttons:
+            button.configure(state="disabled")
+
+        def worker():
+            try:
+                message, error = work(), None
+            except Exception as e:
+                message, error = None, e
+            self.after(0, self._transfer_finished, buttons, message, error)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _transfer_finished(self, buttons, message, error):
+        if not self.winfo_exists():
+            return
+        for button in buttons:
+            button.configure(state="normal")
+        if error is not None:
+            messagebox.showerror("Error", f"Import/export failed:\n{error}", parent=self)
+        else:
+            messagebox.showinfo("Success", message, parent=self)
+            self.master.update_dashboard()
+
     def clear_all_data(self):
         """ Deletes the database file and restarts the application. """
         if messagebox.askyesno("Confirm", "ARE YOU SURE?\n\nThis will permanently delete all analysis history. The application will close after this action."):
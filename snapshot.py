@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from sqlite3 import Error
+
+import database
+
+CHUNK_SIZE = 5000
+
+# --- Snapshot format ("IPPS"): magic, JSON header, then zlib-compressed JSON chunks of one table each ---
+SNAPSHOT_MAGIC = b"IPPS1\n"
+END_OF_SNAPSHOT = 0xFF
+
+# Written (and read back) in this order: links need their batch and IP to exist first
+TABLES = ("import_batches", "ip_records", "raw_payloads", "batch_ip_link")
+
+# Per-machine columns that do not travel: row ids are remapped through natural keys on import
+LOCAL_COLUMNS = {
+    "import_batches": {"id", "run_summary"},
+    "ip_records": {"id"},
+    "raw_payloads": set(),
+    "batch_ip_link": set(),
+}
+
+def _table_columns(conn, table):
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+# --- Export ---
+def _select_sql(conn, table):
+    """ (columns, SELECT) for one table, with ids swapped for their natural keys. """
+    if table == "raw_payloads":
+        return ["ip_address", "provider", "fetched_at", "payload"], """
+            SELECT r.ip_address, p.provider, p.fetched_at, p.payload
+            FROM raw_payloads p JOIN ip_records r ON r.id = p.ip_id
+        """
+    if table == "batch_ip_link":
+        return ["batch_id", "ip_address", "occurrences", "first_line", "last_line"], """
+            SELECT l.batch_id, r.ip_address, l.occurrences, l.first_line, l.last_line
+            FROM batch_ip_link l JOIN ip_records r ON r.id = l.ip_id
+        """
+    columns = [col for col in _table_columns(conn, table) if col not in LOCAL_COLUMNS[table]]
+    if table == "import_batches":
+        columns = ["id"] + columns  # Only to map links onto the importing machine's batch ids
+    return columns, f"SELECT {', '.join(columns)} FROM {table}"
+
+def _write_chunk(f, table_index, rows):
+    block = zlib.compress(json.dumps(rows, separators=(',', ':'), ensure_ascii=False).encode("utf-8"))
+    f.write(struct.pack("<BII", table_index, len(rows), len(block)))
+    f.write(block)
+
+def export_snapshot(file_path, progress_callback=None):
+    """
+    Writes every batch, IP record, raw payload and link into a compressed snapshot, streaming
+    `CHUNK_SIZE` rows at a time via a `.part` file that is renamed on success. Returns row counts per table.
+    """
+    conn = database.create_connection()
+    if conn is None:
+        raise Error("Could not open the database.")
+    conn.row_factory = None
+    part_path = file_path + ".part"
+    counts = {}
+    try:
+        with open(part_path, "wb") as f:
+            # One read transaction, so the tables are exported as one consistent state
+            conn.execute("BEGIN")
+            selects = [_select_sql(conn, table) for table in TABLES]
+            header = json.dumps({
+                "version": 1,
+                "created_at": datetime.now().isoformat(),
+                "tables": {table: columns for table, (columns, _) in zip(TABLES, selects)},
+            }).encode("utf-8")
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+
+            for table_index, (table, (columns, sql)) in enumerate(zip(TABLES, selects)):
+                cursor = conn.cursor()
+                cursor.arraysize = CHUNK_SIZE
+                cursor.execute(sql)
+                counts[table] = 0
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    if table == "raw_payloads":
+                        rows = [(ip, provider, fetched_at, database.decode_payload(payload)) for ip, provider, fetched_at, payload in rows]
+                    _write_chunk(f, table_index, rows)
+                    counts[table] += len(rows)
+                    if progress_callback:
+                        progress_callback(table, counts[table])
+            f.write(struct.pack("<BII", END_OF_SNAPSHOT, 0, 0))
+            conn.rollback()
+        os.replace(part_path, file_path)
+        return counts
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        conn.close()
+
+# --- Import ---
+def read_snapshot(file_path):
+    """ Yields (table, columns, rows) chunk by chunk from a snapshot file. """
+    with open(file_path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError("Not an IP Prism cache snapshot.")
+        header_len, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_len))
+        tables = header["tables"]
+        while True:
+            table_index, _, block_len = struct.unpack("<BII", f.read(9))
+            if table_index == END_OF_SNAPSHOT:
+                break
+            table = TABLES[table_index]
+            yield table, tables[table], json.loads(zlib.decompress(f.read(block_len)))
+
+def _import_batches(cursor, columns, rows, batch_ids):
+    """ Maps each snapshot batch onto the local batch with the same timestamp and file name, creating it if needed. """
+    shared = [col for col in columns if col != "id"]
+    for row in rows:
+        record = dict(zip(columns, row))
+        cursor.execute("SELECT id FROM import_batches WHERE import_timestamp = ? AND file_name = ?",
+                       (record['import_timestamp'], record['file_name']))
+        existing = cursor.fetchone()
+        if existing:
+            batch_ids[record['id']] = existing['id']
+        else:
+            cursor.execute(f"INSERT INTO import_batches ({', '.join(shared)}) VALUES ({', '.join('?' for _ in shared)})",
+                           [record[col] for col in shared])
+            batch_ids[record['id']] = cursor.lastrowid
+
+def _ip_records_upsert_sql(columns):
+    """
+    Inserts new IPs; an existing IP takes the snapshot row only if that row was checked against
+    the APIs more recently (newest `last_api_check` wins). Local tags/notes are kept unless empty.
+    `columns` ends with updated_at, which is set to the import time.
+    """
+    assignments = [f"{col} = COALESCE({col}, excluded.{col})" if col in ("tags", "notes") else f"{col} = excluded.{col}"
+                   for col in columns if col != "ip_address"]
+    return f"""
+        INSERT INTO ip_records ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})
+        ON CONFLICT(ip_address) DO UPDATE SET {', '.join(assignments)}
+        WHERE excluded.last_api_check IS NOT NULL AND (last_api_check IS NULL OR excluded.last_api_check > last_api_check)
+    """
+
+def import_snapshot(file_path, progress_callback=None):
+    """
+    Bulk-loads a snapshot into the local database in one transaction (all or nothing) with
+    executemany per chunk. Conflicting IPs keep whichever side has the newest `last_api_check`;
+    batches already present are reused and their links are not counted twice.
+    Columns this database does not have are dropped. Returns row counts per table as read.
+    """
+    conn = database.create_connection()
+    if conn is None:
+        raise Error("Could not open the database.")
+    imported_at = datetime.now().isoformat()
+    local_columns = {table: set(_table_columns(conn, table)) for table in TABLES}
+    batch_ids = {}
+    counts = {table: 0 for table in TABLES}
+    try:
+        with conn:
+            cursor = conn.cursor()
+            for table, columns, rows in read_snapshot(file_path):
+                if table == "import_batches":
+                    known = [i for i, col in enumerate(columns) if col in local_columns[table]]
+                    _import_batches(cursor, [columns[i] for i in known], [[row[i] for i in known] for row in rows], batch_ids)
+                elif table == "ip_records":
+                    # Rows updated by the import count as edited now, so cached reports are rebuilt
+                    known = [i for i, col in enumerate(columns) if col in local_columns[table] and col != "updated_at"]
+                    sql = _ip_records_upsert_sql([columns[i] for i in known] + ["updated_at"])
+                    cursor.executemany(sql, [[row[i] for i in known] + [imported_at] for row in rows])
+                elif table == "raw_payloads":
+                    cursor.executemany("""
+                        INSERT INTO raw_payloads (ip_id, provider, fetched_at, payload)
+                        SELECT id, ?, ?, ? FROM ip_records WHERE ip_address = ? AND (ipqs_checked_at IS NULL OR ipqs_checked_at <= ?)
+                        ON CONFLICT(ip_id, provider) DO UPDATE SET fetched_at = excluded.fetched_at, payload = excluded.payload
+                        WHERE excluded.fetched_at > fetched_at
+                    """, [(provider, fetched_at, database.encode_payload(payload), ip, fetched_at)
+                          for ip, provider, fetched_at, payload in rows])  # Never older than the row that won
+                elif table == "batch_ip_link":
+                    cursor.executemany("""
+                        INSERT INTO batch_ip_link (batch_id, ip_id, occurrences, first_line, last_line)
+                        SELECT ?, id, ?, ?, ? FROM ip_records WHERE ip_address = ?
+                        ON CONFLICT(batch_id, ip_id) DO NOTHING
+                    """, [(batch_ids[batch_id], occurrences, first, last, ip) for batch_id, ip, occurrences, first, last in rows])
+                counts[table] += len(rows)
+                if progress_callback:
+                    progress_callback(table, counts[table])
+        return counts
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the LOCKON IP Prism cache between machines.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("file", help="snapshot file (.ipps)")
+    args = parser.parse_args()
+
+    database.setup_database()
+    if args.action == "export":
+        counts = export_snapshot(args.file)
+    else:
+        counts = import_snapshot(args.file)
+    print(", ".join(f"{table}: {count}" for table, count in counts.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The application modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """ A fresh ip_prism.db in a temporary working directory (reports, metrics and profiles land there too). """
+    monkeypatch.chdir(tmp_path)
+    for key in ("IPQS_API_KEY", "OTX_API_KEY", "IPQS_CREDIT_CAP_DAY", "IPQS_CREDIT_CAP_BATCH", "IP_ALLOWLIST", "IP_DENYLIST"):
+        monkeypatch.setenv(key, "")
+    database.setup_database()
+    return tmp_path
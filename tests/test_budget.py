@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import budget
+import database
+
+NOW = datetime(2026, 10, 1, 12, 0)
+TTLS = {budget.PROVIDER_IPQS: timedelta(hours=24), budget.PROVIDER_OTX: timedelta(hours=72), budget.PROVIDER_FEED: timedelta(hours=12)}
+
+def _details(ipqs_age=None, otx_age=None, feed_age=None, **fields):
+    def checked(age):
+        return None if age is None else (NOW - timedelta(hours=age)).isoformat()
+    row = {'id': 1, 'fraud_score': 0, 'ipqs_checked_at': checked(ipqs_age), 'otx_checked_at': checked(otx_age),
+           'feed_checked_at': checked(feed_age)}
+    row.update(fields)
+    return row
+
+def test_stale_providers():
+    assert budget.stale_providers(None, TTLS, NOW) == {budget.PROVIDER_IPQS, budget.PROVIDER_OTX}
+    assert budget.stale_providers(None, TTLS, NOW, otx_enabled=False) == {budget.PROVIDER_IPQS}
+    assert budget.stale_providers(_details(ipqs_age=1, otx_age=1), TTLS, NOW) == set()
+    assert budget.stale_providers(_details(ipqs_age=30, otx_age=30), TTLS, NOW) == {budget.PROVIDER_IPQS}
+    assert budget.stale_providers(_details(ipqs_age=1, otx_age=100), TTLS, NOW) == {budget.PROVIDER_OTX}
+
+def test_fresh_feed_entry_covers_ipqs():
+    assert budget.stale_providers(_details(ipqs_age=30, feed_age=2), TTLS, NOW, otx_enabled=False) == set()
+    assert budget.fresh_reputation_source(_details(ipqs_age=30, feed_age=2), TTLS, NOW) == budget.PROVIDER_FEED
+    assert budget.fresh_reputation_source(_details(ipqs_age=1, feed_age=2), TTLS, NOW) == budget.PROVIDER_IPQS
+    assert budget.fresh_reputation_source(_details(ipqs_age=30, feed_age=13), TTLS, NOW) is None
+
+def test_provider_ttls(monkeypatch):
+    monkeypatch.setenv("OTX_CACHE_HOURS", "48")
+    monkeypatch.setenv("FEED_CACHE_HOURS", "")
+    ttls = budget.get_provider_ttls(6)
+    assert ttls == {budget.PROVIDER_IPQS: timedelta(hours=6), budget.PROVIDER_OTX: timedelta(hours=48), budget.PROVIDER_FEED: timedelta(hours=6)}
+
+def test_compute_budget_takes_the_smallest_limit():
+    assert budget.compute_budget() == (None, None)
+    assert budget.compute_budget(batch_cap=50, day_cap=100, used_today=70) == (30, "daily cap")
+    assert budget.compute_budget(batch_cap=20, day_cap=100, credits_remaining=40.0) == (20, "per-batch cap")
+    assert budget.compute_budget(day_cap=10, used_today=15, credits_remaining=5) == (0, "daily cap")
+
+def test_rank_key_orders_by_value():
+    def info(occurrences=0, **details):
+        return {'details': _details(**details) if details else None, 'occurrences': occurrences}
+    pending = {
+        'new': info(occurrences=1),
+        'new_frequent': info(occurrences=9),
+        'stale_3d': info(ipqs_age=72, id=2),
+        'stale_1d_high': info(ipqs_age=30, fraud_score=budget.HIGH_SCORE, id=3),
+        'stale_1d_recurring': info(ipqs_age=30, id=4),
+        'stale_1d_plain': info(ipqs_age=30, id=5),
+    }
+    batch_counts = {4: 2}
+    ranked = sorted(pending, key=lambda name: budget.rank_key(pending[name], batch_counts, NOW))
+    assert ranked[:3] == ['new_frequent', 'new', 'stale_3d']
+    assert ranked[-1] == 'stale_1d_plain'
+
+def test_plan_queries_respects_caps_and_reservations(db, monkeypatch):
+    monkeypatch.setenv("IPQS_CREDIT_CAP_DAY", "10")
+    database.add_api_usage(budget.PROVIDER_IPQS, 4)
+    pending = [{'ip': f"8.8.8.{i}", 'details': None, 'occurrences': i} for i in range(8)]
+
+    plan = budget.plan_queries(pending, reserved=2)
+    assert plan.is_limited()
+    assert (plan.budget, plan.limit_reason) == (4, "daily cap")
+    assert [info['ip'] for info in plan.to_query] == ["8.8.8.7", "8.8.8.6", "8.8.8.5", "8.8.8.4"]
+    assert len(plan.skipped) == 4
+
+    plan = budget.plan_queries(pending, credits_remaining=3, reserved=1)
+    assert (plan.budget, plan.limit_reason) == (2, "IPQS credits remaining")
+
+def test_plan_queries_without_limits(db):
+    plan = budget.plan_queries([{'ip': "8.8.8.8", 'details': None}])
+    assert not plan.is_limited() and plan.budget is None and len(plan.to_query) == 1
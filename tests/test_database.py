@@ -0,0 +1,45 @@
+import database
+
+def _seed():
+    batch_a = database.add_import_batch("2026-01-01T00:00:00", "a.log", None)
+    batch_b = database.add_import_batch("2026-01-02T00:00:00", "b.log", None)
+    for i in range(30):
+        database.add_ip_record(f"10.1.0.{i}", "TH" if i % 2 else "US", False, i * 3, f"ISP {i}", "Org_%" if i == 7 else "Org", 0)
+    ids = {row['ip_address']: row['id'] for row in database.find_ip_details_bulk([f"10.1.0.{i}" for i in range(30)], ("id", "ip_address"))}
+    for i in range(20):
+        database.link_ip_to_batch(ids[f"10.1.0.{i}"], batch_a, 1, i + 1, i + 1)
+    for i in range(10, 30):
+        database.link_ip_to_batch(ids[f"10.1.0.{i}"], batch_b, 2, i + 1, i + 1)
+    return batch_a, batch_b
+
+def test_records_behave_like_rows():
+    record = database.record_type(("id", "ip_address"))(1, "1.2.3.4")
+    assert record['ip_address'] == record.ip_address == record[1] == "1.2.3.4"
+    assert dict(record) == {'id': 1, 'ip_address': "1.2.3.4"}
+    assert not hasattr(record, "__dict__")
+
+def test_pages_cover_every_ip_once(db):
+    batch_a, batch_b = _seed()
+    assert database.count_ips_by_batch_ids([batch_a, batch_b]) == 30
+    seen = []
+    for offset in range(0, 30, 7):
+        page = database.get_ip_page([batch_a, batch_b], ("ip_address", "fraud_score"), offset=offset, limit=7)
+        seen += [row['ip_address'] for row in page]
+    assert len(seen) == len(set(seen)) == 30
+
+def test_page_order_and_search(db):
+    batch_a, _ = _seed()
+    page = database.get_ip_page([batch_a], ("ip_address", "fraud_score"), order_by="fraud_score", descending=False, limit=3)
+    assert [row['fraud_score'] for row in page] == [0, 3, 6]
+    page = database.get_ip_page([], ("ip_address",), order_by="ip_address", limit=3)
+    assert [row['ip_address'] for row in page] == ["10.1.0.29", "10.1.0.28", "10.1.0.27"]
+
+    assert database.count_ips_by_batch_ids([batch_a], "isp 1") == 11  # ISP 1, ISP 10-19
+    assert [row['ip_address'] for row in database.get_ip_page([], ("ip_address",), search="_%")] == ["10.1.0.7"]  # Wildcards are literal
+
+def test_volume_columns_are_aggregated(db):
+    batch_a, batch_b = _seed()
+    row, = database.get_ip_page([batch_a, batch_b], ("ip_address", "occurrences"), search="10.1.0.15")
+    assert row['occurrences'] == 3
+    row, = database.get_ip_page([], ("ip_address", "occurrences", "first_line"), search="10.1.0.15")
+    assert (row['occurrences'], row['first_line']) == (3, None)
@@ -0,0 +1,72 @@
+import csv
+import json
+import threading
+
+import pytest
+
+import database
+import exporter
+
+COLUMNS = ("id", "ip_address", "fraud_score", "notes", "occurrences")
+ROWS = [(1, "1.2.3.4", 90, "naïve, \"quoted\"", 3), (2, "5.6.7.8", None, None, 1), (3, "9.9.9.9", 0, "", None)]
+
+def _chunks():
+    yield ROWS[:2]
+    yield ROWS[2:]
+
+def test_format_for_path():
+    assert exporter.format_for_path("out.IPPC") == "columnar"
+    assert exporter.format_for_path("out.jsonl") == "ndjson"
+    assert exporter.format_for_path("out.txt") == "csv"
+
+def test_columnar_round_trip(tmp_path):
+    path = str(tmp_path / "out.ippc")
+    assert exporter.export_rows(path, COLUMNS, _chunks(), "columnar") == 3
+    chunks = list(exporter.read_columnar(path))
+    assert [columns for columns, _ in chunks] == [list(COLUMNS)] * 2
+    assert [row for _, rows in chunks for row in rows] == ROWS
+
+def test_ndjson_round_trip(tmp_path):
+    path = tmp_path / "out.ndjson"
+    exporter.export_rows(str(path), COLUMNS, _chunks(), "ndjson")
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == [dict(zip(COLUMNS, row)) for row in ROWS]
+
+def test_csv_round_trip(tmp_path):
+    path = tmp_path / "out.csv"
+    exporter.export_rows(str(path), COLUMNS, _chunks(), "csv")
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == list(COLUMNS)
+    assert rows[1] == ["1", "1.2.3.4", "90", "naïve, \"quoted\"", "3"]
+    assert len(rows) == 4
+
+def test_read_columnar_rejects_other_files(tmp_path):
+    path = tmp_path / "out.ippc"
+    path.write_bytes(b"id,ip_address\n")
+    with pytest.raises(ValueError):
+        list(exporter.read_columnar(str(path)))
+
+def test_cancelled_export_leaves_no_file(tmp_path):
+    path = tmp_path / "out.csv"
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(exporter.ExportCancelled):
+        exporter.export_rows(str(path), COLUMNS, _chunks(), "csv", cancel_event=cancel_event)
+    assert list(tmp_path.iterdir()) == []
+
+def test_export_job_streams_from_the_database(db):
+    batch_id = database.add_import_batch("2026-01-01T00:00:00", "a.log", None)
+    for i in range(5):
+        ip_id = database.add_ip_record(f"10.0.0.{i}", "US", False, i * 10, "ISP", "Org", 0)
+        database.link_ip_to_batch(ip_id, batch_id, i + 1, 1, i + 1)
+    results, progress = [], []
+    job = exporter.ExportJob(str(db / "out.ippc"), [batch_id], ("ip_address", "fraud_score", "occurrences"),
+                             progress_callback=lambda done, total: progress.append((done, total)),
+                             done_callback=results.append, chunk_size=2)
+    job.start()
+    job.thread.join(10)
+    assert results == [{'rows': 5}]
+    assert progress[-1] == (5, 5)
+    rows = sorted(row for _, chunk in exporter.read_columnar(str(db / "out.ippc")) for row in chunk)
+    assert rows == [(f"10.0.0.{i}", i * 10, i + 1) for i in range(5)]
@@ -0,0 +1,62 @@
+import bz2
+import gzip
+
+import ingest
+
+LOG = (b"1.2.3.4 - GET /\n"
+       b"no address here\n"
+       b"5.6.7.8 -> 1.2.3.4\n"
+       b"1.2.3.4 last")
+
+def test_scan_bytes_counts_and_line_numbers():
+    stats = {}
+    assert ingest.scan_bytes(LOG, stats) == 4
+    assert ingest.decode_stats(stats) == {"1.2.3.4": (3, 1, 4), "5.6.7.8": (1, 3, 3)}
+
+def test_scan_bytes_continues_from_offset():
+    stats = {}
+    assert ingest.scan_bytes(b"9.9.9.9\n", stats, line_offset=10) == 11
+    assert ingest.decode_stats(stats) == {"9.9.9.9": (1, 11, 11)}
+
+def test_merge_stats_shifts_later_lines():
+    merged = {"1.2.3.4": (2, 1, 5)}
+    ingest.merge_stats(merged, {"1.2.3.4": (1, 2, 2), "5.6.7.8": (1, 3, 3)}, line_offset=10)
+    assert merged == {"1.2.3.4": (3, 1, 12), "5.6.7.8": (1, 13, 13)}
+
+def test_canonicalize_stats_merges_spellings():
+    stats = {"010.0.0.1": (2, 4, 9), "10.0.0.1": (1, 1, 3), "999.1.1.1": (5, 1, 1)}
+    assert ingest.canonicalize_stats(stats) == {"10.0.0.1": (3, 1, 9)}
+
+def test_compressed_files_match_plain(tmp_path, monkeypatch):
+    monkeypatch.setenv("INGEST_WORKERS", "1")
+    plain = tmp_path / "access.log"
+    plain.write_bytes(LOG)
+    with gzip.open(tmp_path / "access.log.gz", "wb") as f:
+        f.write(LOG)
+    with bz2.open(tmp_path / "access.log.bz2", "wb") as f:
+        f.write(LOG)
+    expected = {"1.2.3.4": (3, 1, 4), "5.6.7.8": (1, 3, 3)}
+    for name in ("access.log", "access.log.gz", "access.log.bz2"):
+        assert ingest.extract_ip_stats_from_files([str(tmp_path / name)]) == expected
+
+def test_split_plain_file_keeps_line_numbers(tmp_path, monkeypatch):
+    monkeypatch.setenv("INGEST_WORKERS", "1")
+    monkeypatch.setattr(ingest, "SPLIT_SIZE", 7)  # Ranges start mid-line
+    path = tmp_path / "access.log"
+    path.write_bytes(LOG)
+    assert len(ingest._work_items([str(path)])) > 1
+    assert ingest.extract_ip_stats_from_files([str(path)]) == {"1.2.3.4": (3, 1, 4), "5.6.7.8": (1, 3, 3)}
+
+def test_files_merge_in_order_and_bad_files_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setenv("INGEST_WORKERS", "1")
+    first = tmp_path / "a.log"
+    first.write_bytes(b"x\n1.2.3.4\n")
+    second = tmp_path / "b.log"
+    second.write_bytes(b"1.2.3.4\n1.2.3.4\n")
+    broken = tmp_path / "c.log.gz"
+    broken.write_bytes(b"not gzip")
+    warnings = []
+    stats = ingest.extract_ip_stats_from_files([str(first), str(tmp_path / "missing.log"), str(broken), str(second)],
+                                               log=warnings.append)
+    assert stats == {"1.2.3.4": (3, 2, 2)}
+    assert len(warnings) == 2
@@ -0,0 +1,57 @@
+import re
+
+import pytest
+
+import ip_filter
+
+def test_canonicalize():
+    assert ip_filter.canonicalize(" 010.001.002.003 ") == "10.1.2.3"
+    assert ip_filter.canonicalize("256.1.1.1") is None
+    assert ip_filter.canonicalize("1.2.3") is None
+    assert ip_filter.canonicalize("1.2.3.-4") is None
+
+def test_ip_int_round_trip():
+    for ip in ("0.0.0.0", "8.8.4.4", "255.255.255.255"):
+        assert ip_filter.int_to_ip(ip_filter.ip_to_int(ip)) == ip
+
+def test_parse_cidr():
+    assert ip_filter.parse_cidr("10.0.0.0/8") == (ip_filter.ip_to_int("10.0.0.0"), ip_filter.ip_to_int("10.255.255.255"))
+    assert ip_filter.parse_cidr("192.168.1.77/24") == (ip_filter.ip_to_int("192.168.1.0"), ip_filter.ip_to_int("192.168.1.255"))
+    assert ip_filter.parse_cidr("1.2.3.4") == (ip_filter.ip_to_int("1.2.3.4"),) * 2
+    assert ip_filter.parse_cidr("0.0.0.0/0") == (0, 0xFFFFFFFF)
+    with pytest.raises(ValueError):
+        ip_filter.parse_cidr("1.2.3.4/33")
+    with pytest.raises(ValueError):
+        ip_filter.parse_cidr("1.2.3/8")
+
+def test_parse_cidr_list_skips_invalid_entries():
+    assert ip_filter.parse_cidr_list("10.0.0.0/8, bogus 1.2.3.4/40\n5.6.7.0/24") == ["10.0.0.0/8", "5.6.7.0/24"]
+
+def test_cidr_set_merges_overlapping_and_adjacent_ranges():
+    cidrs = ip_filter.CidrSet(["10.0.0.0/25", "10.0.0.128/25", "10.0.0.64/26", "192.168.0.0/16"])
+    assert len(cidrs) == 2
+    assert ip_filter.ip_to_int("10.0.0.200") in cidrs
+    assert ip_filter.ip_to_int("10.0.1.0") not in cidrs
+    column = sorted(ip_filter.ip_to_int(ip) for ip in ("9.255.255.255", "10.0.0.0", "10.0.0.255", "192.168.5.5", "200.0.0.1"))
+    assert cidrs.members(column) == [False, True, True, True, False]
+
+def test_classify_counts_each_reason():
+    raw = ["8.8.8.8", "008.008.008.008", "8.8.4.4", "1.1.1.1", "10.1.2.3", "999.1.1.1", "9.9.9.9", "4.4.4.4"]
+    result = ip_filter.classify_ips(raw,
+                                    allowlist=ip_filter.CidrSet(["8.8.0.0/16", "1.1.1.0/24", "9.9.9.0/24"]),
+                                    denylist=ip_filter.CidrSet(["9.9.9.9"]))
+    assert result == {'accepted': ["1.1.1.1", "8.8.4.4", "8.8.8.8"], 'invalid': 1, 'duplicates': 1,
+                      'bogons': 1, 'not_allowed': 1, 'denied': 1}
+
+def test_classify_can_keep_bogons():
+    assert ip_filter.classify_ips(["10.0.0.1", "127.0.0.1"], drop_bogons=False)['accepted'] == ["10.0.0.1", "127.0.0.1"]
+
+def test_classify_from_settings(monkeypatch):
+    monkeypatch.setenv("IP_DENYLIST", "8.8.8.0/24")
+    monkeypatch.setenv("IP_ALLOWLIST", "")
+    monkeypatch.setenv("DROP_BOGONS", "false")
+    assert ip_filter.classify_from_settings(["8.8.8.8", "10.0.0.1"])['accepted'] == ["10.0.0.1"]
+
+def test_token_pattern_skips_longer_dotted_numbers():
+    text = "from 1.2.3.4, version 1.2.3.4.5 and 5.6.7.8."
+    assert re.findall(ip_filter.IP_TOKEN_PATTERN, text) == ["1.2.3.4", "5.6.7.8"]
@@ -0,0 +1,16 @@
+import job_queue
+
+def test_ipqs_error_is_reported_on_the_job(db):
+    log = db / "access.log"
+    log.write_text("GET / from 8.8.8.8\n")  # No IPQS key is set, so the lookup fails without a request
+    updates = []
+    queue = job_queue.JobQueue(on_update=lambda job, message: updates.append(message))
+    try:
+        job = queue.submit(job_queue.AnalysisJob(str(log), None, None, 24))
+        job.future.result(timeout=60)
+    finally:
+        queue.shutdown()
+
+    assert job.status == job_queue.DONE
+    assert job.last_api_error == "IPQS Key not set."
+    assert any(message and "[API ERROR]" in message for message in updates)
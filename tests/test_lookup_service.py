@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime
+
+import database
+import lookup_service
+
+class FakeQueue:
+    """ The parts of job_queue.JobQueue the service uses; lookups just sleep. """
+    def __init__(self):
+        self.reserved_credits = 0
+        self.started = []
+        self.plan_lock = asyncio.Lock()
+
+    def inflight_future(self, info):
+        return None
+
+    def start_lookup(self, client, info):
+        self.started.append(info['ip'])
+        return asyncio.ensure_future(asyncio.sleep(0.05))
+
+def test_overlapping_requests_respect_day_cap(db, monkeypatch):
+    monkeypatch.setenv("IPQS_CREDIT_CAP_DAY", "5")
+
+    async def main():
+        queue = FakeQueue()
+        service = lookup_service.LookupService(queue, None, 24)
+        first, second = await asyncio.gather(service.resolve([f"8.8.8.{i}" for i in range(1, 5)]),
+                                             service.resolve([f"9.9.9.{i}" for i in range(1, 5)]))
+        return queue, first + second
+
+    queue, answers = asyncio.run(main())
+    assert len(queue.started) == 5
+    assert queue.reserved_credits == 0
+    assert [answer['source'] for answer in answers].count(lookup_service.SOURCE_STALE) == 3
+
+def test_cache_hits_do_not_wait_for_plan_lock(db):
+    database.add_ip_record("8.8.8.8", "US", False, 0, "Google", "Google", 0)
+
+    async def main():
+        queue = FakeQueue()
+        service = lookup_service.LookupService(queue, None, 24)
+        async with queue.plan_lock:  # An analysis job planning
+            return await asyncio.wait_for(service.resolve(["8.8.8.8"]), timeout=2)
+
+    answer, = asyncio.run(main())
+    assert answer['source'] == lookup_service.SOURCE_CACHE
+    assert answer['country'] == "US"
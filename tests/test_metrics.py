@@ -0,0 +1,71 @@
+import json
+
+import metrics
+
+def test_histogram_buckets_are_cumulative():
+    hist = metrics.Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        hist.observe(value)
+    assert hist.cumulative() == [(0.1, 2), (1.0, 3), ("+Inf", 4)]
+    assert (hist.count, hist.sum) == (4, 3.65)
+
+def test_histogram_quantiles():
+    hist = metrics.Histogram(buckets=(0.1, 1.0))
+    assert hist.quantile(0.5) is None
+    for value in (0.05, 0.05, 0.5, 3.0):
+        hist.observe(value)
+    assert hist.quantile(0.5) == 0.1
+    assert hist.quantile(0.75) == 1.0
+    assert hist.quantile(0.95) == "+Inf"
+
+def test_counters_and_cache_hit_ratio():
+    run = metrics.RunMetrics()
+    assert run.cache_hit_ratio() is None
+    run.incr("cache_lookups_total", 3, result=metrics.CACHE_FRESH)
+    run.incr("cache_lookups_total", result=metrics.CACHE_FEED)
+    run.incr("cache_lookups_total", 4, result=metrics.CACHE_NEW)
+    run.incr("provider_errors_total", provider="ipqs", error="timeout")
+    run.incr("provider_errors_total", provider="otx", error="timeout")
+    assert run.cache_hit_ratio() == 0.5
+    assert run.counter_total("provider_errors_total") == 2
+    assert run.counter_total("provider_errors_total", provider="ipqs") == 1
+
+    summary = run.summary()
+    assert (summary['cache_hits'], summary['cache_misses'], summary['provider_errors']) == (4, 4, 2)
+
+def test_prometheus_rendering():
+    run = metrics.RunMetrics()
+    run.add_stage("extract", 1.5)
+    run.add_stage("extract", 0.5)
+    run.observe_latency("ipqs", 0.2)
+    run.incr("provider_requests_total", 2, provider="ipqs")
+    lines = run.to_prometheus(batch_id=7).splitlines()
+
+    assert 'ipprism_stage_seconds_total{batch_id="7",stage="extract"} 2.000000' in lines
+    assert 'ipprism_provider_latency_seconds_bucket{batch_id="7",provider="ipqs",le="0.1"} 0' in lines
+    assert 'ipprism_provider_latency_seconds_bucket{batch_id="7",provider="ipqs",le="0.25"} 1' in lines
+    assert 'ipprism_provider_latency_seconds_bucket{batch_id="7",provider="ipqs",le="+Inf"} 1' in lines
+    assert 'ipprism_provider_latency_seconds_count{batch_id="7",provider="ipqs"} 1' in lines
+    assert lines.count("# TYPE ipprism_provider_requests_total counter") == 1
+    assert 'ipprism_provider_requests_total{batch_id="7",provider="ipqs"} 2' in lines
+
+def test_export_writes_json_and_prometheus(tmp_path, monkeypatch):
+    monkeypatch.setenv("METRICS_DIR", str(tmp_path / "out"))
+    run = metrics.RunMetrics()
+    with run.stage("store"):
+        pass
+    run.observe_latency("otx", 0.7)
+    path = metrics.export(run, 3)
+
+    data = json.loads(open(path, encoding="utf-8").read())
+    assert data['batch_id'] == 3
+    assert data['stages']['store']['count'] == 1
+    assert data['latency']['otx']['p50'] == 1.0
+    assert (tmp_path / "out" / "batch_3.prom").read_text(encoding="utf-8").endswith("\n")
+
+def test_null_metrics_accepts_every_update():
+    null = metrics.NULL_METRICS
+    with null.stage("extract"):
+        null.add_stage("extract", 1.0)
+        null.observe_latency("ipqs", 0.1)
+        null.incr("retries_total", provider="ipqs")
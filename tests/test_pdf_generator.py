@@ -0,0 +1,13 @@
+import pdf_generator
+
+def test_risk_tags_follow_malicious_threshold(monkeypatch):
+    monkeypatch.setenv("MALICIOUS_THRESHOLD", "90")
+    assert pdf_generator.high_risk_threshold() == 90
+    assert pdf_generator.risk_tags(90) == ('high_risk',)
+    assert pdf_generator.risk_tags(89) == ('medium_risk',)
+    assert pdf_generator.risk_tags(pdf_generator.MEDIUM_RISK_SCORE - 1) == ()
+    assert pdf_generator.risk_tags(None) == ()
+
+def test_risk_tags_with_explicit_threshold():
+    assert pdf_generator.risk_tags(85, 85) == ('high_risk',)
+    assert pdf_generator.risk_tags(84, 85) == ('medium_risk',)
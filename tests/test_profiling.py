@@ -0,0 +1,64 @@
+import threading
+
+import job_queue
+import profiling
+
+def _run_job(path, on_done):
+    queue = job_queue.JobQueue(on_update=lambda job, message: None)
+    try:
+        job = queue.submit(job_queue.AnalysisJob(str(path), None, None, 24, on_done=on_done))
+        job.future.result(timeout=60)
+        return job
+    finally:
+        queue.shutdown()
+
+def test_profiled_job_writes_report(db, monkeypatch):
+    monkeypatch.setenv("PROFILE_ANALYSIS", "true")
+    log = db / "access.log"
+    log.write_text("GET / from 10.0.0.1\nGET / from 192.168.1.7\n")  # Bogons only: no lookups needed
+    finished = threading.Event()
+
+    job = _run_job(log, lambda job: finished.set())
+
+    assert finished.is_set()
+    assert job.status == job_queue.DONE
+    reports = list((db / "profiles").glob("*.txt"))
+    assert len(reports) == 1
+    assert "_prepare" in reports[0].read_text(encoding="utf-8")  # The worker-thread stage was profiled
+    assert profiling._session_lock.acquire(blocking=False)
+    profiling._session_lock.release()
+
+def test_profile_failure_still_runs_on_done(db, monkeypatch):
+    monkeypatch.setenv("PROFILE_ANALYSIS", "true")
+    def broken_stop(self, batch_id):
+        profiling._session_lock.release()
+        raise TypeError("broken profile")
+    monkeypatch.setattr(profiling.ProfileSession, "stop", broken_stop)
+    log = db / "access.log"
+    log.write_text("10.0.0.1\n")
+    finished = threading.Event()
+
+    job = _run_job(log, lambda job: finished.set())
+
+    assert finished.is_set()
+    assert job.status == job_queue.DONE
+
+def test_session_refuses_when_another_profiler_is_active(db):
+    import asyncio
+    import cProfile
+    outer = cProfile.Profile()
+    loop = asyncio.new_event_loop()
+    try:
+        session = profiling.ProfileSession("job")
+        outer.enable()
+        try:
+            started = session.start(loop)
+        finally:
+            outer.disable()
+        if started:  # Before 3.12 profilers are per thread and do not conflict
+            session.stop(1)
+        else:
+            assert profiling._session_lock.acquire(blocking=False)
+            profiling._session_lock.release()
+    finally:
+        loop.close()
@@ -0,0 +1,72 @@
+import pytest
+
+import database
+import snapshot
+
+def _seed():
+    batch_id = database.add_import_batch("2026-01-01T00:00:00", "a.log", "first")
+    for i in range(3):
+        ip_id = database.add_ip_record(f"10.0.0.{i}", "US", i == 2, i * 40, "ISP", "Org", i, payload={'fraud_score': i * 40})
+        database.link_ip_to_batch(ip_id, batch_id, i + 1, 1, i + 1)
+    database.update_ip_details(ip_id, "scanner", "seen on the edge")
+    return batch_id
+
+def _contents():
+    ips = {}
+    for chunk in database.iter_ips_by_batch_ids([], ("ip_address", "fraud_score", "is_malicious", "otx_pulses", "tags", "notes",
+                                                     "last_api_check", "occurrences", "last_line")):
+        ips.update((row['ip_address'], tuple(row)) for row in chunk)
+    batches = [(batch['file_name'], batch['description']) for batch in database.get_all_batches()]
+    return ips, batches
+
+def test_snapshot_round_trip(db, monkeypatch):
+    _seed()
+    path = str(db / "cache.ipps")
+    counts = snapshot.export_snapshot(path)
+    assert counts == {"import_batches": 1, "ip_records": 3, "raw_payloads": 3, "batch_ip_link": 3}
+    expected = _contents()
+
+    other = db / "other"
+    other.mkdir()
+    monkeypatch.chdir(other)
+    database.setup_database()
+    assert snapshot.import_snapshot(path) == counts
+    assert _contents() == expected
+    ip_id = database.find_ip_details("10.0.0.2")['id']
+    conn = database.create_connection()
+    payload, = conn.execute("SELECT payload FROM raw_payloads WHERE ip_id = ?", (ip_id,)).fetchone()
+    conn.close()
+    assert database.decode_payload(payload) == {'fraud_score': 80}
+
+    # Importing again reuses the batch and does not count the links twice
+    snapshot.import_snapshot(path)
+    assert _contents() == expected
+
+def test_newest_check_wins_and_local_notes_stay(db, monkeypatch):
+    _seed()
+    path = str(db / "cache.ipps")
+    snapshot.export_snapshot(path)
+
+    other = db / "other"
+    other.mkdir()
+    monkeypatch.chdir(other)
+    database.setup_database()
+    ip_id = database.add_ip_record("10.0.0.1", "TH", True, 99, "Local ISP", "Local", 5)  # Checked after the export
+    database.update_ip_details(ip_id, "local tag", None)
+    ip_id = database.add_ip_record("10.0.0.0", "TH", False, 1, "Old ISP", "Old", 0)
+    conn = database.create_connection()
+    conn.execute("UPDATE ip_records SET last_api_check = '2000-01-01T00:00:00' WHERE id = ?", (ip_id,))
+    conn.commit()
+    conn.close()
+
+    snapshot.import_snapshot(path)
+    newer = database.find_ip_details("10.0.0.1")
+    assert (newer['fraud_score'], newer['country'], newer['tags']) == (99, "TH", "local tag")
+    older = database.find_ip_details("10.0.0.0")
+    assert (older['fraud_score'], older['country']) == (0, "US")
+
+def test_read_snapshot_rejects_other_files(tmp_path):
+    path = tmp_path / "cache.ipps"
+    path.write_bytes(b"IPPC1\n")
+    with pytest.raises(ValueError):
+        list(snapshot.read_snapshot(str(path)))